@@ -9,12 +9,23 @@ API 配置管理模块
 import os
 import json
 import logging
-from typing import Dict, List, Optional, Any
+import threading
+from typing import Dict, List, Optional, Any, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# HTTP 连接池配置（所有提供商共用默认值）
+POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', 10))
+MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+RETRY_BACKOFF = float(os.getenv('LLM_RETRY_BACKOFF', 0.3))
+CONNECT_TIMEOUT = int(os.getenv('LLM_CONNECT_TIMEOUT_MS', 5000)) / 1000
+READ_TIMEOUT = int(os.getenv('LLM_READ_TIMEOUT_MS', os.getenv('LONGCAT_API_TIMEOUT_MS', 30000))) / 1000
+
 
 class APIConfig:
     """API 配置类"""
@@ -23,16 +34,17 @@ class APIConfig:
     PROVIDERS = {
         'longcat': {
             'name': 'LongCat',
-            'base_url': 'https://api.longcat.chat/openai',
+            'base_url': os.getenv('LONGCAT_API_BASE_URL', 'https://api.longcat.chat/openai'),
             'api_key_env': 'LONGCAT_API_KEY',
             'models': ['LongCat-Flash-Chat', 'LongCat-Flash-Thinking'],
             'supports_stream': True,
         },
         'openai': {
             'name': 'OpenAI',
-            'base_url': 'https://api.openai.com',
+            'base_url': os.getenv('OPENAI_API_BASE_URL', 'https://api.openai.com'),
             'api_key_env': 'OPENAI_API_KEY',
             'models': ['gpt-4', 'gpt-4-turbo', 'gpt-3.5-turbo'],
+            'embedding_model': 'text-embedding-3-small',
             'supports_stream': True,
         },
         'anthropic': {
@@ -44,10 +56,12 @@ class APIConfig:
         },
         'ollama': {
             'name': 'Ollama (本地)',
-            'base_url': 'http://localhost:11434',
+            'base_url': os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434'),
             'api_key_env': None,  # Ollama 不需要 API Key
             'models': ['llama2', 'mistral', 'codellama'],
+            'embedding_model': 'nomic-embed-text',
             'supports_stream': True,
+            'read_timeout': 120,  # 本地模型首个 token 较慢
         },
         'custom': {
             'name': '自定义 OpenAI 兼容 API',
@@ -58,6 +72,10 @@ class APIConfig:
         },
     }
     
+    # 每个提供商共享一个 Session（线程安全，复用 keep-alive 连接）
+    _sessions: Dict[str, requests.Session] = {}
+    _session_lock = threading.Lock()
+    
     def __init__(self, provider: str = 'longcat'):
         """
         初始化 API 配置
@@ -71,6 +89,10 @@ class APIConfig:
         self.base_url = self.config['base_url']
         self.models = self.config['models']
         self.supports_stream = self.config['supports_stream']
+        self.pool_size = self.config.get('pool_size', POOL_SIZE)
+        self.max_retries = self.config.get('max_retries', MAX_RETRIES)
+        self.connect_timeout = self.config.get('connect_timeout', CONNECT_TIMEOUT)
+        self.read_timeout = self.config.get('read_timeout', READ_TIMEOUT)
     
     def _get_api_key(self) -> Optional[str]:
         """获取 API Key"""
@@ -92,6 +114,13 @@ class APIConfig:
         Args:
             endpoint_type: 端点类型 ('chat', 'completion', 'embedding')
         """
+        if endpoint_type == 'embedding':
+            if self.provider == 'anthropic':
+                raise ValueError(f'{self.config["name"]} 不提供向量接口')
+            if self.provider == 'ollama':
+                return f'{self.base_url}/api/embed'
+            return f'{self.base_url}/v1/embeddings'
+        
         if self.provider == 'anthropic':
             return f'{self.base_url}/v1/messages'
         elif self.provider == 'ollama':
@@ -115,6 +144,53 @@ class APIConfig:
         
         return headers
     
+    def get_timeout(self) -> Tuple[float, float]:
+        """获取 (连接超时, 读取超时)，单位秒"""
+        return (self.connect_timeout, self.read_timeout)
+    
+    def get_session(self) -> requests.Session:
+        """
+        获取该提供商共享的 HTTP Session
+        
+        Session 带连接池和 keep-alive，连接错误时按指数退避重试。
+        只重试连接阶段的错误（请求尚未发出），不会重复提交已发送的请求。
+        """
+        session = self._sessions.get(self.provider)
+        if session is not None:
+            return session
+        
+        with self._session_lock:
+            session = self._sessions.get(self.provider)
+            if session is None:
+                retry = Retry(
+                    total=self.max_retries,
+                    connect=self.max_retries,
+                    read=0,
+                    status=0,
+                    other=0,
+                    backoff_factor=RETRY_BACKOFF,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[self.provider] = session
+                logger.info(f'已创建 {self.config["name"]} 连接池: 大小={self.pool_size}, 重试={self.max_retries}')
+        return session
+    
+    @classmethod
+    def close_sessions(cls):
+        """关闭所有共享的 HTTP Session"""
+        with cls._session_lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+    
     def format_messages(self, messages: List[Dict]) -> Any:
         """
         格式化消息为特定 API 格式
@@ -127,12 +203,13 @@ class APIConfig:
         """
         if self.provider == 'anthropic':
             # Anthropic 使用不同的消息格式
-            system_message = None
+            system_parts = []
             formatted_messages = []
             
             for msg in messages:
                 if msg['role'] == 'system':
-                    system_message = msg['content']
+                    # 多条系统消息（固定前缀 + 动态上下文）合并为一个 system 字段
+                    system_parts.append(msg['content'])
                 else:
                     formatted_messages.append({
                         'role': msg['role'],
@@ -140,7 +217,7 @@ class APIConfig:
                     })
             
             return {
-                'system': system_message,
+                'system': '\n\n'.join(system_parts) or None,
                 'messages': formatted_messages
             }
         else:
@@ -170,6 +247,14 @@ class APIConfig:
             if formatted['system']:
                 body['system'] = formatted['system']
             return body
+        elif self.provider == 'ollama':
+            # Ollama 的采样参数放在 options 中
+            return {
+                'model': model,
+                'messages': messages,
+                'stream': stream,
+                'options': {'temperature': temperature},
+            }
         else:
             # OpenAI 兼容格式
             return {
@@ -192,31 +277,57 @@ class APIConfig:
         if not line.strip():
             return None
         
-        # 处理 SSE 格式
-        if line.startswith('data: '):
+        if self.stream_format == 'ndjson':
+            # Ollama 每行一个 JSON 对象
+            data_str = line.strip()
+        elif line.startswith('data: '):
+            # 处理 SSE 格式
             data_str = line[6:].strip()
             
             if data_str == '[DONE]':
                 return None
-            
-            try:
-                chunk_data = json.loads(data_str)
-                
-                if self.provider == 'anthropic':
-                    # Anthropic 格式
-                    if chunk_data.get('type') == 'content_block_delta':
-                        delta = chunk_data.get('delta', {})
-                        return delta.get('text', '')
-                else:
-                    # OpenAI 兼容格式
-                    delta = chunk_data.get('choices', [{}])[0].get('delta', {})
-                    return delta.get('content', '')
-            
-            except json.JSONDecodeError:
-                logger.warning(f'JSON 解析失败: {data_str[:100]}')
-                return None
+        else:
+            return None
         
-        return None
+        try:
+            return self.extract_stream_content(json.loads(data_str))
+        except json.JSONDecodeError:
+            logger.warning(f'JSON 解析失败: {data_str[:100]}')
+            return None
+    
+    @property
+    def stream_format(self) -> str:
+        """流式响应格式: 'sse' 或 'ndjson'"""
+        return 'ndjson' if self.provider == 'ollama' else 'sse'
+    
+    def extract_stream_content(self, chunk_data: Dict) -> Optional[str]:
+        """从一个流式数据块中提取增量文本"""
+        if not isinstance(chunk_data, dict):
+            return None
+        
+        if self.provider == 'anthropic':
+            # Anthropic 格式
+            if chunk_data.get('type') == 'content_block_delta':
+                return chunk_data.get('delta', {}).get('text', '')
+            return None
+        elif self.provider == 'ollama':
+            # Ollama 格式
+            return chunk_data.get('message', {}).get('content', '')
+        else:
+            # OpenAI 兼容格式
+            choices = chunk_data.get('choices') or [{}]
+            return (choices[0].get('delta') or {}).get('content', '')
+    
+    def extract_response_content(self, data: Dict) -> str:
+        """从非流式响应中提取完整文本"""
+        if self.provider == 'anthropic':
+            blocks = data.get('content') or []
+            return ''.join(block.get('text', '') for block in blocks if block.get('type') == 'text')
+        elif self.provider == 'ollama':
+            return data.get('message', {}).get('content', '')
+        else:
+            choices = data.get('choices') or [{}]
+            return (choices[0].get('message') or {}).get('content', '') or choices[0].get('text', '')
     
     @classmethod
     def get_available_providers(cls) -> List[Dict]:
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+向量索引召回率 / 延迟基准测试
+在聚类分布的合成向量上比较精确点积检索与各 ANN 实现（不同 ef_search）的
+recall@k、查询延迟（p50 / p99）和构建时间。
+
+用法:
+    python benchmarks/ann_benchmark.py --size 20000 --dim 256 --queries 200
+    python benchmarks/ann_benchmark.py --index hnsw hnswlib --ef 16 32 64 128 --json results.json
+"""
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.utils.embeddings import EmbeddingMatrix, normalize
+from src.utils.ann_index import create_ann_index
+
+
+def make_dataset(size: int, dim: int, queries: int, clusters: int = 100, seed: int = 0):
+    """生成聚类分布的归一化向量和带噪声的查询（接近真实语义向量的分布）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    data = centers[rng.integers(0, clusters, size)] + 0.6 * rng.normal(size=(size, dim))
+    picks = data[rng.integers(0, size, queries)]
+    query_vectors = picks + 0.3 * rng.normal(size=(queries, dim))
+    return normalize(data), normalize(query_vectors)
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def exact_search(matrix: EmbeddingMatrix, queries: np.ndarray, k: int):
+    """精确检索：连续矩阵上的点积 + argpartition"""
+    truth, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        sims = matrix.similarities(query)
+        top = np.argpartition(-sims, k)[:k]
+        top = top[np.argsort(-sims[top])]
+        latencies.append(time.perf_counter() - started)
+        truth.append({matrix.keys[i] for i in top.tolist()})
+    return truth, latencies
+
+
+def run(args):
+    data, queries = make_dataset(args.size, args.dim, args.queries, seed=args.seed)
+    print(f'数据集: {args.size} 条 × {args.dim} 维, {args.queries} 个查询, k={args.k}')
+
+    matrix = EmbeddingMatrix(args.dim, capacity=args.size)
+    for i, vector in enumerate(data):
+        matrix.add(i, vector)
+    truth, latencies = exact_search(matrix, queries, args.k)
+
+    results = [{
+        'index': 'exact',
+        'ef_search': None,
+        'build_seconds': 0.0,
+        'recall': 1.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }]
+
+    for kind in args.index:
+        try:
+            index = create_ann_index(kind, args.dim, M=args.m, ef_construction=args.ef_construction)
+        except ImportError as e:
+            print(f'跳过 {kind}: {e}')
+            continue
+
+        started = time.perf_counter()
+        index.add_items(list(range(args.size)), data)
+        build_seconds = time.perf_counter() - started
+
+        for ef in args.ef:
+            index.set_ef(ef)
+
+            hits, latencies = 0, []
+            for query, expected in zip(queries, truth):
+                started = time.perf_counter()
+                found = index.search(query, args.k)
+                latencies.append(time.perf_counter() - started)
+                hits += len(expected & {key for key, _ in found})
+
+            results.append({
+                'index': index.kind,
+                'ef_search': ef,
+                'build_seconds': build_seconds,
+                'recall': hits / (len(queries) * args.k),
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+            })
+
+    print(f'\n{"索引":<10}{"ef":>6}{"构建(s)":>10}{"recall@k":>10}{"p50(ms)":>10}{"p99(ms)":>10}')
+    for r in results:
+        print(f'{r["index"]:<10}{r["ef_search"] or "-":>6}{r["build_seconds"]:>10.1f}'
+              f'{r["recall"]:>10.3f}{r["p50_ms"]:>10.2f}{r["p99_ms"]:>10.2f}')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'params': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f'\n结果已写入 {args.json}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='向量索引召回率 / 延迟基准测试')
+    parser.add_argument('--size', type=int, default=10000, help='向量数量')
+    parser.add_argument('--dim', type=int, default=256, help='向量维度')
+    parser.add_argument('--queries', type=int, default=200, help='查询数量')
+    parser.add_argument('--k', type=int, default=10, help='每次查询返回数量')
+    parser.add_argument('--index', nargs='+', default=['hnsw', 'hnswlib', 'faiss'], help='要测试的索引实现')
+    parser.add_argument('--ef', type=int, nargs='+', default=[16, 32, 64, 128], help='ef_search 取值')
+    parser.add_argument('--m', type=int, default=16, help='HNSW 的 M 参数')
+    parser.add_argument('--ef-construction', type=int, default=100, help='构建时的 ef')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
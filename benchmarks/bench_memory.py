@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+记忆管理器 / 数据库热路径基准测试
+在合成的中英文记忆语料（1k / 10k / 100k / 1M 条）上测量：
+    vectorize、retrieve_memories、get_all_memories、merge_similar_memories、apply_decay、
+    _load_cache，以及 Database 的写入 / 查询 / 导出
+输出 ops/sec、p50 / p99 延迟和峰值 RSS，以 JSON 保存后可在不同提交之间对比。
+另外在全新的解释器中测量 `import server_v2`、create_app() 和预加载的耗时，
+导入时间超过 --import-budget-ms 时以退出码 1 结束。
+
+每个规模在独立的子进程中运行（峰值 RSS 互不影响），数据库放在临时目录，不会改动 memory_data.db。
+
+用法:
+    python benchmarks/bench_memory.py --sizes 1000 10000 --json before.json
+    python benchmarks/bench_memory.py --sizes 1000 10000 --json after.json --compare before.json
+    python benchmarks/bench_memory.py --sizes 100000 --skip merge_similar_memories apply_decay
+    python benchmarks/bench_memory.py --embedding hashing      # 测量语义向量检索路径
+    python benchmarks/bench_memory.py --sizes --import-budget-ms 200   # 只检查启动耗时
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+BENCHMARKS = [
+    'db_insert', 'db_add_memory', 'db_query', 'db_get_memory', 'db_export',
+    'load_cache', 'vectorize', 'retrieve_memories', 'get_all_memories',
+    'merge_similar_memories', 'apply_decay',
+]
+
+# ==================== 合成语料 ====================
+
+CN_SUBJECTS = ['用户', '我', '我的朋友', '我妈妈', '同事', '老板', '室友', '孩子']
+CN_VERBS = ['喜欢', '讨厌', '经常去', '想学', '正在读', '每天吃', '买了', '收藏了', '最近在看', '害怕']
+CN_OBJECTS = [
+    '苹果', '香蕉', '火锅', '北京烤鸭', '咖啡', '绿茶', '爬山', '游泳', '钢琴', '吉他', '编程', '摄影',
+    '科幻小说', '历史纪录片', '猫', '狗', '上海', '杭州', '日本料理', '篮球', '围棋', '油画', '瑜伽', '跑步',
+]
+CN_TAILS = ['', '，尤其是周末', '，已经坚持了三年', '，但是最近没时间', '，觉得很放松', '，打算明年继续']
+
+EN_SUBJECTS = ['The user', 'My friend', 'My sister', 'A colleague', 'The manager', 'My roommate']
+EN_VERBS = ['likes', 'hates', 'often visits', 'wants to learn', 'is reading', 'eats', 'bought', 'collects']
+EN_OBJECTS = [
+    'apples', 'bananas', 'hot pot', 'coffee', 'green tea', 'hiking', 'swimming', 'piano', 'guitar',
+    'python programming', 'photography', 'science fiction', 'documentaries', 'cats', 'dogs', 'tokyo',
+    'italian food', 'basketball', 'chess', 'painting', 'yoga', 'running', 'jazz', 'board games',
+]
+EN_TAILS = ['', ' on weekends', ' for three years now', ' but has no time lately', ' to relax', ' every morning']
+
+
+def make_sentence(rng: random.Random, lang: str) -> str:
+    if lang == 'mixed':
+        lang = 'cn' if rng.random() < 0.7 else 'en'
+    if lang == 'cn':
+        return rng.choice(CN_SUBJECTS) + rng.choice(CN_VERBS) + rng.choice(CN_OBJECTS) + rng.choice(CN_TAILS)
+    return f'{rng.choice(EN_SUBJECTS)} {rng.choice(EN_VERBS)} {rng.choice(EN_OBJECTS)}{rng.choice(EN_TAILS)}'
+
+
+def make_corpus(size: int, lang: str, per_persona: int, public_ratio: float, seed: int):
+    """生成 (persona_id, 内容, 是否公共) 列表，平均每个角色 per_persona 条"""
+    rng = random.Random(seed)
+    personas = max(1, size // per_persona)
+    return [
+        (rng.randint(1, personas), make_sentence(rng, lang), rng.random() < public_ratio)
+        for _ in range(size)
+    ], personas
+
+
+# ==================== 统计 ====================
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def current_rss_mb() -> float:
+    """当前常驻内存（Linux 读 /proc，其他平台退回峰值）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(latencies, items_per_op: int = 1) -> dict:
+    """延迟样本（秒）-> 统计结果"""
+    total = sum(latencies)
+    return {
+        'count': len(latencies),
+        'items_per_op': items_per_op,
+        'total_seconds': round(total, 6),
+        'ops_per_sec': round(len(latencies) * items_per_op / total, 2) if total else None,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'rss_mb': round(current_rss_mb(), 1),
+    }
+
+
+def measure(func, repeat: int, max_seconds: float, items_per_op: int = 1) -> dict:
+    """重复执行 func()，直到达到 repeat 次或超过 max_seconds"""
+    latencies = []
+    deadline = time.perf_counter() + max_seconds
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - started)
+        if time.perf_counter() > deadline:
+            break
+    return summarize(latencies, items_per_op)
+
+
+# ==================== 单个规模 ====================
+
+def run_scale(size: int, options: dict) -> dict:
+    """在子进程中运行一个规模的全部基准"""
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    if options['embedding']:
+        os.environ['EMBEDDING_BACKEND'] = options['embedding']
+    else:
+        os.environ.pop('EMBEDDING_BACKEND', None)
+
+    import database
+    from src.utils.memory_manager_v2 import MemoryManager
+
+    corpus, personas = make_corpus(size, options['lang'], options['per_persona'],
+                                   options['public_ratio'], options['seed'])
+    rng = random.Random(options['seed'] + 1)
+    queries = [make_sentence(rng, options['lang']) for _ in range(1000)]
+    persona_ids = [rng.randint(1, personas) for _ in range(1000)]
+    skip = set(options['skip'])
+    repeat, max_seconds = options['repeat'], options['max_seconds']
+
+    results = {}
+
+    def bench(name, func, *args, **kwargs):
+        if name in skip:
+            return
+        results[name] = func(*args, **kwargs)
+        r = results[name]
+        print(f'  [{size}] {name:<24}{r["ops_per_sec"] or 0:>14,.1f} ops/s'
+              f'{r["p50_ms"]:>12.3f} ms p50{r["p99_ms"]:>12.3f} ms p99', flush=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = database.Database(os.path.join(tmp, 'bench.db'))
+        database._db_instance = db
+        with db.get_connection() as conn:
+            conn.executemany('INSERT INTO personas (id, name) VALUES (?, ?)',
+                             [(i, f'persona-{i}') for i in range(1, personas + 1)])
+
+        # ---------- Database ----------
+        batch = options['batch']
+        batches = [corpus[i:i + batch] for i in range(0, len(corpus), batch)]
+        vectorizer = MemoryManager(use_database=False, embedding_backend=None)
+
+        def insert_batch(i):
+            db.add_memories([{
+                'persona_id': pid, 'content': content, 'vector': vectorizer.vectorize(content),
+                'is_public': is_public,
+            } for pid, content, is_public in batches[i]])
+
+        # 语料必须完整写入，不受时间限制
+        results['db_insert'] = measure(insert_batch, len(batches), float('inf'), items_per_op=batch)
+        bench('db_add_memory', measure,
+              lambda i: db.add_memory(persona_ids[i % 1000], queries[i % 1000], vectorizer.vectorize(queries[i % 1000])),
+              min(repeat, 200), max_seconds)
+        bench('db_query', measure, lambda i: db.get_memories(persona_ids[i % 1000]), repeat, max_seconds)
+        bench('db_get_memory', measure, lambda i: db.get_memory(rng.randint(1, size)), repeat, max_seconds)
+        bench('db_export', measure, lambda i: db.export_all_data(), 3, max_seconds)
+
+        # ---------- MemoryManager ----------
+        manager = None
+
+        def load(i):
+            nonlocal manager
+            manager = None
+            manager = MemoryManager(use_database=True)
+
+        if 'load_cache' in skip:
+            manager = MemoryManager(use_database=True)
+        else:
+            bench('load_cache', measure, load, 3, max_seconds)
+
+        bench('vectorize', measure, lambda i: manager.vectorize(queries[i % 1000]), repeat * 10, max_seconds)
+        bench('retrieve_memories', measure,
+              lambda i: manager.retrieve_memories(persona_ids[i % 1000], queries[i % 1000], 5),
+              repeat, max_seconds)
+        bench('get_all_memories', measure, lambda i: manager.get_all_memories(persona_ids[i % 1000]),
+              repeat, max_seconds)
+
+        # 以下操作会修改数据，只执行一次
+        bench('merge_similar_memories', measure, lambda i: manager.merge_similar_memories(0.8), 1, max_seconds)
+        bench('apply_decay', measure, lambda i: manager.apply_decay(), 1, max_seconds)
+
+        db.close()
+
+    if 'db_insert' in results:
+        print(f'  [{size}] {"db_insert":<24}{results["db_insert"]["ops_per_sec"]:>14,.1f} rows/s', flush=True)
+    return {
+        'size': size,
+        'personas': personas,
+        'benchmarks': results,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+# ==================== 启动耗时 ====================
+
+# 应该延迟到第一次使用时才导入的模块
+LAZY_MODULES = ['requests', 'numpy', 'flask_cors', 'dotenv', 'database', 'llm_client', 'src.utils.memory_manager_v2']
+
+STARTUP_SCRIPT = '''
+import sys, json, time
+started = time.perf_counter()
+import server_v2
+imported = time.perf_counter()
+eager = [m for m in %r if m in sys.modules]
+app = server_v2.create_app({'BACKGROUND': False, 'LOAD_DOTENV': False, 'PRELOAD': False})
+created = time.perf_counter()
+app.extensions['server_v2'].preload()
+preloaded = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'preload_ms': (preloaded - created) * 1000,
+    'eager_modules': eager,
+}))
+''' % LAZY_MODULES
+
+
+def measure_startup(repeat: int, budget_ms: float) -> dict:
+    """在全新的解释器中测量 import server_v2 / create_app() / 预加载的耗时（毫秒）"""
+    samples = {'import_ms': [], 'create_app_ms': [], 'preload_ms': []}
+    with tempfile.TemporaryDirectory(prefix='bench-startup-') as tmp:
+        env = dict(os.environ, MEMORY_DB_PATH=os.path.join(tmp, 'memory.db'))
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=ROOT, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            for key in samples:
+                samples[key].append(result[key])
+
+    startup = {key: {'p50': round(percentile(values, 0.5), 1), 'max': round(max(values), 1)}
+               for key, values in samples.items()}
+    startup['eager_modules'] = result['eager_modules']
+    startup['budget_ms'] = budget_ms
+    startup['within_budget'] = startup['import_ms']['p50'] <= budget_ms
+    return startup
+
+
+# ==================== 汇总 ====================
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def compare(results: list, baseline_path: str, startup: dict = None):
+    """与之前保存的结果对比 ops/sec（>1 表示更快）"""
+    with open(baseline_path, encoding='utf-8') as f:
+        data = json.load(f)
+    baseline = {r['size']: r for r in data['results']}
+
+    if startup and data.get('startup'):
+        print(f'\n启动耗时（毫秒，p50）: ' + '，'.join(
+            f'{key} {data["startup"][key]["p50"]:.1f} → {startup[key]["p50"]:.1f}'
+            for key in ('import_ms', 'create_app_ms', 'preload_ms')))
+    if not results:
+        return
+
+    print(f'\n与 {baseline_path} 对比（ops/sec 比值，>1 表示更快）')
+    print(f'{"规模":>10}  {"基准":<24}{"之前":>14}{"现在":>14}{"比值":>8}')
+    for result in results:
+        before = baseline.get(result['size'])
+        if not before:
+            continue
+        for name, now in result['benchmarks'].items():
+            old = before['benchmarks'].get(name)
+            if not old or not old['ops_per_sec'] or not now['ops_per_sec']:
+                continue
+            print(f'{result["size"]:>10}  {name:<24}{old["ops_per_sec"]:>14,.1f}{now["ops_per_sec"]:>14,.1f}'
+                  f'{now["ops_per_sec"] / old["ops_per_sec"]:>8.2f}')
+        print(f'{result["size"]:>10}  {"peak_rss_mb":<24}{before["peak_rss_mb"]:>14,.1f}{result["peak_rss_mb"]:>14,.1f}'
+              f'{result["peak_rss_mb"] / before["peak_rss_mb"]:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='记忆管理器 / 数据库热路径基准测试')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000],
+                        help='语料规模（例如 1000 10000 100000 1000000）')
+    parser.add_argument('--lang', choices=['cn', 'en', 'mixed'], default='mixed', help='语料语言')
+    parser.add_argument('--per-persona', type=int, default=100, help='平均每个角色的记忆数')
+    parser.add_argument('--public-ratio', type=float, default=0.1, help='公共记忆比例')
+    parser.add_argument('--batch', type=int, default=1000, help='批量写入的批大小')
+    parser.add_argument('--repeat', type=int, default=200, help='每个基准最多执行次数')
+    parser.add_argument('--max-seconds', type=float, default=10.0, help='每个基准的时间上限（秒）')
+    parser.add_argument('--skip', nargs='*', default=[], choices=BENCHMARKS, help='跳过的基准')
+    parser.add_argument('--embedding', default='', help='向量后端（默认不使用，即词频向量）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    parser.add_argument('--compare', help='与之前保存的 JSON 结果对比')
+    parser.add_argument('--import-budget-ms', type=float, default=250.0, help='import server_v2 的耗时预算（毫秒，p50）')
+    parser.add_argument('--import-repeat', type=int, default=5, help='启动耗时的测量次数（0 表示不测量）')
+    args = parser.parse_args()
+
+    options = {
+        'lang': args.lang, 'per_persona': args.per_persona, 'public_ratio': args.public_ratio,
+        'batch': args.batch, 'repeat': args.repeat, 'max_seconds': args.max_seconds,
+        'skip': args.skip, 'embedding': args.embedding, 'seed': args.seed,
+    }
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in args.sizes:
+        print(f'规模 {size}:', flush=True)
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_scale, (size, options)))
+        print(f'  [{size}] 峰值 RSS: {results[-1]["peak_rss_mb"]:.1f} MB\n', flush=True)
+
+    startup = None
+    if args.import_repeat > 0:
+        startup = measure_startup(args.import_repeat, args.import_budget_ms)
+        status = '✅' if startup['within_budget'] else '❌ 超出预算'
+        print(f'启动耗时: import server_v2 {startup["import_ms"]["p50"]:.1f} ms（预算 {args.import_budget_ms:.0f} ms）{status}，'
+              f'create_app {startup["create_app_ms"]["p50"]:.1f} ms，预加载 {startup["preload_ms"]["p50"]:.1f} ms')
+        if startup['eager_modules']:
+            print(f'  导入时已加载: {", ".join(startup["eager_modules"])}')
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'params': vars(args),
+        'results': results,
+        'startup': startup,
+    }
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'结果已写入 {args.json}')
+    if args.compare:
+        compare(results, args.compare, startup)
+    return report
+
+
+if __name__ == '__main__':
+    report = main()
+    sys.exit(0 if not report['startup'] or report['startup']['within_budget'] else 1)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+端到端压测工具
+启动本地模拟 LLM 服务（mock_llm_server.py）和 server_v2.py / server.py / serve.py（使用临时数据库），
+用并发用户混合请求 /chat、/memories-live 和 /memories，报告：
+    首字节时间（TTFB）、tokens/sec、错误率、各接口延迟分位数，以及服务进程的 CPU / RSS
+
+用法:
+    python benchmarks/load_test.py --concurrency 16 --duration 30
+    python benchmarks/load_test.py --server server.py --ttft 0.5 --token-rate 30 --error-rate 0.05
+    python benchmarks/load_test.py --mix chat=1 memories=5 live=2 --json load.json
+    python benchmarks/load_test.py --url http://localhost:3001 --server-pid 12345   # 压测已运行的服务
+    WEB_CONCURRENCY=4 python benchmarks/load_test.py --server serve.py            # prefork 多进程
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(Path(__file__).parent))
+
+from mock_llm_server import MockLLMConfig, MockLLMServer
+
+ENDPOINTS = ('chat', 'memories', 'live')
+
+CHAT_MESSAGES = [
+    '我最近在学钢琴，有什么练习建议吗？', '帮我总结一下今天的工作', '推荐几本科幻小说',
+    '我喜欢爬山和摄影，周末去哪里好？', 'How do I learn Python quickly?', '翻译一下：今天天气很好',
+    '我养了一只猫，它最近不爱吃东西', '给我讲个笑话吧',
+]
+SEARCH_QUERIES = ['钢琴', '科幻', '爬山', 'Python', '猫', '工作', '天气']
+
+_CJK = re.compile('[\u4e00-\u9fff]')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+# ==================== 服务进程采样 ====================
+
+class ProcessSampler(threading.Thread):
+    """定期采样进程（含子进程）的 CPU 占用和内存（Linux 读 /proc，其他平台需要 psutil）"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # (CPU %, RSS MB, PSS MB)
+        self._stop_event = threading.Event()
+        try:
+            import psutil
+            self._process = psutil.Process(pid)
+        except Exception:
+            self._process = None
+
+    def _children(self):
+        """子进程（prefork 的 worker）"""
+        try:
+            with open(f'/proc/{self.pid}/task/{self.pid}/children') as f:
+                return [int(pid) for pid in f.read().split()]
+        except OSError:
+            return []
+
+    def _read(self):
+        """返回 (累计 CPU 秒数, RSS MB, PSS MB)，包含子进程；PSS 按共享页的进程数分摊，无法读取时为 None"""
+        if self._process is not None:
+            cpu = rss = 0.0
+            for proc in [self._process] + self._process.children(recursive=True):
+                times = proc.cpu_times()
+                cpu += times.user + times.system
+                rss += proc.memory_info().rss / 1024 / 1024
+            return cpu, rss, None
+
+        cpu = rss = pss = 0.0
+        for pid in [self.pid] + self._children():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+                with open(f'/proc/{pid}/statm') as f:
+                    rss += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+            except OSError:
+                if pid == self.pid:
+                    raise
+                continue  # 子进程已退出
+            if pss is not None:
+                try:
+                    with open(f'/proc/{pid}/smaps_rollup') as f:
+                        pss += next(int(line.split()[1]) for line in f if line.startswith('Pss:')) / 1024
+                except (OSError, StopIteration):
+                    pss = None
+        return cpu, rss, pss
+
+    def run(self):
+        try:
+            last_cpu, _, _ = self._read()
+        except Exception:
+            return  # 无法采样（进程不存在或平台不支持）
+        last_time = time.monotonic()
+        while not self._stop_event.wait(self.interval):
+            try:
+                cpu, rss, pss = self._read()
+            except Exception:
+                return
+            now = time.monotonic()
+            self.samples.append(((cpu - last_cpu) / (now - last_time) * 100, rss, pss))
+            last_cpu, last_time = cpu, now
+
+    def stop(self) -> dict:
+        self._stop_event.set()
+        self.join(timeout=2)
+        if not self.samples:
+            return {}
+        cpu = [s[0] for s in self.samples]
+        rss = [s[1] for s in self.samples]
+        pss = [s[2] for s in self.samples if s[2] is not None]
+        report = {
+            'cpu_percent_avg': round(sum(cpu) / len(cpu), 1),
+            'cpu_percent_max': round(max(cpu), 1),
+            'rss_mb_max': round(max(rss), 1),
+            'rss_mb_end': round(rss[-1], 1),
+        }
+        if pss:
+            report['pss_mb_max'] = round(max(pss), 1)
+        return report
+
+
+# ==================== 服务启动 ====================
+
+def start_server(args, mock: MockLLMServer, workdir: str):
+    """启动被测服务（模拟 LLM 和临时数据库），返回 (进程, URL)"""
+    port = free_port()
+    env = os.environ.copy()
+    env.update({
+        'PORT': str(port),
+        'MEMORY_DB_PATH': os.path.join(workdir, 'load_test.db'),
+        'LONGCAT_API_BASE_URL': mock.base_url,
+        'LONGCAT_API_KEY': 'mock-key',
+        'CHAT_PROVIDER': 'longcat',
+        'SUMMARY_PROVIDER': 'longcat',
+        'ROUTER_BACKENDS': '',
+        'EMBEDDING_BACKEND': args.embedding,
+        'PYTHONUNBUFFERED': '1',
+    })
+    log = open(args.server_log, 'wb') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, str(ROOT / args.server)], cwd=str(ROOT), env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{args.server} 启动失败（退出码 {process.returncode}），可用 --server-log 查看输出')
+        try:
+            if requests.get(f'{url}/personas', timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{args.server} 在 {args.startup_timeout} 秒内没有就绪')
+
+
+# ==================== 请求 ====================
+
+def do_chat(session: requests.Session, url: str, persona: int, rng: random.Random, timeout: float) -> dict:
+    started = time.perf_counter()
+    result = {'endpoint': 'chat', 'ok': False}
+    try:
+        with session.post(f'{url}/chat', json={'persona': persona, 'message': rng.choice(CHAT_MESSAGES)},
+                          stream=True, timeout=timeout) as response:
+            chunks = []
+            first = None
+            for chunk in response.iter_content(chunk_size=None):
+                if first is None:
+                    first = time.perf_counter()
+                chunks.append(chunk)
+            text = b''.join(chunks).decode('utf-8', errors='replace')
+        ended = time.perf_counter()
+        tokens = len(_CJK.findall(text))  # 模拟服务每个 token 是一个汉字
+        result.update({
+            'ok': response.status_code == 200 and '错误:' not in text and tokens > 0,
+            'status': response.status_code,
+            'ttfb': (first or ended) - started,
+            'duration': ended - started,
+            'tokens': tokens,
+            'tokens_per_sec': tokens / (ended - first) if first and ended > first else None,
+        })
+    except requests.RequestException as e:
+        result.update({'error': type(e).__name__, 'duration': time.perf_counter() - started})
+    return result
+
+
+def do_get(session: requests.Session, endpoint: str, path: str, params: dict, timeout: float) -> dict:
+    started = time.perf_counter()
+    result = {'endpoint': endpoint, 'ok': False}
+    try:
+        response = session.get(path, params=params, timeout=timeout, stream=True)
+        first = time.perf_counter()
+        body = response.content
+        ended = time.perf_counter()
+        result.update({
+            'ok': response.status_code == 200,
+            'status': response.status_code,
+            'ttfb': first - started,
+            'duration': ended - started,
+            'bytes': len(body),
+        })
+    except requests.RequestException as e:
+        result.update({'error': type(e).__name__, 'duration': time.perf_counter() - started})
+    return result
+
+
+def user_loop(user_id: int, args, url: str, deadline: float, results: list):
+    """一个并发用户：按权重随机选择接口，直到压测结束"""
+    rng = random.Random(args.seed + user_id)
+    session = requests.Session()
+    weights = [args.mix.get(name, 0) for name in ENDPOINTS]
+    while time.monotonic() < deadline:
+        endpoint = rng.choices(ENDPOINTS, weights)[0]
+        persona = rng.choice(args.personas)
+        if endpoint == 'chat':
+            result = do_chat(session, url, persona, rng, args.timeout)
+        elif endpoint == 'memories':
+            result = do_get(session, endpoint, f'{url}/memories/{persona}', {}, args.timeout)
+        else:
+            result = do_get(session, endpoint, f'{url}/memories-live/{persona}',
+                            {'query': rng.choice(SEARCH_QUERIES)} if rng.random() < 0.5 else {}, args.timeout)
+        result['finished_at'] = time.monotonic()
+        results.append(result)
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+    session.close()
+
+
+# ==================== 汇总 ====================
+
+def summarize(results: list, elapsed: float) -> dict:
+    report = {}
+    for endpoint in ENDPOINTS:
+        rows = [r for r in results if r['endpoint'] == endpoint]
+        if not rows:
+            continue
+        ok = [r for r in rows if r['ok']]
+        ttfb = [r['ttfb'] for r in ok]
+        duration = [r['duration'] for r in ok]
+        stats = {
+            'requests': len(rows),
+            'errors': len(rows) - len(ok),
+            'error_rate': round((len(rows) - len(ok)) / len(rows), 4),
+            'rps': round(len(ok) / elapsed, 2),
+            'ttfb_ms': {f'p{int(p * 100)}': round(percentile(ttfb, p) * 1000, 1) if ttfb else None
+                        for p in (0.5, 0.95, 0.99)},
+            'duration_ms': {f'p{int(p * 100)}': round(percentile(duration, p) * 1000, 1) if duration else None
+                            for p in (0.5, 0.95, 0.99)},
+        }
+        if endpoint == 'chat':
+            rates = [r['tokens_per_sec'] for r in ok if r.get('tokens_per_sec')]
+            stats['tokens_total'] = sum(r['tokens'] for r in ok)
+            stats['tokens_per_sec'] = {
+                'aggregate': round(stats['tokens_total'] / elapsed, 1),
+                'per_stream_p50': round(percentile(rates, 0.5), 1) if rates else None,
+                'per_stream_p5': round(percentile(rates, 0.05), 1) if rates else None,
+            }
+        errors = {}
+        for r in rows:
+            if not r['ok']:
+                key = r.get('error') or f'HTTP {r.get("status")}'
+                errors[key] = errors.get(key, 0) + 1
+        if errors:
+            stats['error_kinds'] = errors
+        report[endpoint] = stats
+    return report
+
+
+def print_report(report: dict):
+    print(f'\n{"接口":<10}{"请求":>8}{"错误率":>8}{"RPS":>8}{"TTFB p50":>10}{"TTFB p99":>10}'
+          f'{"耗时 p50":>10}{"耗时 p99":>10}')
+    for endpoint, s in report['endpoints'].items():
+        print(f'{endpoint:<10}{s["requests"]:>8}{s["error_rate"]:>8.2%}{s["rps"]:>8.1f}'
+              f'{s["ttfb_ms"]["p50"] or 0:>10.1f}{s["ttfb_ms"]["p99"] or 0:>10.1f}'
+              f'{s["duration_ms"]["p50"] or 0:>10.1f}{s["duration_ms"]["p99"] or 0:>10.1f}')
+    chat = report['endpoints'].get('chat')
+    if chat:
+        t = chat['tokens_per_sec']
+        print(f'\ntokens/sec: 总计 {t["aggregate"]}, 单流 p50 {t["per_stream_p50"]}, p5 {t["per_stream_p5"]}')
+    if report.get('server'):
+        s = report['server']
+        print(f'服务进程: CPU 平均 {s["cpu_percent_avg"]}% / 峰值 {s["cpu_percent_max"]}%, '
+              f'RSS 峰值 {s["rss_mb_max"]} MB' + (f', PSS 峰值 {s["pss_mb_max"]} MB' if 'pss_mb_max' in s else ''))
+    if report.get('mock'):
+        print(f'模拟 LLM: {report["mock"]}')
+
+
+def parse_mix(items) -> dict:
+    mix = {}
+    for item in items:
+        name, _, weight = item.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'未知接口: {name}（可选 {", ".join(ENDPOINTS)}）')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端压测（本地模拟 LLM）')
+    parser.add_argument('--server', default='server_v2.py', choices=['server_v2.py', 'server.py', 'serve.py'],
+                        help='被测服务')
+    parser.add_argument('--url', help='压测已运行的服务（不启动服务和模拟 LLM）')
+    parser.add_argument('--server-pid', type=int, help='配合 --url 采样该进程的 CPU / RSS')
+    parser.add_argument('--server-log', help='把被测服务的输出写入文件')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--concurrency', type=int, default=8, help='并发用户数')
+    parser.add_argument('--duration', type=float, default=20.0, help='压测时长（秒）')
+    parser.add_argument('--think-time', type=float, default=0.0, help='用户两次请求之间的平均间隔（秒）')
+    parser.add_argument('--mix', nargs='+', default=['chat=1', 'memories=3', 'live=2'],
+                        help='接口权重，例如 chat=1 memories=3 live=2')
+    parser.add_argument('--personas', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--timeout', type=float, default=60.0, help='单个请求超时（秒）')
+    parser.add_argument('--embedding', default='', help='被测服务的向量后端（EMBEDDING_BACKEND）')
+    # 模拟 LLM 参数
+    parser.add_argument('--ttft', type=float, default=0.2, help='模拟 LLM 的首 token 延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='模拟 LLM 每秒 token 数')
+    parser.add_argument('--tokens', type=int, default=60, help='模拟 LLM 每个回复的 token 数')
+    parser.add_argument('--jitter', type=float, default=0.2, help='TTFT 随机抖动比例')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟 LLM 返回 500 的比例')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='模拟 LLM 流中途断开的比例')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+    args.mix = parse_mix(args.mix)
+
+    mock = None
+    process = None
+    workdir = tempfile.TemporaryDirectory()
+    try:
+        if args.url:
+            url, pid = args.url.rstrip('/'), args.server_pid
+        else:
+            mock = MockLLMServer(config=MockLLMConfig(
+                args.ttft, args.token_rate, args.tokens, args.jitter,
+                args.error_rate, args.disconnect_rate, args.seed,
+            )).start()
+            process, url = start_server(args, mock, workdir.name)
+            pid = process.pid
+            print(f'模拟 LLM: {mock.base_url}，被测服务: {args.server} @ {url}')
+
+        sampler = ProcessSampler(pid) if pid else None
+        if sampler:
+            sampler.start()
+
+        print(f'压测 {args.duration:.0f} 秒，{args.concurrency} 个并发用户，权重 {args.mix}')
+        results = []
+        started = time.monotonic()
+        deadline = started + args.duration
+        users = [threading.Thread(target=user_loop, args=(i, args, url, deadline, results), daemon=True)
+                 for i in range(args.concurrency)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join(timeout=args.duration + args.timeout + 5)
+        elapsed = time.monotonic() - started
+
+        report = {
+            'params': {k: v for k, v in vars(args).items()},
+            'elapsed_seconds': round(elapsed, 2),
+            'endpoints': summarize(results, elapsed),
+            'server': sampler.stop() if sampler else {},
+            'mock': mock.snapshot() if mock else {},
+        }
+        print_report(report)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f'\n结果已写入 {args.json}')
+        return report
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if mock is not None:
+            mock.stop()
+        workdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
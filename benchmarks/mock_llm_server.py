@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+本地模拟的 OpenAI 兼容 LLM 服务（用于压测，不消耗真实 API 额度）
+
+POST .../chat/completions:
+    stream=true  按配置的首 token 延迟（TTFT）和 token 速率返回 SSE 流
+    stream=false 等待整段生成时间后返回 JSON
+支持故障注入：按比例返回 HTTP 500，或在流中途断开连接。
+GET /stats 返回已处理的请求统计。
+
+用法:
+    python benchmarks/mock_llm_server.py --port 8901 --ttft 0.3 --token-rate 50 --tokens 80 --error-rate 0.02
+    LONGCAT_API_BASE_URL=http://127.0.0.1:8901 LONGCAT_API_KEY=mock python server_v2.py
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 每个 token 是一个汉字（客户端按字数即可得到 token 数）
+TOKEN_TEXT = '今天天气很好我们一起去公园散步吧顺便聊聊最近读过的书和看过的电影'
+
+
+class MockLLMConfig:
+    """模拟服务的行为参数（运行中可修改）"""
+
+    def __init__(self, ttft: float = 0.2, token_rate: float = 50.0, tokens: int = 60,
+                 jitter: float = 0.0, error_rate: float = 0.0, disconnect_rate: float = 0.0, seed: int = None):
+        self.ttft = ttft                        # 首 token 延迟（秒）
+        self.token_rate = token_rate            # 每秒 token 数
+        self.tokens = tokens                    # 每个回复的 token 数
+        self.jitter = jitter                    # TTFT 随机抖动比例（0.2 表示 ±20%）
+        self.error_rate = error_rate            # 返回 HTTP 500 的比例
+        self.disconnect_rate = disconnect_rate  # 流中途断开的比例
+        self.random = random.Random(seed)
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持 keep-alive（流式响应使用 chunked 编码）
+    server: 'MockLLMServer'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.server.snapshot())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            body = {}
+
+        if not self.path.rstrip('/').endswith('chat/completions'):
+            self._send_json(404, {'error': 'not found'})
+            return
+
+        config = self.server.config
+        self.server.count('requests')
+        if config.random.random() < config.error_rate:
+            self.server.count('errors')
+            self._send_json(500, {'error': {'message': 'injected failure', 'type': 'server_error'}})
+            return
+
+        ttft = config.ttft * (1 + config.jitter * (2 * config.random.random() - 1))
+        interval = 1.0 / config.token_rate if config.token_rate > 0 else 0
+        tokens = [TOKEN_TEXT[i % len(TOKEN_TEXT)] for i in range(config.tokens)]
+        model = body.get('model', 'mock-model')
+
+        if not body.get('stream'):
+            time.sleep(ttft + interval * len(tokens))
+            self.server.count('completions')
+            self._send_json(200, {
+                'id': 'mock', 'object': 'chat.completion', 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                             'finish_reason': 'stop'}],
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        disconnect_at = config.random.randrange(len(tokens)) \
+            if tokens and config.random.random() < config.disconnect_rate else None
+        try:
+            time.sleep(ttft)
+            for i, token in enumerate(tokens):
+                if i == disconnect_at:
+                    self.server.count('disconnects')
+                    self.close_connection = True
+                    return  # 不发送结束块，客户端看到连接中断
+                chunk = {'id': 'mock', 'object': 'chat.completion.chunk', 'model': model,
+                         'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]}
+                self._write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                if interval:
+                    time.sleep(interval)
+            self._write_chunk(b'data: [DONE]\n\n')
+            self._write_chunk(b'')
+            self.server.count('streams')
+            self.server.count('tokens', len(tokens))
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.count('client_aborts')
+            self.close_connection = True
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """多线程的模拟 LLM 服务"""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, config: MockLLMConfig = None):
+        super().__init__((host, port), MockLLMHandler)
+        self.config = config or MockLLMConfig()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, key: str, value: int = 1):
+        with self._lock:
+            self._stats[key] = self._stats.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def handle_error(self, request, client_address):
+        # 客户端提前断开（压测结束、请求超时）是正常情况，不打印堆栈
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self) -> 'MockLLMServer':
+        """在后台线程中运行"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的 OpenAI 兼容 LLM 服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--ttft', type=float, default=0.2, help='首 token 延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='每秒 token 数')
+    parser.add_argument('--tokens', type=int, default=60, help='每个回复的 token 数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='TTFT 随机抖动比例')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 HTTP 500 的比例')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='流中途断开的比例')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    config = MockLLMConfig(args.ttft, args.token_rate, args.tokens, args.jitter,
+                           args.error_rate, args.disconnect_rate, args.seed)
+    server = MockLLMServer(args.host, args.port, config)
+    print(f'模拟 LLM 服务运行在 {server.base_url}（Ctrl+C 退出）')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
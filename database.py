@@ -4,34 +4,57 @@
 """
 SQLite 数据库管理模块
 用于持久化存储 Personas、聊天记录和记忆数据
+数据量很大时可按 Persona 分片到多个 SQLite 文件（MEMORY_DB_SHARDS，见 ShardedDatabase）
 """
 
+import os
 import sqlite3
 import json
 import logging
 from datetime import datetime
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 from pathlib import Path
+from src.utils.metrics import Histogram, instrument_methods
+from src.utils.query_stats import QueryStats, TimedConnection
 
 logger = logging.getLogger(__name__)
 
-# 数据库文件路径
-DB_PATH = Path(__file__).parent / 'memory_data.db'
+# 数据库文件路径（MEMORY_DB_PATH 可指定其他文件，例如压测时使用临时数据库）
+DB_PATH = Path(os.getenv('MEMORY_DB_PATH') or Path(__file__).parent / 'memory_data.db')
 
+# 记忆查询返回的列（向量 BLOB 单独读取，不随记忆列表返回/导出）
+MEMORY_COLUMNS = 'id, persona_id, content, vector, weight, is_public, created_at, updated_at'
 
+
+# 语句统计与慢查询日志（DB_QUERY_STATS=1 开启，DB_SLOW_QUERY_MS 为慢查询阈值）
+# 每条语句经过 Python 包装，有额外开销，默认关闭，排查数据库耗时时再开启
+QUERY_STATS_ENABLED = os.getenv('DB_QUERY_STATS', '0').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 100))
+
+# 每个公开方法的耗时（/metrics）
+DB_METHOD_SECONDS = Histogram('sqlite_method_seconds', 'Database 方法耗时（秒）', ['method'])
+
+
+@instrument_methods(DB_METHOD_SECONDS, exclude=('get_connection', 'init_database', 'close', 'change_logs',
+                                                   'get_query_stats', 'reset_query_stats'))
 class Database:
     """数据库管理类"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, query_stats: QueryStats = None):
         """初始化数据库连接"""
         self.db_path = db_path or str(DB_PATH)
         self.conn = None
+        self.query_stats = query_stats or (QueryStats(SLOW_QUERY_MS) if QUERY_STATS_ENABLED else None)
         self.init_database()
     
     def get_connection(self):
         """获取数据库连接"""
         if self.conn is None:
-            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            if self.query_stats is not None:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=TimedConnection)
+                self.conn.query_stats = self.query_stats
+            else:
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
             self.conn.row_factory = sqlite3.Row  # 使用字典式访问
         return self.conn
     
@@ -79,6 +102,54 @@ class Database:
             )
         ''')
         
+        # 迁移：记忆表增加向量列（float32 BLOB 及生成它的模型）
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(memories)')}
+        if 'embedding' not in columns:
+            cursor.execute('ALTER TABLE memories ADD COLUMN embedding BLOB')
+        if 'embedding_model' not in columns:
+            cursor.execute('ALTER TABLE memories ADD COLUMN embedding_model TEXT')
+        
+        # 创建对话滚动摘要表（last_message_id 之前的聊天记录已并入摘要）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                persona_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (persona_id) REFERENCES personas(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # 创建记忆变更日志表：由触发器写入，多个 worker 按 seq 增量同步各自的记忆缓存
+        # （权重只在各进程内近似维护，不记录权重变化）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS memory_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                memory_id INTEGER NOT NULL,
+                persona_id INTEGER,
+                op TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS memories_after_insert AFTER INSERT ON memories
+            BEGIN
+                INSERT INTO memory_changes (memory_id, persona_id, op) VALUES (NEW.id, NEW.persona_id, 'insert');
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS memories_after_update AFTER UPDATE OF content, is_public, persona_id ON memories
+            BEGIN
+                INSERT INTO memory_changes (memory_id, persona_id, op) VALUES (NEW.id, NEW.persona_id, 'update');
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS memories_after_delete AFTER DELETE ON memories
+            BEGIN
+                INSERT INTO memory_changes (memory_id, persona_id, op) VALUES (OLD.id, OLD.persona_id, 'delete');
+            END
+        ''')
+        
         # 创建索引
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_persona ON chat_sessions(persona_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_memory_persona ON memories(persona_id)')
@@ -171,11 +242,64 @@ class Database:
         conn.commit()
         return cursor.lastrowid
     
+    def add_chat_messages(self, messages: List[Tuple[int, str, str, Optional[str]]]) -> List[int]:
+        """
+        批量添加聊天消息（一次事务提交）
+        
+        Args:
+            messages: [(persona_id, role, content, model), ...]
+        
+        Returns:
+            新消息的 ID 列表（与输入顺序一致）
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        message_ids = []
+        with conn:
+            for message in messages:
+                cursor.execute(
+                    'INSERT INTO chat_sessions (persona_id, role, content, model) VALUES (?, ?, ?, ?)',
+                    tuple(message)
+                )
+                message_ids.append(cursor.lastrowid)
+        return message_ids
+    
+    def get_chat_messages_after(self, persona_id: int, after_id: int = 0, limit: int = None) -> List[Dict]:
+        """获取 ID 大于 after_id 的聊天消息（按时间正序，指定 limit 时返回最近的 limit 条）"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT * FROM chat_sessions WHERE persona_id = ? AND id > ? ORDER BY id DESC LIMIT ?',
+            (persona_id, after_id, limit if limit is not None else -1)
+        )
+        rows = cursor.fetchall()
+        return [dict(row) for row in reversed(rows)]
+    
     def clear_chat_history(self, persona_id: int):
-        """清空聊天历史"""
+        """清空聊天历史（同时清除对话摘要）"""
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('DELETE FROM chat_sessions WHERE persona_id = ?', (persona_id,))
+        cursor.execute('DELETE FROM conversation_summaries WHERE persona_id = ?', (persona_id,))
+        conn.commit()
+    
+    def get_conversation_summary(self, persona_id: int) -> Optional[Dict]:
+        """获取对话滚动摘要"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM conversation_summaries WHERE persona_id = ?', (persona_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+    
+    def save_conversation_summary(self, persona_id: int, summary: str, last_message_id: int):
+        """保存对话滚动摘要"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT OR REPLACE INTO conversation_summaries (persona_id, summary, last_message_id, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+            (persona_id, summary, last_message_id)
+        )
         conn.commit()
     
     # ==================== 记忆操作 ====================
@@ -187,17 +311,17 @@ class Database:
         
         if persona_id is None:
             # 获取所有记忆
-            cursor.execute('SELECT * FROM memories ORDER BY created_at DESC')
+            cursor.execute(f'SELECT {MEMORY_COLUMNS} FROM memories ORDER BY created_at DESC')
         elif include_public:
             # 获取指定 Persona 的记忆 + 公共记忆
             cursor.execute(
-                'SELECT * FROM memories WHERE persona_id = ? OR is_public = 1 ORDER BY created_at DESC',
+                f'SELECT {MEMORY_COLUMNS} FROM memories WHERE persona_id = ? OR is_public = 1 ORDER BY created_at DESC',
                 (persona_id,)
             )
         else:
             # 仅获取指定 Persona 的私有记忆
             cursor.execute(
-                'SELECT * FROM memories WHERE persona_id = ? AND is_public = 0 ORDER BY created_at DESC',
+                f'SELECT {MEMORY_COLUMNS} FROM memories WHERE persona_id = ? AND is_public = 0 ORDER BY created_at DESC',
                 (persona_id,)
             )
         
@@ -208,12 +332,13 @@ class Database:
         """获取单条记忆"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM memories WHERE id = ?', (memory_id,))
+        cursor.execute(f'SELECT {MEMORY_COLUMNS} FROM memories WHERE id = ?', (memory_id,))
         row = cursor.fetchone()
         return dict(row) if row else None
     
     def add_memory(self, persona_id: int, content: str, vector: List[float] = None, 
-                   weight: float = 1.0, is_public: bool = False) -> int:
+                   weight: float = 1.0, is_public: bool = False,
+                   embedding: bytes = None, embedding_model: str = None) -> int:
         """添加新记忆"""
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -221,15 +346,49 @@ class Database:
         vector_json = json.dumps(vector) if vector else None
         
         cursor.execute(
-            'INSERT INTO memories (persona_id, content, vector, weight, is_public) VALUES (?, ?, ?, ?, ?)',
-            (persona_id, content, vector_json, weight, int(is_public))
+            'INSERT INTO memories (persona_id, content, vector, weight, is_public, embedding, embedding_model) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (persona_id, content, vector_json, weight, int(is_public), embedding, embedding_model)
         )
         conn.commit()
         return cursor.lastrowid
     
+    def add_memories(self, memories: List[Dict]) -> List[int]:
+        """
+        批量添加记忆（一次事务提交）
+        
+        Args:
+            memories: 记忆列表，每项包含 persona_id、content，
+                      可选 vector、weight、is_public、embedding、embedding_model
+        
+        Returns:
+            新记忆的 ID 列表（与输入顺序一致）
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        memory_ids = []
+        with conn:
+            for memory in memories:
+                vector = memory.get('vector')
+                cursor.execute(
+                    'INSERT INTO memories (persona_id, content, vector, weight, is_public, embedding, embedding_model) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        memory['persona_id'],
+                        memory['content'],
+                        json.dumps(vector) if vector else None,
+                        memory.get('weight', 1.0),
+                        int(memory.get('is_public', False)),
+                        memory.get('embedding'),
+                        memory.get('embedding_model')
+                    )
+                )
+                memory_ids.append(cursor.lastrowid)
+        return memory_ids
+    
     def update_memory(self, memory_id: int, content: str = None, vector: List[float] = None, 
-                      weight: float = None, is_public: bool = None):
-        """更新记忆"""
+                      weight: float = None, is_public: bool = None,
+                      embedding: bytes = None, embedding_model: str = None):
+        """更新记忆（内容变化但未提供新向量时清除旧向量）"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -242,6 +401,11 @@ class Database:
         if vector is not None:
             updates.append('vector = ?')
             params.append(json.dumps(vector))
+        if embedding is not None:
+            updates.append('embedding = ?, embedding_model = ?')
+            params.extend([embedding, embedding_model])
+        elif content is not None:
+            updates.append('embedding = NULL, embedding_model = NULL')
         if weight is not None:
             updates.append('weight = ?')
             params.append(weight)
@@ -258,6 +422,71 @@ class Database:
             )
             conn.commit()
     
+    def get_memories_by_ids(self, memory_ids: List[int]) -> List[Dict]:
+        """按 ID 批量获取记忆（包含向量 BLOB，用于同步其他进程写入的记忆）"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        memory_ids = list(memory_ids)
+        rows = []
+        for start in range(0, len(memory_ids), 500):
+            chunk = memory_ids[start:start + 500]
+            cursor.execute(
+                f'SELECT {MEMORY_COLUMNS}, embedding, embedding_model FROM memories '
+                f'WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk
+            )
+            rows.extend(dict(row) for row in cursor.fetchall())
+        return rows
+    
+    def get_memory_embeddings(self, embedding_model: str) -> Dict[int, bytes]:
+        """获取由指定模型生成的记忆向量 {记忆 ID: float32 BLOB}"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT id, embedding FROM memories WHERE embedding_model = ? AND embedding IS NOT NULL',
+            (embedding_model,)
+        )
+        return {row['id']: row['embedding'] for row in cursor.fetchall()}
+    
+    def get_memory_ids(self) -> set:
+        """获取所有记忆 ID"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM memories')
+        return {row['id'] for row in cursor.fetchall()}
+    
+    def set_memory_embeddings(self, embeddings: List[Tuple[int, bytes]], embedding_model: str):
+        """批量写入记忆向量（一次事务提交）"""
+        conn = self.get_connection()
+        with conn:
+            conn.executemany(
+                'UPDATE memories SET embedding = ?, embedding_model = ? WHERE id = ?',
+                [(blob, embedding_model, memory_id) for memory_id, blob in embeddings]
+            )
+    
+    def set_memory_vectors(self, vectors: List[Tuple[int, Dict]], embeddings: List[Tuple[int, bytes]] = None,
+                           embedding_model: str = None):
+        """批量写入词频向量（提供 embeddings 时同时写入语义向量），一次事务提交"""
+        conn = self.get_connection()
+        with conn:
+            conn.executemany(
+                'UPDATE memories SET vector = ? WHERE id = ?',
+                [(json.dumps(vector) if vector else None, memory_id) for memory_id, vector in vectors]
+            )
+            if embeddings:
+                conn.executemany(
+                    'UPDATE memories SET embedding = ?, embedding_model = ? WHERE id = ?',
+                    [(blob, embedding_model, memory_id) for memory_id, blob in embeddings]
+                )
+
+    def apply_memory_plan(self, delete_ids: List[int], weights: Dict[int, float]):
+        """一次事务中删除记忆并更新权重（记忆合并计划）"""
+        conn = self.get_connection()
+        with conn:
+            conn.executemany('UPDATE memories SET weight = ? WHERE id = ?',
+                             [(weight, memory_id) for memory_id, weight in weights.items()])
+            conn.executemany('DELETE FROM memories WHERE id = ?', [(memory_id,) for memory_id in delete_ids])
+
     def delete_memory(self, memory_id: int):
         """删除记忆"""
         conn = self.get_connection()
@@ -287,6 +516,38 @@ class Database:
         logger.info(f'权重衰减完成，删除了 {deleted} 条低权重记忆')
         return deleted
     
+    # ==================== 记忆变更日志 ====================
+    
+    def get_change_seq_range(self) -> Tuple[int, int]:
+        """变更日志中保留的最小和最大 seq（没有记录时为 0）"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT MIN(seq), MAX(seq) FROM memory_changes')
+        first, last = cursor.fetchone()
+        return first or 0, last or 0
+    
+    def get_memory_changes(self, after_seq: int = 0, limit: int = 1000) -> List[Dict]:
+        """获取 seq 大于 after_seq 的记忆变更（按 seq 升序）"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT seq, memory_id, persona_id, op FROM memory_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+            (after_seq, limit)
+        )
+        return [dict(row) for row in cursor.fetchall()]
+    
+    def prune_memory_changes(self, keep: int) -> int:
+        """只保留最近 keep 条变更记录，返回删除的条数"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM memory_changes WHERE seq <= (SELECT MAX(seq) FROM memory_changes) - ?', (keep,))
+        conn.commit()
+        return cursor.rowcount
+    
+    def change_logs(self) -> Dict[int, 'Database']:
+        """各自独立编号的记忆变更日志 {分片号: 数据库}（未分片时只有一个）"""
+        return {0: self}
+    
     # ==================== 数据导出/导入 ====================
     
     def export_all_data(self) -> Dict[str, Any]:
@@ -328,6 +589,19 @@ class Database:
         conn.commit()
         logger.info('数据导入完成')
     
+    # ==================== 语句统计 ====================
+    
+    def get_query_stats(self, limit: int = None, sort: str = 'total_ms') -> Dict[str, Any]:
+        """获取每种语句的执行次数、延迟分位数和最近的慢查询"""
+        if self.query_stats is None:
+            return {'enabled': False}
+        return {'enabled': True, **self.query_stats.snapshot(limit, sort)}
+    
+    def reset_query_stats(self):
+        """清空语句统计"""
+        if self.query_stats is not None:
+            self.query_stats.reset()
+    
     def close(self):
         """关闭数据库连接"""
         if self.conn:
@@ -335,6 +609,346 @@ class Database:
             self.conn = None
 
 
+# ==================== 按 Persona 分片 ====================
+
+# 分片数（MEMORY_DB_SHARDS > 1 时新数据库按 Persona 分片；已分片的数据库总是按分片打开）
+DB_SHARDS = int(os.getenv('MEMORY_DB_SHARDS', 0))
+
+# 分片中的记忆和聊天消息 ID 从 分片号 << SHARD_ID_BITS 开始编号，由 ID 即可确定所在分片
+# （40 位：每个分片约 1 万亿条；前端 JS 能精确表示的整数支持 8192 个分片）
+SHARD_ID_BITS = 40
+
+
+def shard_of_id(row_id: int) -> int:
+    """记忆 / 聊天消息 ID 所在的分片"""
+    return int(row_id) >> SHARD_ID_BITS
+
+
+def shard_path(db_path: str, index: int) -> str:
+    """分片文件路径：memory_data.db -> memory_data.shard0.db（内存数据库的分片也在内存中）"""
+    if db_path == ':memory:':
+        return db_path
+    path = Path(db_path)
+    return str(path.with_name(f'{path.stem}.shard{index}{path.suffix}'))
+
+
+def create_shard(db_path: str, index: int, query_stats: QueryStats = None) -> Database:
+    """打开（或创建）第 index 个分片，新分片的 ID 从 index << SHARD_ID_BITS 开始"""
+    db = Database(db_path, query_stats)
+    conn = db.get_connection()
+    with conn:
+        for table in ('memories', 'chat_sessions'):
+            conn.execute(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? '
+                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)',
+                (table, index << SHARD_ID_BITS, table)
+            )
+    return db
+
+
+# 路由方法不单独计时（分片上的调用已计入 sqlite_method_seconds）
+class ShardedDatabase(Database):
+    """
+    按 Persona 分片的数据库
+
+    主库（db_path）保存 Personas 和分片表：
+        db_shards       分片号 -> 分片文件（相对主库目录）
+        persona_shards  Persona -> 分片号（创建 Persona 时按 ID 取模分配，之后增加分片不会移动已有的 Persona）
+    聊天记录、对话摘要、记忆和记忆变更日志保存在 Persona 所在的分片中，各分片有独立的写锁，
+    不同 Persona 的写入互不阻塞。
+
+    按 ID 操作记忆时由 ID 的高位确定分片；公共记忆和导出在所有分片上查询后合并。
+    跨分片的批量写入（合并计划等）在每个分片内是一次事务，分片之间不保证原子性。
+    已有数据的单库用 migrate_shards.py 拆分。
+    """
+
+    def __init__(self, db_path: str = None, shards: int = None, query_stats: QueryStats = None):
+        """
+        Args:
+            db_path: 主库文件
+            shards: 分片数（新建时必须大于 0；大于已有分片数时增加分片）
+            query_stats: 语句统计（主库和所有分片共用）
+        """
+        super().__init__(db_path, query_stats)
+        self.shards: Dict[int, Database] = {}
+        self._persona_shards: Dict[int, int] = {}
+
+        conn = self.get_connection()
+        paths = {row['shard']: row['path'] for row in conn.execute('SELECT shard, path FROM db_shards')}
+        if not paths:
+            if not shards:
+                raise ValueError(f'{self.db_path} 不是分片数据库，需要指定分片数')
+            if self._has_unsharded_data():
+                raise RuntimeError(f'{self.db_path} 中已有未分片的数据，请先运行 migrate_shards.py 拆分')
+        with conn:
+            for index in range(len(paths), max(shards or 0, len(paths))):
+                paths[index] = Path(shard_path(self.db_path, index)).name if self.db_path != ':memory:' else ':memory:'
+                conn.execute('INSERT INTO db_shards (shard, path) VALUES (?, ?)', (index, paths[index]))
+
+        base = Path(self.db_path).parent
+        for index, path in sorted(paths.items()):
+            self.shards[index] = create_shard(path if path == ':memory:' else str(base / path), index, self.query_stats)
+        self._persona_shards = {row['persona_id']: row['shard']
+                                for row in conn.execute('SELECT persona_id, shard FROM persona_shards')}
+        logger.info(f'已打开 {len(self.shards)} 个分片: {self.db_path}')
+
+    def init_database(self):
+        """主库在单库结构之外增加分片表"""
+        super().init_database()
+        conn = self.get_connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS db_shards (shard INTEGER PRIMARY KEY, path TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS persona_shards (persona_id INTEGER PRIMARY KEY, shard INTEGER NOT NULL)')
+
+    def _has_unsharded_data(self) -> bool:
+        conn = self.get_connection()
+        return any(conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone()
+                   for table in ('memories', 'chat_sessions'))
+
+    @staticmethod
+    def is_sharded(db_path: str) -> bool:
+        """数据库文件是否已经分片"""
+        if not db_path or db_path == ':memory:' or not os.path.exists(db_path):
+            return False
+        conn = sqlite3.connect(db_path)
+        try:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'db_shards'").fetchone():
+                return False
+            return conn.execute('SELECT 1 FROM db_shards LIMIT 1').fetchone() is not None
+        finally:
+            conn.close()
+
+    # ==================== 路由 ====================
+
+    def shard_index(self, persona_id: Optional[int]) -> int:
+        """Persona 所在的分片号（分片表中没有时按 ID 取模）"""
+        if persona_id is None:
+            return 0
+        persona_id = int(persona_id)    # JSON 客户端传来的 ID 可能是字符串
+        index = self._persona_shards.get(persona_id)
+        if index is None:
+            # 可能是其他进程创建的 Persona
+            row = self.get_connection().execute(
+                'SELECT shard FROM persona_shards WHERE persona_id = ?', (persona_id,)).fetchone()
+            index = row['shard'] if row else persona_id % len(self.shards)
+            self._persona_shards[persona_id] = index
+        return index
+
+    def shard_for(self, persona_id: Optional[int]) -> Database:
+        return self.shards[self.shard_index(persona_id)]
+
+    def shard_for_id(self, row_id: int) -> Database:
+        return self.shards[shard_of_id(row_id)]
+
+    def _group_by_shard(self, items, key) -> Dict[int, list]:
+        groups = {}
+        for item in items:
+            groups.setdefault(shard_of_id(key(item)), []).append(item)
+        return groups
+
+    # ==================== Persona 操作（主库） ====================
+
+    def create_persona(self, name: str, description: str = '') -> int:
+        """创建新 Persona 并分配分片"""
+        conn = self.get_connection()
+        with conn:
+            cursor = conn.execute('INSERT INTO personas (name, description) VALUES (?, ?)', (name, description))
+            persona_id = cursor.lastrowid
+            index = persona_id % len(self.shards)
+            conn.execute('INSERT OR REPLACE INTO persona_shards (persona_id, shard) VALUES (?, ?)', (persona_id, index))
+        self._persona_shards[persona_id] = index
+        return persona_id
+
+    # ==================== 聊天记录操作（Persona 所在分片） ====================
+
+    def get_chat_history(self, persona_id: int, limit: int = 50) -> List[Dict]:
+        return self.shard_for(persona_id).get_chat_history(persona_id, limit)
+
+    def add_chat_message(self, persona_id: int, role: str, content: str, model: str = None) -> int:
+        return self.shard_for(persona_id).add_chat_message(persona_id, role, content, model)
+
+    def add_chat_messages(self, messages: List[Tuple[int, str, str, Optional[str]]]) -> List[int]:
+        """批量添加聊天消息（每个分片一次事务），返回与输入顺序一致的 ID"""
+        groups = {}
+        for position, message in enumerate(messages):
+            groups.setdefault(self.shard_index(message[0]), []).append(position)
+        message_ids = [0] * len(messages)
+        for index, positions in groups.items():
+            ids = self.shards[index].add_chat_messages([messages[p] for p in positions])
+            for position, message_id in zip(positions, ids):
+                message_ids[position] = message_id
+        return message_ids
+
+    def get_chat_messages_after(self, persona_id: int, after_id: int = 0, limit: int = None) -> List[Dict]:
+        return self.shard_for(persona_id).get_chat_messages_after(persona_id, after_id, limit)
+
+    def clear_chat_history(self, persona_id: int):
+        self.shard_for(persona_id).clear_chat_history(persona_id)
+
+    def get_conversation_summary(self, persona_id: int) -> Optional[Dict]:
+        return self.shard_for(persona_id).get_conversation_summary(persona_id)
+
+    def save_conversation_summary(self, persona_id: int, summary: str, last_message_id: int):
+        self.shard_for(persona_id).save_conversation_summary(persona_id, summary, last_message_id)
+
+    # ==================== 记忆操作 ====================
+
+    def get_memories(self, persona_id: int = None, include_public: bool = True) -> List[Dict]:
+        """获取记忆列表（全部记忆和公共记忆在所有分片上查询后按创建时间合并）"""
+        if persona_id is not None and not include_public:
+            return self.shard_for(persona_id).get_memories(persona_id, False)
+        rows = []
+        for shard in self.shards.values():
+            rows.extend(shard.get_memories(persona_id, include_public))
+        rows.sort(key=lambda row: row['created_at'] or '', reverse=True)
+        return rows
+
+    def get_memory(self, memory_id: int) -> Optional[Dict]:
+        return self.shard_for_id(memory_id).get_memory(memory_id)
+
+    def add_memory(self, persona_id: int, content: str, vector: List[float] = None,
+                   weight: float = 1.0, is_public: bool = False,
+                   embedding: bytes = None, embedding_model: str = None) -> int:
+        return self.shard_for(persona_id).add_memory(persona_id, content, vector, weight, is_public,
+                                                      embedding, embedding_model)
+
+    def add_memories(self, memories: List[Dict]) -> List[int]:
+        """批量添加记忆（每个分片一次事务），返回与输入顺序一致的 ID"""
+        groups = {}
+        for position, memory in enumerate(memories):
+            groups.setdefault(self.shard_index(memory['persona_id']), []).append(position)
+        memory_ids = [0] * len(memories)
+        for index, positions in groups.items():
+            ids = self.shards[index].add_memories([memories[p] for p in positions])
+            for position, memory_id in zip(positions, ids):
+                memory_ids[position] = memory_id
+        return memory_ids
+
+    def update_memory(self, memory_id: int, content: str = None, vector: List[float] = None,
+                      weight: float = None, is_public: bool = None,
+                      embedding: bytes = None, embedding_model: str = None):
+        self.shard_for_id(memory_id).update_memory(memory_id, content, vector, weight, is_public,
+                                                   embedding, embedding_model)
+
+    def get_memories_by_ids(self, memory_ids: List[int]) -> List[Dict]:
+        rows = []
+        for index, ids in self._group_by_shard(memory_ids, int).items():
+            rows.extend(self.shards[index].get_memories_by_ids(ids))
+        return rows
+
+    def get_memory_embeddings(self, embedding_model: str) -> Dict[int, bytes]:
+        embeddings = {}
+        for shard in self.shards.values():
+            embeddings.update(shard.get_memory_embeddings(embedding_model))
+        return embeddings
+
+    def get_memory_ids(self) -> set:
+        return set().union(*(shard.get_memory_ids() for shard in self.shards.values()))
+
+    def set_memory_embeddings(self, embeddings: List[Tuple[int, bytes]], embedding_model: str):
+        for index, items in self._group_by_shard(embeddings, lambda item: item[0]).items():
+            self.shards[index].set_memory_embeddings(items, embedding_model)
+
+    def set_memory_vectors(self, vectors: List[Tuple[int, Dict]], embeddings: List[Tuple[int, bytes]] = None,
+                           embedding_model: str = None):
+        vector_groups = self._group_by_shard(vectors, lambda item: item[0])
+        embedding_groups = self._group_by_shard(embeddings or [], lambda item: item[0])
+        for index in vector_groups.keys() | embedding_groups.keys():
+            self.shards[index].set_memory_vectors(vector_groups.get(index, []), embedding_groups.get(index),
+                                                  embedding_model)
+
+    def apply_memory_plan(self, delete_ids: List[int], weights: Dict[int, float]):
+        delete_groups = self._group_by_shard(delete_ids, int)
+        weight_groups = self._group_by_shard(weights.items(), lambda item: item[0])
+        for index in delete_groups.keys() | weight_groups.keys():
+            self.shards[index].apply_memory_plan(delete_groups.get(index, []), dict(weight_groups.get(index, [])))
+
+    def delete_memory(self, memory_id: int):
+        self.shard_for_id(memory_id).delete_memory(memory_id)
+
+    def update_memory_weight(self, memory_id: int, weight: float):
+        self.shard_for_id(memory_id).update_memory_weight(memory_id, weight)
+
+    def apply_weight_decay(self, decay_factor: float = 0.95):
+        return sum(shard.apply_weight_decay(decay_factor) for shard in self.shards.values())
+
+    # ==================== 记忆变更日志（每个分片一份） ====================
+
+    # 合并视图：seq 与记忆 ID 一样编码为 分片号 << SHARD_ID_BITS | 分片内 seq，按分片依次排列，适合一次性读取；
+    # 持续增量同步时前面分片的新变更会排在已读过的位置之前，需用 change_logs() 按分片分别记录游标
+
+    def get_change_seq_range(self) -> Tuple[int, int]:
+        ranges = [(index, *shard.get_change_seq_range()) for index, shard in sorted(self.shards.items())]
+        ranges = [(index, first, last) for index, first, last in ranges if last]
+        if not ranges:
+            return 0, 0
+        return ranges[0][0] << SHARD_ID_BITS | ranges[0][1], ranges[-1][0] << SHARD_ID_BITS | ranges[-1][2]
+
+    def get_memory_changes(self, after_seq: int = 0, limit: int = 1000) -> List[Dict]:
+        after_shard = shard_of_id(after_seq)
+        changes = []
+        for index, shard in sorted(self.shards.items()):
+            if index < after_shard or len(changes) >= limit:
+                continue
+            after = int(after_seq) & ((1 << SHARD_ID_BITS) - 1) if index == after_shard else 0
+            for change in shard.get_memory_changes(after, limit - len(changes)):
+                change['seq'] |= index << SHARD_ID_BITS
+                changes.append(change)
+        return changes
+
+    def prune_memory_changes(self, keep: int) -> int:
+        return sum(shard.prune_memory_changes(keep) for shard in self.shards.values())
+
+    def change_logs(self) -> Dict[int, Database]:
+        return dict(self.shards)
+
+    # ==================== 数据导入 ====================
+
+    def import_data(self, data: Dict[str, Any]):
+        """从 JSON 导入数据（记忆写入 Persona 所在分片；ID 不属于该分片的记忆重新编号）"""
+        personas = data.get('personas', [])
+        if personas:
+            conn = self.get_connection()
+            with conn:
+                for persona in personas:
+                    cursor = conn.execute(
+                        'INSERT OR REPLACE INTO personas (id, name, description) VALUES (?, ?, ?)',
+                        (persona.get('id'), persona.get('name'), persona.get('description', ''))
+                    )
+                    persona_id = cursor.lastrowid
+                    if persona_id not in self._persona_shards:
+                        conn.execute('INSERT OR IGNORE INTO persona_shards (persona_id, shard) VALUES (?, ?)',
+                                     (persona_id, persona_id % len(self.shards)))
+            self._persona_shards = {row['persona_id']: row['shard']
+                                    for row in conn.execute('SELECT persona_id, shard FROM persona_shards')}
+
+        groups = {}
+        for memory in data.get('memories', []):
+            index = self.shard_index(memory.get('persona_id'))
+            if memory.get('id') is not None and shard_of_id(memory['id']) != index:
+                memory = {**memory, 'id': None}
+            groups.setdefault(index, []).append(memory)
+        for index, memories in groups.items():
+            self.shards[index].import_data({'memories': memories})
+
+    def close(self):
+        """关闭主库和所有分片的连接（之后访问时重新连接）"""
+        super().close()
+        for shard in self.shards.values():
+            shard.close()
+
+
+def open_database(db_path: str = None, shards: int = None) -> Database:
+    """
+    打开数据库：已分片的数据库，或 shards（默认 MEMORY_DB_SHARDS）大于 1 时返回 ShardedDatabase
+    """
+    db_path = str(db_path or DB_PATH)
+    shards = DB_SHARDS if shards is None else shards
+    if shards > 1 or ShardedDatabase.is_sharded(db_path):
+        return ShardedDatabase(db_path, shards if shards > 1 else None)
+    return Database(db_path)
+
+
 # 全局数据库实例
 _db_instance = None
 
@@ -342,7 +956,7 @@ def get_db() -> Database:
     """获取全局数据库实例"""
     global _db_instance
     if _db_instance is None:
-        _db_instance = Database()
+        _db_instance = open_database()
     return _db_instance
 
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+LLM 提供商客户端
+所有上游调用统一经过 api_config.APIConfig：构建请求体和请求头、
+复用每个提供商的连接池与超时配置、按提供商格式解析流式/非流式响应。
+
+聊天和摘要可以路由到不同的提供商，例如：
+    CHAT_PROVIDER=longcat     CHAT_MODEL=LongCat-Flash-Chat
+    SUMMARY_PROVIDER=ollama   SUMMARY_MODEL=mistral
+"""
+
+import os
+import json
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+import requests
+from api_config import APIConfig
+from src.utils.sse_parser import StreamRelay, SSEParser, NDJSONParser, json_loads, sniff_stream_format
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """上游 LLM 调用失败（status_code 为上游的 HTTP 状态码，连接失败或超时时为 None）"""
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LLMClient:
+    """单个提供商的 LLM 客户端"""
+
+    _role_clients: Dict[str, 'LLMClient'] = {}
+    _role_lock = threading.Lock()
+
+    def __init__(self, provider: str = 'longcat', default_model: str = None):
+        """
+        初始化客户端
+
+        Args:
+            provider: 提供商 ID（见 APIConfig.PROVIDERS）
+            default_model: 默认模型，未指定时使用该提供商的第一个模型
+        """
+        self.config = APIConfig(provider)
+        self.provider = self.config.provider
+        self.default_model = default_model or (self.config.models[0] if self.config.models else None)
+
+    @classmethod
+    def for_role(cls, role: str) -> 'LLMClient':
+        """
+        获取某个用途（chat / summary）的共享客户端
+
+        提供商和模型由环境变量 <ROLE>_PROVIDER / <ROLE>_MODEL 指定
+        """
+        client = cls._role_clients.get(role)
+        if client is not None:
+            return client
+
+        with cls._role_lock:
+            client = cls._role_clients.get(role)
+            if client is None:
+                prefix = role.upper()
+                client = cls(
+                    provider=os.getenv(f'{prefix}_PROVIDER', 'longcat'),
+                    default_model=os.getenv(f'{prefix}_MODEL') or None,
+                )
+                cls._role_clients[role] = client
+                logger.info(f'LLM 路由: {role} -> {client.config.config["name"]} ({client.default_model})')
+        return client
+
+    @property
+    def models(self) -> List[str]:
+        """该提供商支持的模型（自定义提供商仅包含默认模型）"""
+        return self.config.models or ([self.default_model] if self.default_model else [])
+
+    def build_request(self, model: str, messages: List[Dict], stream: bool = True,
+                      temperature: float = 0.7) -> Tuple[str, Dict[str, str], Dict]:
+        """
+        构建上游请求
+
+        Returns:
+            (URL, 请求头, 请求体)
+        """
+        if not self.config.is_configured():
+            key_env = self.config.config.get('api_key_env')
+            raise LLMError(f'{key_env} 未设置。请在 .env 文件中设置 API 密钥，或设置环境变量 {key_env}。')
+
+        headers = self.config.get_headers()
+        if stream:
+            if self.config.stream_format == 'sse':
+                headers['Accept'] = 'text/event-stream, application/json'
+            else:
+                headers['Accept'] = 'application/x-ndjson, application/json'
+
+        body = self.config.build_request_body(model or self.default_model, messages,
+                                              temperature=temperature, stream=stream)
+        return self.config.get_endpoint('chat'), headers, body
+
+    def request(self, model: str, messages: List[Dict], stream: bool = True,
+                temperature: float = 0.7) -> requests.Response:
+        """发送请求，返回 HTTP 响应（非 200 时抛出 LLMError）"""
+        url, headers, body = self.build_request(model, messages, stream=stream, temperature=temperature)
+
+        try:
+            response = self.config.get_session().post(
+                url,
+                json=body,
+                headers=headers,
+                timeout=self.config.get_timeout(),
+                stream=stream
+            )
+        except requests.Timeout:
+            raise LLMError(f'API调用超时（连接 {self.config.connect_timeout * 1000:.0f}ms / 读取 {self.config.read_timeout * 1000:.0f}ms）')
+        except requests.ConnectionError as err:
+            raise LLMError(f'无法连接到 {self.config.config["name"]}: {err}')
+
+        if response.status_code != 200:
+            raise LLMError(self.describe_error(response.status_code, response.text), response.status_code)
+
+        return response
+
+    def describe_error(self, status_code: int, error_text: str) -> str:
+        """把上游错误响应转换为可读的错误信息"""
+        error_message = f'API调用失败: {status_code}'
+        try:
+            error_data = json.loads(error_text)
+            if 'error' in error_data:
+                error_info = error_data['error']
+                if isinstance(error_info, dict):
+                    error_message += f' - {error_info.get("message", error_info.get("code", "未知错误"))}'
+                else:
+                    error_message += f' - {error_info}'
+            if status_code == 401:
+                error_message += f'\n提示：请检查 {self.config.config.get("api_key_env")} 是否正确设置。'
+        except (ValueError, AttributeError, TypeError):
+            error_message += f' - {error_text}'
+        return error_message
+
+    def complete(self, messages: List[Dict], model: str = None, temperature: float = 0.7) -> str:
+        """非流式调用，返回完整文本"""
+        response = self.request(model, messages, stream=False, temperature=temperature)
+        return self.config.extract_response_content(response.json())
+
+    def parse_content(self, data: bytes) -> Optional[str]:
+        """从一个流式事件的数据中提取增量文本"""
+        try:
+            return self.config.extract_stream_content(json_loads(data)) or None
+        except ValueError:
+            logger.warning(f'JSON 解析失败: {data[:100]!r}')
+            return None
+
+    def create_relay(self, passthrough: bool = False) -> StreamRelay:
+        """
+        创建该提供商格式的流转发器
+
+        NDJSON 格式（Ollama）不是 SSE，不支持原样转发，始终输出纯文本
+        """
+        if self.config.stream_format == 'ndjson':
+            return StreamRelay(passthrough=False, parser=NDJSONParser(), parse_content=self.parse_content)
+        return StreamRelay(passthrough=passthrough, parser=SSEParser(), parse_content=self.parse_content)
+
+    def begin_relay(self, relay: StreamRelay, content_type: str, head: bytes) -> bool:
+        """
+        根据 Content-Type 和首批字节判断上游实际格式，并相应设置转发器
+
+        Returns:
+            是否为完整 JSON（上游忽略了 stream 参数）：读完响应体后交给 relay_json_body 解析
+        """
+        relay.source_format = sniff_stream_format(content_type, head)
+        if relay.source_format == 'ndjson' and not isinstance(relay.parser, NDJSONParser):
+            relay.parser = NDJSONParser()
+            relay.passthrough = False
+        return relay.source_format == 'json'
+
+    def relay_json_body(self, relay: StreamRelay, body: bytes) -> List[bytes]:
+        """从完整的 JSON 响应中解析内容，按转发器的输出格式返回"""
+        try:
+            content = self.config.extract_response_content(json_loads(body))
+        except (ValueError, AttributeError, IndexError) as e:
+            logger.warning(f'非流式 JSON 响应解析失败: {e}, 内容: {body[:100]!r}')
+            content = ''
+        relay.done = True
+        output = []
+        if content:
+            relay.parts.append(content)
+            if relay.passthrough:
+                frame = json.dumps({'choices': [{'delta': {'content': content}}]}, ensure_ascii=False)
+                output.append(f'data: {frame}\n\n'.encode('utf-8'))
+            else:
+                output.append(content.encode('utf-8'))
+        if relay.passthrough:
+            output.append(b'data: [DONE]\n\n')
+        return output
+
+    def relay_response(self, response: requests.Response, relay: StreamRelay) -> Iterator[bytes]:
+        """
+        转发上游流式响应
+
+        先根据 Content-Type 和首批字节判断实际格式（见 begin_relay）：上游忽略 stream 参数、
+        直接返回完整 JSON 时，从同一个响应中解析内容，不再重复请求
+        """
+        chunks = response.iter_content(chunk_size=None)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if head.strip():
+                break
+
+        if self.begin_relay(relay, response.headers.get('Content-Type', ''), head):
+            yield from self.relay_json_body(relay, head + b''.join(chunks))
+            return
+
+        if head:
+            yield from relay.feed(head)
+        if not relay.done:
+            yield from relay.relay(chunks)
+
+    def stream(self, messages: List[Dict], model: str = None, temperature: float = 0.7) -> Iterator[str]:
+        """流式调用，逐段返回文本"""
+        response = self.request(model, messages, stream=True, temperature=temperature)
+        relay = self.create_relay()
+        try:
+            for chunk in self.relay_response(response, relay):
+                yield chunk.decode('utf-8')
+        finally:
+            response.close()
+
+
+if __name__ == '__main__':
+    # 测试 LLM 客户端
+    logging.basicConfig(level=logging.INFO)
+
+    for role in ('chat', 'summary'):
+        client = LLMClient.for_role(role)
+        print(f'{role}: {client.config.config["name"]} / {client.default_model} -> {client.config.get_endpoint()}')
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+把单个 SQLite 数据库按 Persona 拆分为分片数据库（见 database.ShardedDatabase）
+
+    主库保留 Personas，增加分片表；聊天记录、对话摘要和记忆移动到 Persona 所在的分片文件
+    分片中的记忆和聊天消息重新编号（ID 高位是分片号），新旧 ID 对照写入 <数据库>.idmap.json
+    对话摘要的 last_message_id 换算为新的消息 ID
+    原数据库先备份为 <数据库>.bak
+
+迁移需要停止服务后进行。共享向量文件（.vectors）和向量索引（.ann）以记忆 ID 为键，
+下次启动时会按新 ID 自动重建。
+
+用法:
+    python migrate_shards.py --shards 4
+    python migrate_shards.py --db /data/memory_data.db --shards 8 --dry-run
+"""
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import logging
+import argparse
+from bisect import bisect_right
+from pathlib import Path
+
+from database import DB_PATH, Database, ShardedDatabase, create_shard, shard_path
+
+logger = logging.getLogger('migrate_shards')
+
+MEMORY_COPY_COLUMNS = ('persona_id', 'content', 'vector', 'weight', 'is_public',
+                       'created_at', 'updated_at', 'embedding', 'embedding_model')
+
+
+def plan(conn: sqlite3.Connection, shards: int) -> dict:
+    """每个 Persona 分配到的分片，以及各分片的行数"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    persona_ids = {row[0] for row in conn.execute('SELECT id FROM personas')}
+    for table in ('memories', 'chat_sessions', 'conversation_summaries'):
+        if table in tables:
+            persona_ids.update(row[0] for row in conn.execute(f'SELECT DISTINCT persona_id FROM {table}'))
+    assignment = {pid: (pid % shards if pid is not None else 0) for pid in persona_ids}
+
+    counts = {index: {'personas': 0, 'memories': 0, 'chat_sessions': 0} for index in range(shards)}
+    for pid, index in assignment.items():
+        if pid is not None:
+            counts[index]['personas'] += 1
+    for table in ('memories', 'chat_sessions'):
+        if table not in tables:
+            continue
+        for pid, count in conn.execute(f'SELECT persona_id, COUNT(*) FROM {table} GROUP BY persona_id'):
+            counts[assignment[pid]][table] += count
+    return {'assignment': assignment, 'counts': counts}
+
+
+def copy_shard(conn: sqlite3.Connection, shard: sqlite3.Connection, persona_ids: list, id_map: dict):
+    """把一组 Persona 的数据复制到分片（一次事务），记录新旧 ID"""
+    if not persona_ids:
+        return
+    with shard:
+        for pid in persona_ids:
+            where, params = ('persona_id IS NULL', ()) if pid is None else ('persona_id = ?', (pid,))
+
+            old_ids, new_ids = [], []
+            for row in conn.execute(f'SELECT id, persona_id, role, content, model, created_at FROM chat_sessions '
+                                    f'WHERE {where} ORDER BY id', params):
+                cursor = shard.execute(
+                    'INSERT INTO chat_sessions (persona_id, role, content, model, created_at) VALUES (?, ?, ?, ?, ?)',
+                    tuple(row[1:])
+                )
+                old_ids.append(row[0])
+                new_ids.append(cursor.lastrowid)
+            id_map['chat_sessions'].update(zip(old_ids, new_ids))
+
+            if pid is not None:
+                row = conn.execute('SELECT summary, last_message_id, updated_at FROM conversation_summaries '
+                                   'WHERE persona_id = ?', (pid,)).fetchone()
+                if row is not None:
+                    # 摘要覆盖到的最后一条消息 -> 新 ID（消息已被删除时取它之前最近的一条）
+                    position = bisect_right(old_ids, row[1])
+                    last_message_id = new_ids[position - 1] if position else 0
+                    shard.execute(
+                        'INSERT OR REPLACE INTO conversation_summaries (persona_id, summary, last_message_id, updated_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        (pid, row[0], last_message_id, row[2])
+                    )
+
+            columns = ', '.join(MEMORY_COPY_COLUMNS)
+            for row in conn.execute(f'SELECT id, {columns} FROM memories WHERE {where} ORDER BY id', params):
+                cursor = shard.execute(
+                    f'INSERT INTO memories ({columns}) VALUES ({", ".join("?" * len(MEMORY_COPY_COLUMNS))})',
+                    tuple(row[1:])
+                )
+                id_map['memories'][row[0]] = cursor.lastrowid
+
+
+def migrate(db_path: str, shards: int, backup: bool = True) -> dict:
+    """拆分数据库，返回各分片的行数"""
+    if ShardedDatabase.is_sharded(db_path):
+        raise RuntimeError(f'{db_path} 已经分片')
+    if shards < 1:
+        raise ValueError('分片数至少为 1')
+    for index in range(shards):
+        if os.path.exists(shard_path(db_path, index)):
+            raise RuntimeError(f'分片文件已存在: {shard_path(db_path, index)}')
+
+    Database(db_path).close()  # 补齐旧版本数据库缺少的列
+    if backup:
+        shutil.copy2(db_path, db_path + '.bak')
+        logger.info(f'已备份到 {db_path}.bak')
+
+    conn = sqlite3.connect(db_path)
+    try:
+        result = plan(conn, shards)
+        by_shard = {index: [] for index in range(shards)}
+        for pid, index in result['assignment'].items():
+            by_shard[index].append(pid)
+
+        id_map = {'memories': {}, 'chat_sessions': {}}
+        created = []
+        try:
+            for index in range(shards):
+                path = shard_path(db_path, index)
+                shard = create_shard(path, index)
+                created.append(path)
+                copy_shard(conn, shard.get_connection(), sorted(by_shard[index], key=lambda p: (p is None, p)), id_map)
+                shard.close()
+                logger.info(f'分片 {index}: {result["counts"][index]}')
+
+            # 主库：写入分片表并删除已移动的数据（一次事务）
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS db_shards (shard INTEGER PRIMARY KEY, path TEXT NOT NULL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS persona_shards (persona_id INTEGER PRIMARY KEY, shard INTEGER NOT NULL)')
+                conn.executemany('INSERT INTO db_shards (shard, path) VALUES (?, ?)',
+                                 [(index, Path(shard_path(db_path, index)).name) for index in range(shards)])
+                conn.executemany('INSERT INTO persona_shards (persona_id, shard) VALUES (?, ?)',
+                                 [(pid, index) for pid, index in result['assignment'].items() if pid is not None])
+                for table in ('memories', 'chat_sessions', 'conversation_summaries', 'memory_changes'):
+                    conn.execute(f'DELETE FROM {table}')
+        except Exception:
+            # 主库未修改，删除已创建的分片文件
+            for path in created:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+
+    with open(db_path + '.idmap.json', 'w', encoding='utf-8') as f:
+        json.dump({table: {str(old): new for old, new in ids.items()} for table, ids in id_map.items()}, f)
+    logger.info(f'新旧 ID 对照已写入 {db_path}.idmap.json')
+    return result['counts']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把数据库按 Persona 拆分为分片')
+    parser.add_argument('--db', default=str(DB_PATH), help='数据库文件（默认 MEMORY_DB_PATH / memory_data.db）')
+    parser.add_argument('--shards', type=int, required=True, help='分片数')
+    parser.add_argument('--dry-run', action='store_true', help='只显示分配结果，不修改数据库')
+    parser.add_argument('--no-backup', action='store_true', help='不备份原数据库')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+    if not os.path.exists(args.db):
+        logger.error(f'数据库不存在: {args.db}')
+        sys.exit(1)
+
+    if args.dry_run:
+        conn = sqlite3.connect(args.db)
+        try:
+            counts = plan(conn, args.shards)['counts']
+        finally:
+            conn.close()
+        for index, count in counts.items():
+            print(f'分片 {index} ({shard_path(args.db, index)}): {count}')
+        return
+
+    try:
+        counts = migrate(args.db, args.shards, backup=not args.no_backup)
+    except (RuntimeError, ValueError) as e:
+        logger.error(f'❌ {e}')
+        sys.exit(1)
+
+    db = ShardedDatabase(args.db)
+    total = sum(c['memories'] for c in counts.values())
+    migrated = len(db.get_memories())
+    db.close()
+    if migrated != total:
+        logger.error(f'❌ 迁移后的记忆数与原数据库不一致: {migrated} != {total}')
+        sys.exit(1)
+    logger.info(f'✅ 迁移完成: {args.shards} 个分片，{total} 条记忆')
+
+
+if __name__ == '__main__':
+    main()
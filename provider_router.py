@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+延迟感知的提供商路由
+按提供商/模型统计首 token 延迟（TTFT）和错误率，为每个请求选择最快的健康后端；
+可选对冲请求：主请求在 p95 延迟内没有返回首个 token 时向下一个后端再发一次，取先返回者；
+连续失败的后端会被熔断一段时间。
+
+配置示例：
+    ROUTER_BACKENDS=longcat:LongCat-Flash-Chat,openai:gpt-4-turbo
+    ROUTER_HEDGE=1
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+from llm_client import LLMClient, LLMError
+from src.utils.sse_parser import StreamRelay
+
+logger = logging.getLogger(__name__)
+
+# 熔断器状态
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Backend:
+    """一个提供商 + 模型组合，以及它的延迟统计和熔断状态"""
+
+    def __init__(self, client: LLMClient, model: str, window: int = 200,
+                 failure_threshold: int = 3, cooldown: float = 30.0):
+        self.client = client
+        self.model = model
+        self.name = f'{client.provider}:{model}'
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=window)       # 最近的首 token 延迟（秒）
+        self._outcomes = deque(maxlen=window)   # 最近的成功/失败
+        self.ewma_ttft: Optional[float] = None
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def record_success(self, ttft: float):
+        with self._lock:
+            self._ttft.append(ttft)
+            self._outcomes.append(True)
+            self.ewma_ttft = ttft if self.ewma_ttft is None else 0.8 * self.ewma_ttft + 0.2 * ttft
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                logger.info(f'[Router] {self.name} 已恢复，熔断关闭')
+            self.state = CLOSED
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f'[Router] {self.name} 连续失败 {self.consecutive_failures} 次，熔断 {self.cooldown:.0f}s')
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """请求结束但不计入成功或失败（请求本身有误、对冲请求被取消）：释放半开状态的试探名额"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def acquire(self) -> bool:
+        """是否允许向该后端发送请求（熔断打开时拒绝，冷却后只放行一个试探请求）"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def is_available(self) -> bool:
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return not (self.state == HALF_OPEN and self._trial_in_flight)
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+    @property
+    def sample_count(self) -> int:
+        return len(self._ttft)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._ttft)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    def score(self) -> float:
+        """排序分数（越小越好）：EWMA 延迟按错误率放大；没有样本的后端优先试探"""
+        if self.ewma_ttft is None:
+            return 0.0
+        return self.ewma_ttft * (1 + 4 * self.error_rate)
+
+    def get_stats(self) -> Dict:
+        return {
+            'backend': self.name,
+            'state': self.state,
+            'ttft_ewma': self.ewma_ttft,
+            'ttft_p50': self.percentile(0.5),
+            'ttft_p95': self.percentile(0.95),
+            'error_rate': self.error_rate,
+            'samples': len(self._ttft),
+            'consecutive_failures': self.consecutive_failures,
+        }
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """错误是否说明后端不健康（连接失败、超时、5xx），4xx 是请求本身的问题，不计入熔断"""
+    status_code = getattr(error, 'status_code', None)
+    return status_code is None or status_code >= 500
+
+
+class _Race:
+    """
+    一次路由请求中并行的上游尝试
+
+    各尝试登记自己的响应；胜出者确定后（finish）关闭其余响应，正在读取首个 token 的尝试随之结束，
+    已放入队列但未被采用的结果也一并关闭
+    """
+
+    def __init__(self):
+        self.results: queue.Queue = queue.Queue()
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._responses = []
+
+    def register(self, response) -> bool:
+        """登记上游响应（已经结束时直接关闭，返回 False）"""
+        with self._lock:
+            if not self.cancelled:
+                self._responses.append(response)
+                return True
+        response.close()
+        return False
+
+    def put(self, item) -> bool:
+        """提交尝试结果（已经结束时返回 False，由调用方关闭自己的响应）"""
+        with self._lock:
+            if not self.cancelled:
+                self.results.put(item)
+                return True
+        return False
+
+    def finish(self, winner: Optional['RoutedStream'] = None):
+        """结束竞争：关闭除胜出者以外的所有响应"""
+        with self._lock:
+            self.cancelled = True
+            responses, self._responses = self._responses, []
+            while True:
+                try:
+                    _, stream, _ = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                if stream is not None and stream is not winner:
+                    responses.append(stream.response)
+        for response in responses:
+            if winner is None or response is not winner.response:
+                response.close()
+
+
+class RoutedStream:
+    """路由选中的上游流：先输出已读取的首批数据，再继续转发剩余内容"""
+
+    def __init__(self, backend: Backend, response, relay: StreamRelay,
+                 chunks: Iterator[bytes], first_output: List[bytes], started_at: float):
+        self.backend = backend
+        self.response = response
+        self.relay = relay
+        self._chunks = chunks
+        self._first_output = first_output
+        self.started_at = started_at
+
+    @property
+    def text(self) -> str:
+        return self.relay.text
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            yield from self._first_output
+            if not self.relay.done:
+                for chunk in self._chunks:
+                    if chunk:
+                        yield from self.relay.feed(chunk)
+                    if self.relay.done:
+                        break
+                else:
+                    yield from self.relay.flush()
+        except Exception as e:
+            if is_backend_failure(e):
+                self.backend.record_failure()
+            raise
+        finally:
+            self.response.close()
+
+
+class ProviderRouter:
+    """在多个后端之间选择最快的健康后端，可选对冲请求"""
+
+    def __init__(self, backends: List[Backend], hedge: bool = False,
+                 hedge_delay: float = 2.0, hedge_min_delay: float = 0.2):
+        """
+        初始化路由器
+
+        Args:
+            backends: 候选后端
+            hedge: 是否启用对冲请求
+            hedge_delay: 样本不足时的对冲等待时间（秒）
+            hedge_min_delay: 对冲等待时间下限（秒）
+        """
+        if not backends:
+            raise ValueError('至少需要一个后端')
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_min_delay = hedge_min_delay
+        self._stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'failovers': 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional['ProviderRouter']:
+        """根据 ROUTER_BACKENDS 创建路由器，未配置时返回 None"""
+        spec = os.getenv('ROUTER_BACKENDS', '').strip()
+        if not spec:
+            return None
+
+        backends = []
+        for item in spec.split(','):
+            provider, _, model = item.strip().partition(':')
+            client = LLMClient(provider, default_model=model or None)
+            backends.append(Backend(
+                client,
+                model or client.default_model,
+                failure_threshold=int(os.getenv('ROUTER_FAILURE_THRESHOLD', 3)),
+                cooldown=float(os.getenv('ROUTER_COOLDOWN', 30)),
+            ))
+
+        router = cls(
+            backends,
+            hedge=os.getenv('ROUTER_HEDGE', '').lower() in ('1', 'true', 'yes'),
+            hedge_delay=float(os.getenv('ROUTER_HEDGE_DELAY', 2.0)),
+        )
+        logger.info(f'[Router] 后端: {", ".join(b.name for b in backends)}, 对冲: {router.hedge}')
+        return router
+
+    @property
+    def models(self) -> List[str]:
+        return list(dict.fromkeys(b.model for b in self.backends))
+
+    def rank(self, model: str = None) -> List[Backend]:
+        """按健康状态和延迟排序候选后端（指定模型时优先该模型的后端）"""
+        candidates = [b for b in self.backends if b.model == model] or self.backends
+        healthy = [b for b in candidates if b.is_available()]
+        return sorted(healthy, key=lambda b: b.score())
+
+    def _hedge_delay_for(self, backend: Backend) -> float:
+        p95 = backend.percentile(0.95)
+        if p95 is None or backend.sample_count < 10:
+            return self.hedge_delay
+        return max(self.hedge_min_delay, p95)
+
+    def _attempt(self, backend: Backend, messages: List[Dict], passthrough: bool, race: _Race):
+        """在线程中发起请求并读取到首批输出"""
+        started_at = time.monotonic()
+        response = None
+        try:
+            response = backend.client.request(backend.model, messages, stream=True)
+            if not race.register(response):
+                backend.release()
+                return
+            relay = backend.client.create_relay(passthrough=passthrough)
+            chunks = response.iter_content(chunk_size=None)
+            head = b''
+            for chunk in chunks:
+                head += chunk
+                if head.strip() or race.cancelled:
+                    break
+
+            first_output = []
+            if race.cancelled:
+                pass
+            elif backend.client.begin_relay(relay, response.headers.get('Content-Type', ''), head):
+                # 上游忽略 stream 参数返回了完整 JSON
+                first_output = backend.client.relay_json_body(relay, head + b''.join(chunks))
+            else:
+                first_output = relay.feed(head) if head else []
+                if not (first_output or relay.done):
+                    for chunk in chunks:
+                        if chunk:
+                            first_output = relay.feed(chunk)
+                        if first_output or relay.done or race.cancelled:
+                            break
+                    else:
+                        first_output = relay.flush()
+
+            if race.cancelled:
+                # 另一个请求已胜出（连接已被关闭）：读到首个 token 时仍记录延迟
+                if first_output:
+                    backend.record_success(time.monotonic() - started_at)
+                else:
+                    backend.release()
+                response.close()
+                return
+
+            backend.record_success(time.monotonic() - started_at)
+            stream = RoutedStream(backend, response, relay, chunks, first_output, started_at)
+            if not race.put((backend, stream, None)):
+                response.close()
+        except Exception as e:
+            if response is not None:
+                response.close()
+            if race.cancelled:
+                # 胜出者确定后关闭了这个连接，读取因此中断
+                backend.release()
+                return
+            if is_backend_failure(e):
+                backend.record_failure()
+            else:
+                backend.release()
+            race.put((backend, None, e))
+
+    def open_stream(self, messages: List[Dict], model: str = None, passthrough: bool = False) -> RoutedStream:
+        """
+        打开一个流式请求，返回已收到首个 token 的 RoutedStream
+
+        主后端失败时依次切换到下一个后端；启用对冲时主后端超过 p95 延迟仍无输出，
+        会并行请求下一个后端并采用先返回的结果
+        """
+        with self._lock:
+            self._stats['requests'] += 1
+
+        candidates = self.rank(model)
+        race = _Race()
+        hedged = set()
+        in_flight = 0
+        next_index = 0
+        last_error = None
+
+        def launch():
+            """启动下一个可用后端的请求，没有可用后端时返回 None"""
+            nonlocal in_flight, next_index
+            while next_index < len(candidates):
+                backend = candidates[next_index]
+                next_index += 1
+                if backend.acquire():
+                    break
+            else:
+                return None
+            in_flight += 1
+            threading.Thread(
+                target=self._attempt,
+                args=(backend, messages, passthrough, race),
+                name=f'router-{backend.name}',
+                daemon=True
+            ).start()
+            return backend
+
+        primary = launch()
+        if primary is None:
+            raise LLMError('所有 LLM 后端均不可用（已熔断）')
+
+        winner = None
+        try:
+            while in_flight:
+                can_hedge = self.hedge and next_index < len(candidates) and in_flight == 1
+                timeout = self._hedge_delay_for(primary) if can_hedge else None
+                try:
+                    backend, stream, error = race.results.get(timeout=timeout)
+                except queue.Empty:
+                    # 主请求超过对冲延迟仍未返回首个 token
+                    hedge_backend = launch()
+                    if hedge_backend is not None:
+                        hedged.add(hedge_backend)
+                        with self._lock:
+                            self._stats['hedged'] += 1
+                        logger.info(f'[Router] {primary.name} 超过 {timeout * 1000:.0f}ms 未返回，对冲请求 {hedge_backend.name}')
+                    continue
+
+                in_flight -= 1
+                if stream is not None:
+                    winner = stream
+                    if backend in hedged:
+                        with self._lock:
+                            self._stats['hedge_wins'] += 1
+                    return stream
+
+                last_error = error
+                logger.warning(f'[Router] {backend.name} 请求失败: {error}')
+                if in_flight == 0 and launch() is not None:
+                    with self._lock:
+                        self._stats['failovers'] += 1
+
+            raise last_error or LLMError('所有 LLM 后端请求失败')
+        finally:
+            # 关闭落败的请求（包括同时返回、还在队列中的结果）
+            race.finish(winner)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['hedge'] = self.hedge
+        stats['backends'] = [b.get_stats() for b in self.backends]
+        return stats
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+生产环境启动脚本（prefork 多进程）
+
+主进程创建应用并预加载数据库、记忆缓存和向量索引，然后 gc.freeze() 并 fork 出 N 个 worker：
+    worker 以写时复制的方式共享主进程加载的记忆缓存和索引，内存占用不随 worker 数线性增长
+    gc.freeze() 把已有对象移出分代回收，避免 worker 中的垃圾回收遍历它们导致共享页被复制
+    SQLite 连接在 fork 前关闭，每个 worker 第一次访问数据库时各自重新连接
+    各 worker 写入的记忆通过 memory_changes 变更日志同步（见 MemoryManager.sync_changes）
+    记忆衰减线程只在 worker 0 中运行
+
+主进程只负责监督：worker 异常退出时重新 fork，收到 SIGTERM / SIGINT 时通知所有 worker 退出。
+/metrics、/traces、/db-stats 是各 worker 进程内的数据。
+
+用法:
+    python serve.py                       # worker 数 = WEB_CONCURRENCY 或 CPU 核数
+    python serve.py --workers 4 --port 3001
+
+Windows 没有 fork，退回单进程运行。
+"""
+
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+
+logger = logging.getLogger('serve')
+
+# worker 启动后很快退出时，延迟重新 fork，避免配置错误时不停重启
+MIN_WORKER_LIFETIME = 5.0
+RESPAWN_DELAY = 1.0
+
+
+def create_listener(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """在主进程中创建监听 socket，由所有 worker 共享 accept"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock: socket.socket, host: str, port: int, index: int):
+    """worker 进程主循环（不返回）"""
+    from werkzeug.serving import make_server
+
+    state = app.extensions['server_v2']
+    exit_code = 0
+    try:
+        # Ctrl+C 会发给整个进程组，由主进程统一处理
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        state.after_fork()
+        if index == 0:
+            state.start_background()
+
+        server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+        logger.info(f'worker {index} (pid {os.getpid()}) 已启动')
+        server.serve_forever()
+    except SystemExit:
+        pass
+    except Exception as e:
+        logger.exception(f'worker {index} 异常退出: {e}')
+        exit_code = 1
+    finally:
+        try:
+            state.shutdown()
+        except Exception as e:
+            logger.error(f'worker {index} 关闭失败: {e}')
+        logging.shutdown()
+    # 不执行主进程注册的 atexit 等清理逻辑
+    os._exit(exit_code)
+
+
+class Master:
+    """prefork 主进程：fork worker 并在其退出时补充"""
+
+    def __init__(self, app, sock: socket.socket, host: str, port: int, workers: int, graceful_timeout: float = 10.0):
+        self.app = app
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}   # pid -> (index, 启动时间)
+        self.stopping = False
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.app, self.sock, self.host, self.port, index)
+        self.workers[pid] = (index, time.monotonic())
+
+    def _handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for index in range(self.num_workers):
+            self.spawn(index)
+
+        while not self.stopping:
+            time.sleep(0.5)
+            for pid, status in self._reap():
+                index, started = self.workers.pop(pid)
+                if self.stopping:
+                    break
+                logger.warning(f'worker {index} (pid {pid}) 已退出 (status={status})，重新启动')
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(RESPAWN_DELAY)
+                self.spawn(index)
+
+        self.stop()
+
+    def _reap(self):
+        reaped = []
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.workers:
+                reaped.append((pid, os.waitstatus_to_exitcode(status)))
+        return reaped
+
+    def stop(self):
+        """通知所有 worker 退出，超时后强制结束"""
+        logger.info('⏹️  停止所有 worker...')
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            for pid, _ in self._reap():
+                self.workers.pop(pid, None)
+            time.sleep(0.1)
+        for pid in self.workers:
+            logger.warning(f'worker pid {pid} 未按时退出，强制结束')
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='prefork 生产环境启动脚本')
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 3001)))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', 0)) or os.cpu_count() or 1,
+                        help='worker 进程数（默认 WEB_CONCURRENCY 或 CPU 核数）')
+    parser.add_argument('--graceful-timeout', type=float, default=10.0, help='停止时等待 worker 退出的秒数')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+
+    from server_v2 import create_app
+    app = create_app({'PRELOAD': True, 'BACKGROUND': False})
+    state = app.extensions['server_v2']
+    if not state.chat_client.config.is_configured():
+        logger.warning(f'⚠️  {state.chat_client.config.config.get("api_key_env")} 未设置，API 调用将失败')
+
+    if not hasattr(os, 'fork'):
+        logger.warning('当前平台不支持 fork，以单进程运行')
+        state.start_background()
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+        return
+
+    sock = create_listener(args.host, args.port)
+    state.before_fork()
+    # 预加载的对象不再参与分代回收，worker 中的 GC 不会写入这些页
+    gc.collect()
+    gc.freeze()
+    logger.info(f'🚀 服务器启动于 http://{args.host}:{args.port}（{args.workers} 个 worker，'
+                f'冻结 {gc.get_freeze_count()} 个对象）')
+
+    Master(app, sock, args.host, args.port, args.workers, args.graceful_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
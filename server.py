@@ -2,16 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
-import requests
 import logging
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock
 import time
 from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
 from src.utils.memory_manager import MemoryManager
+from src.utils.summary_pipeline import SummaryPipeline
+from src.utils.prompt_builder import PromptBuilder
+from src.utils.metrics import REGISTRY, CONTENT_TYPE, CACHE_REQUESTS, Registry, track_stream
+from llm_client import LLMClient
 
 # 加载环境变量
 load_dotenv()
@@ -27,7 +29,7 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*", "supports_credentials": True}})
 
-PORT = 3001
+PORT = int(os.getenv('PORT', 3001))
 
 # 初始化记忆管理器
 memory_manager = MemoryManager()
@@ -43,11 +45,12 @@ def apply_decay_periodically():
 decay_thread = Thread(target=apply_decay_periodically, daemon=True)
 decay_thread.start()
 
-# LongCat API 配置
-LONGCAT_API_BASE = 'https://api.longcat.chat/openai'
-DEFAULT_MODEL = 'LongCat-Flash-Chat'
-THINKING_MODEL = 'LongCat-Flash-Thinking'
-API_TIMEOUT = int(os.getenv('LONGCAT_API_TIMEOUT_MS', 30000)) / 1000
+# LLM 客户端（聊天与摘要可路由到不同提供商，见 llm_client.py）
+chat_client = LLMClient.for_role('chat')
+summary_client = LLMClient.for_role('summary')
+prompt_builder = PromptBuilder()
+DEFAULT_MODEL = chat_client.default_model
+VALID_MODELS = chat_client.models
 
 # 存储数据
 personas = [
@@ -60,6 +63,36 @@ personas = [
 chat_sessions = {}  # 存储每个 persona 的聊天记录
 current_models = {}  # 存储每个 persona 当前使用的模型
 
+# 上游返回空内容时的非流式重试次数（0 表示不重试，只记录）
+EMPTY_STREAM_RETRIES = int(os.getenv('EMPTY_STREAM_RETRIES', 0))
+
+# 上游响应格式与空响应重试统计
+stream_stats = {
+    'responses': 0,
+    'formats': {},          # 上游实际返回的格式: sse / ndjson / json
+    'empty': 0,             # 没有内容的响应
+    'retries': 0,           # 非流式重试次数
+    'retry_success': 0,     # 重试后拿到内容的次数
+    'retry_time_total': 0.0,
+}
+stream_stats_lock = Lock()
+
+
+def record_stream_result(source_format, has_content):
+    with stream_stats_lock:
+        stream_stats['responses'] += 1
+        stream_stats['formats'][source_format] = stream_stats['formats'].get(source_format, 0) + 1
+        if not has_content:
+            stream_stats['empty'] += 1
+
+
+def record_retry_result(success, elapsed):
+    with stream_stats_lock:
+        stream_stats['retries'] += 1
+        stream_stats['retry_time_total'] += elapsed
+        if success:
+            stream_stats['retry_success'] += 1
+
 
 # 获取 Persona 列表
 @app.route('/personas', methods=['GET'])
@@ -77,73 +110,13 @@ def switch_model():
     if not persona or not model:
         return jsonify({'error': '缺少必要参数'}), 400
     
-    valid_models = [DEFAULT_MODEL, THINKING_MODEL]
-    if model not in valid_models:
-        return jsonify({'error': f'无效的模型名称。支持的模型: {", ".join(valid_models)}'}), 400
+    if model not in VALID_MODELS:
+        return jsonify({'error': f'无效的模型名称。支持的模型: {", ".join(VALID_MODELS)}'}), 400
     
     current_models[persona] = model
     return jsonify({'success': True, 'model': model})
 
 
-# 调用 LongCat API
-def call_longcat_api(model, messages, stream=True):
-    api_key = os.getenv('LONGCAT_API_KEY', '')
-    
-    if not api_key:
-        raise Exception('LONGCAT_API_KEY 未设置。请在 .env 文件中设置 API 密钥，或设置环境变量 LONGCAT_API_KEY。')
-    
-    request_body = {
-        'model': model,
-        'messages': messages,
-        'temperature': 0.7,
-    }
-    
-    if stream:
-        request_body['stream'] = True
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}',
-    }
-    
-    if stream:
-        headers['Accept'] = 'text/event-stream, application/json'
-    
-    api_url = f'{LONGCAT_API_BASE}/v1/chat/completions'
-    
-    try:
-        response = requests.post(
-            api_url,
-            json=request_body,
-            headers=headers,
-            timeout=API_TIMEOUT,
-            stream=stream
-        )
-    except requests.Timeout:
-        raise Exception(f'API调用超时（{API_TIMEOUT * 1000:.0f}ms）')
-    except Exception as err:
-        raise err
-    
-    if response.status_code != 200:
-        error_text = response.text
-        error_message = f'API调用失败: {response.status_code}'
-        try:
-            error_data = response.json()
-            if 'error' in error_data:
-                error_info = error_data['error']
-                if isinstance(error_info, dict):
-                    error_message += f' - {error_info.get("message", error_info.get("code", "未知错误"))}'
-                else:
-                    error_message += f' - {error_info}'
-            if response.status_code == 401:
-                error_message += '\n提示：请检查 LONGCAT_API_KEY 是否正确设置。'
-        except:
-            error_message += f' - {error_text}'
-        raise Exception(error_message)
-    
-    return response
-
-
 # 生成记忆摘要
 def generate_memory_summary(persona_id, conversation):
     try:
@@ -162,9 +135,7 @@ def generate_memory_summary(persona_id, conversation):
             {'role': 'user', 'content': summary_prompt},
         ]
         
-        response = call_longcat_api(DEFAULT_MODEL, messages, stream=False)
-        data = response.json()
-        return data.get('choices', [{}])[0].get('message', {}).get('content', '')
+        return summary_client.complete(messages)
     except Exception as error:
         logger.error(f'生成记忆摘要失败: {error}')
         # 如果API调用失败，使用简单的摘要方法
@@ -172,6 +143,37 @@ def generate_memory_summary(persona_id, conversation):
         return ' | '.join([msg['content'] for msg in last_messages])[:200]
 
 
+# 生成并保存记忆摘要（在摘要流水线的工作线程中执行）
+def save_memory_summary(persona, conversation):
+    try:
+        summary = generate_memory_summary(persona, conversation)
+        if summary and summary.strip():
+            is_public = any(keyword in summary for keyword in ['通用', '公共', '一般', '共同'])
+            memory_manager.add_memory(persona, summary.strip(), is_public)
+            logger.info(f'✅ 记忆已保存 (Persona {persona}, {"公共" if is_public else "角色"}): {summary.strip()}')
+    except Exception as e:
+        logger.error(f'❌ 保存记忆失败: {e}')
+
+
+summary_pipeline = SummaryPipeline(save_memory_summary)
+summary_pipeline.start()
+
+
+# 抓取 /metrics 时计算的指标（单独的注册表：导入本模块不会替换其他服务注册到 REGISTRY 的同名指标）
+METRICS = Registry()
+METRICS.gauge_callback(
+    'memory_count', '每个 Persona 的记忆数（persona_id=public 为公共记忆）',
+    lambda: {**{(str(pid),): len(memories) for pid, memories in memory_manager.memories.items()},
+             ('public',): len(memory_manager.public_memories)},
+    ['persona_id']
+)
+METRICS.gauge_callback(
+    'summary_queue_depth', '摘要流水线的队列深度',
+    lambda: {('memory',): summary_pipeline.get_stats()['queue_depth']},
+    ['pipeline']
+)
+
+
 # 聊天接口 - 流式响应
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -193,36 +195,29 @@ def chat():
     
     try:
         # 验证并选择模型
-        valid_models = [DEFAULT_MODEL, THINKING_MODEL]
         selected_model = model or current_models.get(persona, DEFAULT_MODEL)
-        if selected_model not in valid_models:
+        if selected_model not in VALID_MODELS:
             selected_model = DEFAULT_MODEL
         
         persona_obj = next((p for p in personas if p['id'] == persona), None)
         
         # 检索相关记忆
         relevant_memories = memory_manager.retrieve_memories(persona, message, 3)
-        memory_context = ''
-        if relevant_memories:
-            memory_list = '\n'.join([
-                f"- {m['content']} ({'角色记忆' if m.get('type') == 'persona' else '公共记忆'})"
-                for m in relevant_memories
-            ])
-            memory_context = f'相关记忆：\n{memory_list}\n\n'
         
         # 构建消息历史
         if persona not in chat_sessions:
+            CACHE_REQUESTS.labels(cache='chat_session', result='miss').inc()
             chat_sessions[persona] = []
+        else:
+            CACHE_REQUESTS.labels(cache='chat_session', result='hit').inc()
         
-        # 添加系统提示词
-        system_content = f"{persona_obj.get('description', '') if persona_obj else ''}\n\n{memory_context}请根据以上信息和记忆，自然地回应用户。"
-        system_message = {
-            'role': 'system',
-            'content': system_content,
-        }
-        
-        # 构建完整消息列表
-        messages = [system_message] + chat_sessions[persona][-10:] + [{'role': 'user', 'content': message}]
+        # 按 token 预算组装消息：固定前缀（描述 + 指令）在前，本轮记忆在历史之后
+        messages = prompt_builder.build(
+            persona_obj.get('description', '') if persona_obj else '',
+            message,
+            history=chat_sessions[persona],
+            memories=relevant_memories,
+        )
         
         # 保存用户消息
         chat_sessions[persona].append({
@@ -231,86 +226,47 @@ def chat():
             'timestamp': datetime.now().isoformat(),
         })
         
-        # 调用 LongCat API
-        logger.info(f'[Chat] 调用 API - Persona: {persona}, Model: {selected_model}')
-        api_response = call_longcat_api(selected_model, messages, stream=True)
+        # 调用 LLM API
+        logger.info(f'[Chat] 调用 API - Persona: {persona}, Provider: {chat_client.provider}, Model: {selected_model}')
+        upstream_started = time.monotonic()
+        api_response = chat_client.request(selected_model, messages, stream=True)
         
         logger.info(f'[Chat] API 响应状态: {api_response.status_code}')
         logger.info(f'[Chat] 响应 Content-Type: {api_response.headers.get("content-type", "")}, Content-Length: {api_response.headers.get("content-length", "unknown")}')
         
         # 生成流式响应
         def generate():
+            relay = chat_client.create_relay()
             full_response = ''
-            buffer = ''
             
             try:
-                for line_bytes in api_response.iter_lines():
-                    if not line_bytes:
-                        continue
-                    
-                    line = line_bytes.decode('utf-8') if isinstance(line_bytes, bytes) else line_bytes
-                    
-                    if not line.strip():
-                        continue
-                    
-                    # 处理 SSE 格式: data: {...}
-                    if line.startswith('data: '):
-                        data_str = line[6:].strip()
-                        if data_str == '[DONE]':
-                            continue
-                        
-                        try:
-                            chunk_data = json.loads(data_str)
-                            content = chunk_data.get('choices', [{}])[0].get('delta', {}).get('content', '') or \
-                                     chunk_data.get('choices', [{}])[0].get('message', {}).get('content', '')
-                            if content:
-                                full_response += content
-                                yield content
-                                if len(full_response) % 50 == 0:
-                                    logger.info(f'[Chat] 已发送 {len(full_response)} 字符')
-                        except json.JSONDecodeError as e:
-                            logger.warning(f'解析 SSE 数据失败: {e}, line: {line}')
-                    else:
-                        # 如果不是 SSE 格式，尝试直接解析 JSON
-                        try:
-                            chunk_data = json.loads(line)
-                            content = chunk_data.get('choices', [{}])[0].get('delta', {}).get('content', '') or \
-                                     chunk_data.get('choices', [{}])[0].get('message', {}).get('content', '')
-                            if content:
-                                full_response += content
-                                yield content
-                        except json.JSONDecodeError:
-                            pass
+                # 按 Content-Type 和首批字节识别 SSE / NDJSON / 普通 JSON，始终只读取这一个响应
+                yield from track_stream(chat_client.relay_response(api_response, relay), chat_client.provider, upstream_started)
+                full_response = relay.text
+                record_stream_result(relay.source_format, bool(full_response.strip()))
                 
-                logger.info(f'[Chat] 流式响应完成，总长度: {len(full_response)} 字符')
-
-                # 如果流式返回为空，尝试非流式回退（某些后端在 stream 模式下可能不会返回 SSE 内容）
-                if not full_response.strip():
-                    logger.warning('[Chat] 警告：流式响应内容为空，尝试非流式回退...')
+                logger.info(f'[Chat] 流式响应完成 ({relay.source_format})，总长度: {len(full_response)} 字符')
+
+                # 上游返回空内容时按 EMPTY_STREAM_RETRIES 决定是否重试（默认不重试）
+                attempt = 0
+                while not full_response.strip() and attempt < EMPTY_STREAM_RETRIES:
+                    attempt += 1
+                    logger.warning(f'[Chat] 警告：响应内容为空，非流式重试 {attempt}/{EMPTY_STREAM_RETRIES}...')
+                    started_at = time.monotonic()
                     try:
-                        nonstream_resp = call_longcat_api(selected_model, messages, stream=False)
-                        try:
-                            data = nonstream_resp.json()
-                        except Exception as e:
-                            logger.error(f'[Chat] 非流式回退解析 JSON 失败: {e}')
-                            data = {}
-
-                        # 尝试兼容不同返回格式（choices[].message.content 或 choices[].text）
-                        content = ''
-                        try:
-                            content = data.get('choices', [{}])[0].get('message', {}).get('content', '') or \
-                                      data.get('choices', [{}])[0].get('text', '')
-                        except Exception:
-                            content = ''
-
-                        if content:
-                            full_response = content
-                            # 立即把回退内容发送给客户端
-                            yield content
-                        else:
-                            logger.warning('[Chat] 非流式回退也未返回内容')
+                        content = chat_client.complete(messages, model=selected_model)
                     except Exception as e:
-                        logger.error(f'[Chat] 非流式回退调用失败: {e}')
+                        logger.error(f'[Chat] 非流式重试调用失败: {e}')
+                        content = ''
+                    record_retry_result(bool(content.strip()), time.monotonic() - started_at)
+                    
+                    if content.strip():
+                        full_response = content
+                        # 立即把重试内容发送给客户端
+                        yield content
+                
+                if not full_response.strip():
+                    logger.warning('[Chat] 上游未返回内容')
                 
                 # 统一保存 AI 响应（无论是流式还是非流式）
                 if full_response.strip():
@@ -324,24 +280,12 @@ def chat():
                 for memory in relevant_memories:
                     memory_manager.update_memory_weight(memory['id'], persona, 0.1)  # 增加增量
                 
-                # 在后台生成记忆摘要（异步）
-                def save_memory_async():
-                    try:
-                        time.sleep(0.5)
-                        session = chat_sessions.get(persona, [])
-                        if len(session) >= 2:
-                            last_two_messages = session[-2:]
-                            if last_two_messages[0]['role'] == 'user' and last_two_messages[1]['role'] == 'assistant':
-                                summary = generate_memory_summary(persona, last_two_messages)
-                                if summary and summary.strip():
-                                    is_public = any(keyword in summary for keyword in ['通用', '公共', '一般', '共同'])
-                                    memory_manager.add_memory(persona, summary.strip(), is_public)
-                                    logger.info(f'✅ 记忆已保存 (Persona {persona}, {"公共" if is_public else "角色"}): {summary.strip()}')
-                    except Exception as e:
-                        logger.error(f'❌ 保存记忆失败: {e}')
-                
-                memory_thread = Thread(target=save_memory_async, daemon=True)
-                memory_thread.start()
+                # 在后台生成记忆摘要（提交到摘要流水线）
+                session = chat_sessions.get(persona, [])
+                if len(session) >= 2:
+                    last_two_messages = session[-2:]
+                    if last_two_messages[0]['role'] == 'user' and last_two_messages[1]['role'] == 'assistant':
+                        summary_pipeline.submit(persona, last_two_messages)
                 
                 # 定期合并相似记忆（每10轮对话）
                 if len(chat_sessions.get(persona, [])) % 10 == 0:
@@ -349,6 +293,8 @@ def chat():
                 
             except Exception as stream_error:
                 logger.error(f'流式读取错误: {stream_error}')
+            finally:
+                api_response.close()
         
         return Response(generate(), mimetype='text/plain; charset=utf-8')
     
@@ -357,6 +303,16 @@ def chat():
         return jsonify({'error': str(error)}), 500
 
 
+# 上游响应统计
+@app.route('/stream-stats', methods=['GET'])
+def get_stream_stats():
+    with stream_stats_lock:
+        stats = dict(stream_stats, formats=dict(stream_stats['formats']))
+    stats['retry_policy'] = {'empty_stream_retries': EMPTY_STREAM_RETRIES}
+    stats['retry_time_avg'] = stats['retry_time_total'] / stats['retries'] if stats['retries'] else 0.0
+    return jsonify(stats)
+
+
 # 获取记忆
 @app.route('/memories/<int:persona_id>', methods=['GET'])
 def get_memories(persona_id):
@@ -407,6 +363,13 @@ def add_memory():
     return jsonify({'success': True, 'memory': memory})
 
 
+# Prometheus 指标
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """输出 Prometheus 文本格式的指标"""
+    return Response(REGISTRY.render() + METRICS.render(), content_type=CONTENT_TYPE)
+
+
 # 导出数据
 @app.route('/export', methods=['GET'])
 def export_data():
@@ -425,10 +388,10 @@ def export_data():
 
 if __name__ == '__main__':
     logger.info(f'服务器运行在 http://localhost:{PORT}')
-    logger.info(f'LongCat API: {LONGCAT_API_BASE}')
+    logger.info(f'LLM API: {chat_client.config.get_endpoint()}')
     
     # 检查 API Key 是否设置
-    if not os.getenv('LONGCAT_API_KEY'):
+    if not chat_client.config.is_configured():
         logger.warning('\n⚠️  警告：LONGCAT_API_KEY 未设置！')
         logger.warning('请创建 .env 文件并添加：')
         logger.warning('LONGCAT_API_KEY=your_api_key_here\n')
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+LongCat Chat Server - 异步版 (aiohttp)
+与 server_v2.py 提供相同的路由，上游流式调用使用异步 HTTP 客户端，
+MemoryManager / Database 操作放到线程池中执行，单进程即可承载大量并发流。
+
+启动: python server_async.py
+"""
+
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiohttp import web
+from dotenv import load_dotenv
+from src.utils.memory_manager_v2 import MemoryManager
+from src.utils.prompt_builder import PromptBuilder
+from src.utils.conversation_summary import ConversationSummarizer, build_summary_messages
+from src.utils.metrics import REGISTRY, CONTENT_TYPE, CACHE_REQUESTS, Registry, StreamTimer
+from src.utils.tracing import RequestTracer
+from llm_client import LLMClient, LLMError
+from database import get_db
+
+# 加载环境变量
+load_dotenv()
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(levelname)s] %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+PORT = int(os.getenv('PORT', 3001))
+
+# LLM 客户端（聊天与摘要可路由到不同提供商，见 llm_client.py）
+chat_client = LLMClient.for_role('chat')
+summary_client = LLMClient.for_role('summary')
+prompt_builder = PromptBuilder()
+DEFAULT_MODEL = chat_client.default_model
+VALID_MODELS = chat_client.models
+
+# 请求追踪（REQUEST_TRACE=1 开启，REQUEST_TRACE_PROFILE_EVERY=N 每 N 个请求剖析一次）
+tracer = RequestTracer()
+
+# 数据库 / 记忆管理器的阻塞操作在此线程池中执行
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 8))
+
+# 存储数据
+chat_sessions = {}  # 存储每个 persona 的聊天记录（内存）
+current_models = {}  # 存储每个 persona 当前使用的模型
+
+
+# ==================== 初始化 ====================
+
+async def on_startup(app):
+    """创建线程池、HTTP 客户端并初始化数据"""
+    app['executor'] = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+    app['db'] = get_db()
+    app['memory_manager'] = await run_blocking(app, MemoryManager, True)
+    app['summarizer'] = ConversationSummarizer(app['db'], generate_conversation_summary)
+
+    # 每个上游主机一个连接池（超时按提供商在请求时设置）
+    app['http'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, limit_per_host=chat_client.config.pool_size * 10),
+    )
+
+    await run_blocking(app, init_default_personas, app['db'])
+    app['decay_task'] = asyncio.create_task(apply_decay_periodically(app))
+    app['background_tasks'] = set()
+
+    # 抓取 /metrics 时计算的指标（每个应用一份，不替换其他应用注册的同名指标）
+    app['metrics'] = Registry()
+    app['metrics'].gauge_callback(
+        'memory_count', '每个 Persona 缓存中的记忆数',
+        lambda: {(str(pid),): len(memories) for pid, memories in app['memory_manager'].memory_cache.items()},
+        ['persona_id']
+    )
+    app['metrics'].gauge_callback(
+        'background_tasks', '正在运行的后台任务数（记忆摘要 / 对话摘要）',
+        lambda: len(app['background_tasks'])
+    )
+
+
+async def on_cleanup(app):
+    """关闭后台任务、HTTP 客户端和线程池"""
+    app['decay_task'].cancel()
+    if app['background_tasks']:
+        await asyncio.gather(*app['background_tasks'], return_exceptions=True)
+    await app['http'].close()
+    app['executor'].shutdown(wait=True)
+    app['metrics'].clear()
+
+
+async def run_blocking(app, func, *args, **kwargs):
+    """在线程池中执行阻塞调用"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app['executor'], partial(func, *args, **kwargs))
+
+
+def init_default_personas(db):
+    """初始化默认 Personas"""
+    existing = db.get_all_personas()
+    if not existing:
+        default_personas = [
+            {'name': '学术助手', 'description': '帮助进行学术研究和写作'},
+            {'name': '创意写作', 'description': '协助创意写作和故事创作'},
+            {'name': '技术支持', 'description': '提供技术问题解答'},
+            {'name': '翻译助手', 'description': '多语言翻译服务'},
+        ]
+        for p in default_personas:
+            db.create_persona(p['name'], p['description'])
+        logger.info('已创建默认 Personas')
+
+
+# 定期应用权重衰减（每小时）
+async def apply_decay_periodically(app):
+    while True:
+        await asyncio.sleep(60 * 60)  # 每小时
+        await run_blocking(app, app['memory_manager'].apply_decay)
+        logger.info('记忆权重衰减已应用')
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """允许跨域访问（与 flask_cors 配置一致）"""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+    return response
+
+
+def json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=partial(json.dumps, ensure_ascii=False))
+
+
+# ==================== 上游 API ====================
+
+async def call_llm_api(app, client, model, messages, stream=True):
+    """异步调用 LLM API，返回 aiohttp 响应（调用方负责释放）"""
+    url, headers, body = client.build_request(model, messages, stream=stream)
+    connect_timeout, read_timeout = client.config.get_timeout()
+
+    try:
+        response = await app['http'].post(
+            url,
+            json=body,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        )
+    except asyncio.TimeoutError:
+        raise LLMError(f'API调用超时（连接 {connect_timeout * 1000:.0f}ms / 读取 {read_timeout * 1000:.0f}ms）')
+    except aiohttp.ClientConnectionError as err:
+        raise LLMError(f'无法连接到 {client.config.config["name"]}: {err}')
+
+    if response.status != 200:
+        error_text = await response.text()
+        response.release()
+        raise LLMError(client.describe_error(response.status, error_text), response.status)
+
+    return response
+
+
+async def generate_memory_summary(app, persona_id, conversation):
+    """生成记忆摘要"""
+    try:
+        conversation_text = '\n'.join([f"{msg['role']}: {msg['content']}" for msg in conversation])
+        summary_prompt = f"""请为以下对话生成一个简洁的记忆摘要（1-2句话），重点关注重要信息和关键点：
+
+对话内容：
+{conversation_text}
+
+记忆摘要："""
+
+        messages = [
+            {'role': 'system', 'content': '你是一个专业的记忆摘要生成助手。请生成简洁、准确的中文摘要。'},
+            {'role': 'user', 'content': summary_prompt},
+        ]
+
+        response = await call_llm_api(app, summary_client, None, messages, stream=False)
+        async with response:
+            data = await response.json(content_type=None)
+        return summary_client.config.extract_response_content(data)
+    except Exception as error:
+        logger.error(f'生成记忆摘要失败: {error}')
+        # 如果API调用失败，使用简单的摘要方法
+        last_messages = conversation[-4:]
+        return ' | '.join([msg['content'] for msg in last_messages])[:200]
+
+
+async def save_memory_summary(app, persona, conversation):
+    """后台生成并保存记忆摘要（不阻塞流式响应结束）"""
+    summary = await generate_memory_summary(app, persona, conversation)
+    if summary:
+        # 判断是否为公共记忆
+        is_public = any(keyword in summary for keyword in ['通用', '公共', '一般', '普遍'])
+        await run_blocking(app, app['memory_manager'].add_memory, persona, summary, is_public=is_public)
+        logger.info(f'记忆已保存: {summary[:50]}...')
+
+
+def generate_conversation_summary(previous_summary, messages):
+    """生成对话滚动摘要（在线程池中执行，见 ConversationSummarizer.update）"""
+    return summary_client.complete(build_summary_messages(previous_summary, messages)).strip()
+
+
+def spawn_background(app, coro):
+    """启动后台任务，并在关闭时等待其完成"""
+    task = asyncio.create_task(coro)
+    app['background_tasks'].add(task)
+    task.add_done_callback(app['background_tasks'].discard)
+    return task
+
+
+# ==================== API 路由 ====================
+
+routes = web.RouteTableDef()
+
+
+# 获取 Persona 列表
+@routes.get('/personas')
+async def get_personas(request):
+    personas = await run_blocking(request.app, request.app['db'].get_all_personas)
+    return json_response(personas)
+
+
+# 创建新 Persona
+@routes.post('/personas')
+async def create_persona(request):
+    data = await request.json()
+    name = data.get('name')
+    description = data.get('description', '')
+
+    if not name:
+        return json_response({'error': '缺少 Persona 名称'}, 400)
+
+    persona_id = await run_blocking(request.app, request.app['db'].create_persona, name, description)
+    return json_response({'id': persona_id, 'name': name, 'description': description})
+
+
+# 切换模型
+@routes.post('/switch-model')
+async def switch_model(request):
+    data = await request.json()
+    persona = data.get('persona')
+    model = data.get('model')
+
+    if not persona or not model:
+        return json_response({'error': '缺少必要参数'}, 400)
+
+    if model not in VALID_MODELS:
+        return json_response({'error': f'无效的模型名称。支持的模型: {", ".join(VALID_MODELS)}'}, 400)
+
+    current_models[persona] = model
+    return json_response({'success': True, 'model': model})
+
+
+# 聊天接口 - 流式响应
+@routes.post('/chat')
+async def chat(request):
+    app = request.app
+    data = await request.json()
+    persona = data.get('persona')
+    message = data.get('message')
+    model = data.get('model')
+
+    if not persona or not message:
+        return json_response({'error': '缺少必要参数'}, 400)
+
+    db = app['db']
+    memory_manager = app['memory_manager']
+    trace = tracer.start('chat')
+
+    try:
+        # 验证并选择模型
+        selected_model = model or current_models.get(persona, DEFAULT_MODEL)
+        if selected_model not in VALID_MODELS:
+            selected_model = DEFAULT_MODEL
+
+        with trace.span('persona_lookup'):
+            persona_obj = await run_blocking(app, db.get_persona, persona)
+
+        # 检索相关记忆
+        with trace.span('retrieve_memories'):
+            relevant_memories = await run_blocking(app, memory_manager.retrieve_memories, persona, message, 3)
+
+        with trace.span('prompt_build'):
+            # 构建消息历史（重启后从数据库恢复尚未并入摘要的消息）
+            summarizer = app['summarizer']
+            if persona not in chat_sessions:
+                CACHE_REQUESTS.labels(cache='chat_session', result='miss').inc()
+                chat_sessions[persona] = await run_blocking(app, summarizer.load_history, persona)
+            else:
+                CACHE_REQUESTS.labels(cache='chat_session', result='hit').inc()
+
+            # 已并入滚动摘要的消息不再保留原文
+            summary, chat_sessions[persona] = summarizer.split_history(persona, chat_sessions[persona])
+
+            # 按 token 预算组装消息：固定前缀（描述 + 指令）在前，本轮记忆在历史之后
+            messages = prompt_builder.build(
+                persona_obj.get('description', '') if persona_obj else '',
+                message,
+                history=chat_sessions[persona],
+                memories=relevant_memories,
+                summary=summary,
+            )
+
+        # 保存到数据库
+        with trace.span('db_write'):
+            message_id = await run_blocking(app, db.add_chat_message, persona, 'user', message, selected_model)
+
+        # 保存用户消息
+        chat_sessions[persona].append({
+            'id': message_id,
+            'role': 'user',
+            'content': message,
+            'timestamp': datetime.now().isoformat(),
+        })
+
+        # 调用 LLM API
+        logger.info(f'[Chat] 调用 API - Persona: {persona}, Provider: {chat_client.provider}, Model: {selected_model}')
+        timer = StreamTimer(chat_client.provider)
+        with trace.span('upstream_connect'):
+            api_response = await call_llm_api(app, chat_client, selected_model, messages, stream=True)
+        logger.info(f'[Chat] API 响应状态: {api_response.status}')
+
+    except Exception as error:
+        logger.error(f'聊天处理失败: {error}')
+        trace.finish()
+        return json_response({'error': str(error)}, 500)
+
+    # 客户端可请求原样转发上游 SSE 帧（stream_format=sse 或 Accept: text/event-stream）
+    passthrough = data.get('stream_format') == 'sse' or \
+        'text/event-stream' in request.headers.get('Accept', '')
+    relay = chat_client.create_relay(passthrough=passthrough)
+
+    # 先读取首批字节判断上游实际格式：忽略 stream 参数的后端会直接返回完整 JSON
+    chunks = api_response.content.iter_any()
+    head = b''
+    try:
+        async for chunk in chunks:
+            head += chunk
+            if head.strip():
+                break
+        is_json = chat_client.begin_relay(relay, api_response.headers.get('Content-Type', ''), head)
+        if is_json:
+            async for chunk in chunks:
+                head += chunk
+    except Exception as error:
+        api_response.release()
+        logger.error(f'聊天处理失败: {error}')
+        trace.finish()
+        return json_response({'error': str(error) or type(error).__name__}, 500)
+
+    # 生成流式响应
+    content_type = 'text/event-stream; charset=utf-8' if relay.passthrough else 'text/plain; charset=utf-8'
+    response = web.StreamResponse(headers={'Content-Type': content_type})
+    if trace.server_timing():
+        response.headers['Server-Timing'] = trace.server_timing()
+    await response.prepare(request)
+
+    try:
+        async with api_response:
+            for output in chat_client.relay_json_body(relay, head) if is_json else relay.feed(head):
+                timer.first_token()
+                trace.mark('first_token')
+                await response.write(output)
+            if not relay.done:
+                async for chunk in chunks:
+                    for output in relay.feed(chunk):
+                        timer.first_token()
+                        trace.mark('first_token')
+                        await response.write(output)
+                    if relay.done:
+                        break
+                else:
+                    for output in relay.flush():
+                        timer.first_token()
+                        trace.mark('first_token')
+                        await response.write(output)
+        timer.finish('ok')
+        trace.mark('stream_end')
+
+        full_text = relay.text
+
+        # 保存到数据库
+        with trace.span('db_write'):
+            message_id = await run_blocking(app, db.add_chat_message, persona, 'assistant', full_text, selected_model)
+
+        # 保存 AI 响应
+        chat_sessions[persona].append({
+            'id': message_id,
+            'role': 'assistant',
+            'content': full_text,
+            'timestamp': datetime.now().isoformat(),
+        })
+
+        with trace.span('summary_enqueue'):
+            # 在后台生成记忆摘要
+            if len(chat_sessions[persona]) >= 2:
+                spawn_background(app, save_memory_summary(app, persona, chat_sessions[persona][-2:]))
+
+            # 未摘要的消息过多时在后台更新对话滚动摘要（同一 Persona 不会并发更新）
+            if summarizer.needs_update(persona, chat_sessions[persona]):
+                spawn_background(app, run_blocking(app, summarizer.update, persona))
+
+    except (ConnectionResetError, asyncio.CancelledError):
+        # 客户端断开连接
+        logger.info(f'[Chat] 客户端已断开 - Persona: {persona}')
+        timer.finish('aborted')
+        raise
+    except Exception as e:
+        logger.error(f'流式响应生成失败: {e}')
+        timer.finish('error')
+        if relay.passthrough:
+            await response.write(f'event: error\ndata: {json.dumps({"error": str(e)}, ensure_ascii=False)}\n\n'.encode('utf-8'))
+        else:
+            await response.write(f'错误: {str(e)}'.encode('utf-8'))
+    finally:
+        trace.finish()
+
+    await response.write_eof()
+    return response
+
+
+# ==================== 记忆管理 API ====================
+
+# 获取记忆列表
+@routes.get('/memories/{persona_id:\\d+}')
+async def get_memories(request):
+    """
+    获取指定 Persona 的所有记忆
+
+    ?since=<游标> 时只返回游标之后的变更（见 MemoryManager.get_memory_delta）：
+    {cursor, reset, upserts, deletes}，没有变化时返回空的 304；since 为空时返回全部记忆和游标
+    """
+    persona_id = int(request.match_info['persona_id'])
+    memory_manager = request.app['memory_manager']
+    since = request.query.get('since')
+    if since is None:
+        memories = await run_blocking(request.app, memory_manager.get_all_memories, persona_id)
+        return json_response(memories)
+
+    delta = await run_blocking(request.app, memory_manager.get_memory_delta, persona_id, since)
+    if delta is None:
+        return web.Response(status=304)
+    return json_response(delta)
+
+
+# 获取实时记忆（支持搜索）
+@routes.get('/memories-live/{persona_id:\\d+}')
+async def get_memories_live(request):
+    """获取实时记忆，支持搜索"""
+    persona_id = int(request.match_info['persona_id'])
+    query = request.query.get('query', '')
+    memory_manager = request.app['memory_manager']
+
+    if query:
+        # 使用语义检索
+        memories = await run_blocking(request.app, memory_manager.retrieve_memories, persona_id, query, limit=20)
+    else:
+        # 获取所有记忆
+        memories = await run_blocking(request.app, memory_manager.get_all_memories, persona_id)
+
+    return json_response(memories)
+
+
+# 添加记忆
+@routes.post('/memories')
+async def add_memory(request):
+    """手动添加记忆"""
+    data = await request.json()
+    persona_id = data.get('personaId')
+    content = data.get('content')
+    is_public = data.get('isPublic', False)
+
+    if not persona_id or not content:
+        return json_response({'error': '缺少必要参数'}, 400)
+
+    memory = await run_blocking(request.app, request.app['memory_manager'].add_memory,
+                                persona_id, content, is_public=is_public)
+    return json_response(memory)
+
+
+# 更新记忆
+@routes.put('/memories/{memory_id:\\d+}')
+async def update_memory(request):
+    """更新记忆内容"""
+    memory_id = int(request.match_info['memory_id'])
+    data = await request.json()
+    content = data.get('content')
+
+    if not content:
+        return json_response({'error': '缺少内容'}, 400)
+
+    success = await run_blocking(request.app, request.app['memory_manager'].update_memory,
+                                 memory_id, content=content)
+
+    if success:
+        return json_response({'success': True})
+    else:
+        return json_response({'error': '更新失败'}, 500)
+
+
+# 删除记忆
+@routes.delete('/memories/{memory_id:\\d+}')
+async def delete_memory(request):
+    """删除记忆"""
+    memory_id = int(request.match_info['memory_id'])
+    success = await run_blocking(request.app, request.app['memory_manager'].delete_memory, memory_id)
+
+    if success:
+        return json_response({'success': True})
+    else:
+        return json_response({'error': '删除失败'}, 500)
+
+
+# 数据库语句统计
+@routes.get('/db-stats')
+async def get_db_stats(request):
+    """获取每种 SQL 语句的次数、延迟分位数和最近的慢查询（?reset=1 读取后清空）"""
+    db = request.app['db']
+    stats = db.get_query_stats(int(request.query.get('limit', 0)) or None, request.query.get('sort', 'total_ms'))
+    if request.query.get('reset'):
+        db.reset_query_stats()
+    return json_response(stats)
+
+
+# 最近的请求追踪
+@routes.get('/traces')
+async def get_traces(request):
+    """获取最近请求的阶段耗时（需设置 REQUEST_TRACE=1）"""
+    limit = int(request.query.get('limit', 0)) or None
+    return json_response({'enabled': tracer.enabled, 'traces': tracer.recent(limit)})
+
+
+# Prometheus 指标
+@routes.get('/metrics')
+async def get_metrics(request):
+    """输出 Prometheus 文本格式的指标"""
+    metrics = REGISTRY.render() + request.app['metrics'].render()
+    return web.Response(body=metrics.encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+# 导出数据
+@routes.get('/export')
+async def export_data(request):
+    """导出所有数据"""
+    data = await run_blocking(request.app, request.app['memory_manager'].export_memories)
+
+    return web.Response(
+        text=json.dumps(data, ensure_ascii=False, indent=2),
+        content_type='application/json',
+        headers={
+            'Content-Disposition': f'attachment; filename=memories-{datetime.now().strftime("%Y%m%d")}.json'
+        }
+    )
+
+
+def create_app() -> web.Application:
+    """创建 aiohttp 应用"""
+    app = web.Application(middlewares=[cors_middleware])
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+# ==================== 启动服务器 ====================
+
+if __name__ == '__main__':
+    logger.info(f'🚀 异步服务器启动于 http://localhost:{PORT}')
+
+    if not chat_client.config.is_configured():
+        logger.warning(f'⚠️  {chat_client.config.config.get("api_key_env")} 未设置，API 调用将失败')
+
+    web.run_app(create_app(), host='0.0.0.0', port=PORT, print=None)
@@ -4,23 +4,33 @@
 """
 LongCat Chat Server v2 - 增强版
 支持数据库持久化、记忆管理、流式输出
+
+create_app(config) 创建应用。数据库、记忆管理器、LLM 客户端和摘要流水线在第一次使用时才初始化，
+导入本模块不会打开数据库或加载记忆缓存；config['PRELOAD']（或 SERVER_PRELOAD=1）时在创建应用时预加载，
+适合多 worker 在 fork 之前加载一次。
+
+启动:
+    python server_v2.py
+    python serve.py --workers 4        # prefork 多进程（见 serve.py）
+    gunicorn 'server_v2:create_app()'
 """
 
 import os
 import json
-import requests
+import time
+import random
 import logging
+import threading
+import functools
 from datetime import datetime
-from threading import Thread
-import time
-from flask import Flask, request, Response, jsonify
-from flask_cors import CORS
-from dotenv import load_dotenv
-from src.utils.memory_manager_v2 import MemoryManager
-from database import get_db
-
-# 加载环境变量
-load_dotenv()
+from flask import Flask, Blueprint, current_app, request, Response, jsonify
+from src.utils.summary_pipeline import SummaryPipeline, DROP_NEWEST
+from src.utils.conversation_summary import ConversationSummarizer, build_summary_messages
+from src.utils.chat_writer import ChatWriter
+from src.utils.prompt_builder import PromptBuilder
+from src.utils.metrics import REGISTRY, CONTENT_TYPE, CACHE_REQUESTS, Registry, track_stream
+from src.utils.tracing import RequestTracer
+from src.utils.maintenance import shutdown_executor
 
 # 配置日志
 logging.basicConfig(
@@ -29,364 +39,564 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 初始化 Flask 应用
-app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": "*", "supports_credentials": True}})
-
-PORT = 3001
-
-# 初始化数据库和记忆管理器
-db = get_db()
-memory_manager = MemoryManager(use_database=True)
-
-# 定期应用权重衰减（每小时）
-def apply_decay_periodically():
-    while True:
-        time.sleep(60 * 60)  # 每小时
-        memory_manager.apply_decay()
-        logger.info('记忆权重衰减已应用')
-
-# 启动衰减线程
-decay_thread = Thread(target=apply_decay_periodically, daemon=True)
-decay_thread.start()
-
-# LongCat API 配置
-LONGCAT_API_BASE = 'https://api.longcat.chat/openai'
-DEFAULT_MODEL = 'LongCat-Flash-Chat'
-THINKING_MODEL = 'LongCat-Flash-Thinking'
-API_TIMEOUT = int(os.getenv('LONGCAT_API_TIMEOUT_MS', 30000)) / 1000
-
-# 存储数据
-chat_sessions = {}  # 存储每个 persona 的聊天记录（内存）
-current_models = {}  # 存储每个 persona 当前使用的模型
-
-# 初始化默认 Personas（如果数据库为空）
-def init_default_personas():
-    """初始化默认 Personas"""
-    existing = db.get_all_personas()
-    if not existing:
-        default_personas = [
-            {'name': '学术助手', 'description': '帮助进行学术研究和写作'},
-            {'name': '创意写作', 'description': '协助创意写作和故事创作'},
-            {'name': '技术支持', 'description': '提供技术问题解答'},
-            {'name': '翻译助手', 'description': '多语言翻译服务'},
-        ]
-        for p in default_personas:
-            db.create_persona(p['name'], p['description'])
-        logger.info('已创建默认 Personas')
-
-init_default_personas()
+# create_app 的默认配置（None 表示读取对应的环境变量）
+DEFAULT_CONFIG = {
+    'DB_PATH': None,              # 数据库文件（默认 MEMORY_DB_PATH / memory_data.db）
+    'PRELOAD': None,              # 创建应用时预加载数据库、记忆缓存和 LLM 客户端（SERVER_PRELOAD）
+    'BACKGROUND': True,           # 创建应用时启动衰减线程（fork 前创建应用时设为 False，fork 后调用 start_background）
+    'DECAY_INTERVAL': 60 * 60,    # 记忆权重衰减间隔（秒）
+    'SUMMARY_BATCH_MODE': None,   # 批量摘要模式（SUMMARY_BATCH_MODE）
+    'CHAT_WRITE_ASYNC': None,     # 聊天消息由后台线程组提交（CHAT_WRITE_ASYNC，默认开启）
+    'LOAD_DOTENV': True,          # 读取 .env
+}
+
+DEFAULT_PERSONAS = [
+    {'name': '学术助手', 'description': '帮助进行学术研究和写作'},
+    {'name': '创意写作', 'description': '协助创意写作和故事创作'},
+    {'name': '技术支持', 'description': '提供技术问题解答'},
+    {'name': '翻译助手', 'description': '多语言翻译服务'},
+]
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, '').lower() in ('1', 'true', 'yes')
+
+
+def lazy(factory):
+    """线程安全的延迟初始化属性：第一次访问时调用 factory 创建"""
+    name = '_' + factory.__name__
+
+    @functools.wraps(factory)
+    def getter(self):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            with self._lock:
+                if name not in self.__dict__:
+                    self.__dict__[name] = factory(self)
+                return self.__dict__[name]
+    return property(getter)
+
+
+class ServerState:
+    """应用状态：数据库、记忆管理器、LLM 客户端等在第一次访问时创建"""
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._lock = threading.RLock()
+        self.chat_sessions = {}   # 存储每个 persona 的聊天记录（内存）
+        self.current_models = {}  # 存储每个 persona 当前使用的模型
+        # 请求追踪（REQUEST_TRACE=1 开启，REQUEST_TRACE_PROFILE_EVERY=N 每 N 个请求剖析一次）
+        self.tracer = RequestTracer()
+        self._decay_thread = None
+        # 引用本实例组件的指标（每个应用一份，同一进程中创建多个应用时互不覆盖；/metrics 与全局 REGISTRY 一起输出）
+        self.metrics = Registry()
+
+    def is_loaded(self, name: str) -> bool:
+        """组件是否已经创建"""
+        return '_' + name in self.__dict__
+
+    @lazy
+    def db(self):
+        from database import open_database, get_db
+        db = open_database(self.config['DB_PATH']) if self.config.get('DB_PATH') else get_db()
+
+        # 初始化默认 Personas（如果数据库为空）
+        if not db.get_all_personas():
+            for p in DEFAULT_PERSONAS:
+                db.create_persona(p['name'], p['description'])
+            logger.info('已创建默认 Personas')
+        return db
+
+    @lazy
+    def memory_manager(self):
+        from src.utils.memory_manager_v2 import MemoryManager
+        return MemoryManager(use_database=True, db=self.db)
+
+    # LLM 客户端（聊天与摘要可路由到不同提供商，见 llm_client.py）
+    @lazy
+    def chat_client(self):
+        from llm_client import LLMClient
+        return LLMClient.for_role('chat')
+
+    @lazy
+    def summary_client(self):
+        from llm_client import LLMClient
+        return LLMClient.for_role('summary')
+
+    # 多后端路由（设置 ROUTER_BACKENDS 后启用，按首 token 延迟选择后端并支持对冲请求）
+    @lazy
+    def router(self):
+        from provider_router import ProviderRouter
+        return ProviderRouter.from_env()
+
+    @lazy
+    def valid_models(self):
+        models = self.chat_client.models
+        if self.router:
+            models = list(dict.fromkeys(models + self.router.models))
+        return models
+
+    @property
+    def default_model(self):
+        return self.chat_client.default_model
+
+    @lazy
+    def prompt_builder(self):
+        return PromptBuilder()
+
+    # 批量摘要模式：按 Persona 累积 SUMMARY_BATCH_SIZE 轮或 SUMMARY_BATCH_INTERVAL 秒后一次摘要
+    @lazy
+    def summary_pipeline(self):
+        batch_mode = self.config['SUMMARY_BATCH_MODE']
+        if batch_mode is None:
+            batch_mode = _env_flag('SUMMARY_BATCH_MODE')
+        pipeline = SummaryPipeline(
+            self.save_memory_summary,
+            batch_handler=self.save_memory_summaries if batch_mode else None
+        )
+        pipeline.start()
+        return pipeline
+
+    # 对话滚动摘要：未摘要消息达到 ROLLING_SUMMARY_TRIGGER 条时在后台更新（单线程，按 Persona 去重）
+    @lazy
+    def conversation_summarizer(self):
+        return ConversationSummarizer(self.db, self.generate_conversation_summary)
+
+    @lazy
+    def conversation_pipeline(self):
+        pipeline = SummaryPipeline(
+            lambda persona_id, _: self.conversation_summarizer.update(persona_id),
+            workers=1,
+            drop_policy=DROP_NEWEST
+        )
+        pipeline.start()
+        return pipeline
+
+    # 聊天消息写入线程：使用单独的数据库连接，组提交，不阻塞首个 token（见 chat_writer.py）
+    @lazy
+    def chat_writer(self):
+        from database import open_database
+        db = self.db if self.db.db_path == ':memory:' else open_database(self.db.db_path)
+        writer = ChatWriter(db)
+        if self._async_chat_writes():
+            writer.start()
+        return writer
+
+    def _async_chat_writes(self) -> bool:
+        enabled = self.config['CHAT_WRITE_ASYNC']
+        if enabled is None:
+            enabled = os.getenv('CHAT_WRITE_ASYNC', '1').lower() not in ('0', 'false', 'no')
+        return enabled
+
+    def preload(self):
+        """预加载数据库、记忆缓存和 LLM 客户端"""
+        started = time.perf_counter()
+        self.db
+        self.memory_manager
+        self.valid_models
+        self.summary_client
+        self.conversation_summarizer
+        logger.info(f'预加载完成，用时 {time.perf_counter() - started:.2f}s')
+
+    def start_background(self):
+        """启动定期衰减线程（摘要流水线在第一次提交时启动）"""
+        interval = self.config['DECAY_INTERVAL']
+        if interval and self._decay_thread is None:
+            self._decay_thread = threading.Thread(target=self._apply_decay_periodically, args=(interval,), daemon=True)
+            self._decay_thread.start()
+
+    # ==================== 多进程（serve.py） ====================
+
+    def before_fork(self):
+        """fork 之前在主进程调用：关闭数据库连接（SQLite 连接不能跨 fork 使用，子进程第一次访问时各自重新连接）"""
+        if self.is_loaded('chat_writer'):
+            self.chat_writer.stop()
+            self.chat_writer.db.close()
+        if self.is_loaded('db'):
+            self.db.close()
+
+    def after_fork(self):
+        """fork 之后在 worker 中调用：重置随机数种子，从变更日志追上 fork 之后其他进程的写入"""
+        random.seed()
+        if self.is_loaded('memory_manager'):
+            self.memory_manager.sync_changes()
+        if self.is_loaded('chat_writer') and self._async_chat_writes():
+            self.chat_writer.start()
+
+    def shutdown(self, timeout: float = 5.0):
+        """写完排队的聊天消息，停止摘要流水线（处理完已排队的任务）和维护进程池，关闭数据库连接"""
+        if self.is_loaded('chat_writer'):
+            self.chat_writer.stop(timeout)
+            if self.chat_writer.db is not self.db:
+                self.chat_writer.db.close()
+        for name in ('summary_pipeline', 'conversation_pipeline'):
+            if self.is_loaded(name):
+                getattr(self, name).stop(timeout)
+        shutdown_executor()
+        if self.is_loaded('db'):
+            self.db.close()
+        self.metrics.clear()
+
+    # 定期应用权重衰减
+    def _apply_decay_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.memory_manager.apply_decay()
+            logger.info('记忆权重衰减已应用')
+
+    # ==================== 摘要 ====================
+
+    # 生成记忆摘要
+    def generate_memory_summary(self, persona_id, conversation):
+        try:
+            conversation_text = '\n'.join([f"{msg['role']}: {msg['content']}" for msg in conversation])
+            summary_prompt = f"""请为以下对话生成一个简洁的记忆摘要（1-2句话），重点关注重要信息和关键点：
+
+对话内容：
+{conversation_text}
+
+记忆摘要："""
+
+            messages = [
+                {'role': 'system', 'content': '你是一个专业的记忆摘要生成助手。请生成简洁、准确的中文摘要。'},
+                {'role': 'user', 'content': summary_prompt},
+            ]
+
+            return self.summary_client.complete(messages)
+        except Exception as error:
+            logger.error(f'生成记忆摘要失败: {error}')
+            # 如果API调用失败，使用简单的摘要方法
+            last_messages = conversation[-4:]
+            return ' | '.join([msg['content'] for msg in last_messages])[:200]
+
+    # 批量生成记忆摘要（一次请求摘要多轮对话）
+    def generate_memory_summaries(self, persona_id, conversations):
+        if len(conversations) == 1:
+            return [self.generate_memory_summary(persona_id, conversations[0])]
+
+        try:
+            turns_text = '\n\n'.join([
+                f"对话 {i + 1}：\n" + '\n'.join([f"{msg['role']}: {msg['content']}" for msg in conversation])
+                for i, conversation in enumerate(conversations)
+            ])
+            summary_prompt = f"""请为以下 {len(conversations)} 段对话分别生成简洁的记忆摘要（每段 1-2 句话），重点关注重要信息和关键点。
+只返回一个 JSON 字符串数组，按对话顺序排列，数组长度必须为 {len(conversations)}，不要输出其他内容。
+
+{turns_text}
+
+JSON 摘要数组："""
+
+            messages = [
+                {'role': 'system', 'content': '你是一个专业的记忆摘要生成助手。请生成简洁、准确的中文摘要。'},
+                {'role': 'user', 'content': summary_prompt},
+            ]
+
+            content = self.summary_client.complete(messages)
+
+            # 去掉可能的 Markdown 代码块
+            content = content.strip()
+            if content.startswith('```'):
+                content = content.strip('`')
+                content = content[content.find('['):]
+            summaries = json.loads(content)
+
+            if not isinstance(summaries, list) or len(summaries) != len(conversations):
+                raise ValueError(f'摘要数量不匹配: 期望 {len(conversations)}，实际 {len(summaries) if isinstance(summaries, list) else "非数组"}')
+            return [str(summary) for summary in summaries]
+        except Exception as error:
+            logger.error(f'批量生成记忆摘要失败: {error}')
+            # 如果API调用失败，使用简单的摘要方法
+            return [
+                ' | '.join([msg['content'] for msg in conversation[-4:]])[:200]
+                for conversation in conversations
+            ]
+
+    # 生成并保存记忆摘要（在摘要流水线的工作线程中执行）
+    def save_memory_summary(self, persona_id, conversation):
+        summary = self.generate_memory_summary(persona_id, conversation)
+
+        if summary:
+            self.memory_manager.add_memory(persona_id, summary, is_public=is_public_summary(summary))
+            logger.info(f'记忆已保存: {summary[:50]}...')
+
+    # 批量生成并保存记忆摘要（一次写入数据库）
+    def save_memory_summaries(self, persona_id, conversations):
+        summaries = [s for s in self.generate_memory_summaries(persona_id, conversations) if s]
+
+        if summaries:
+            self.memory_manager.add_memories(persona_id, [(s, is_public_summary(s)) for s in summaries])
+            logger.info(f'批量保存记忆: Persona {persona_id}, {len(summaries)} 条')
+
+    # 生成对话滚动摘要（把较早的消息并入已有摘要）
+    def generate_conversation_summary(self, previous_summary, messages):
+        return self.summary_client.complete(build_summary_messages(previous_summary, messages)).strip()
+
+
+def is_public_summary(summary):
+    """判断是否为公共记忆"""
+    return any(keyword in summary for keyword in ['通用', '公共', '一般', '普遍'])
+
+
+def _record_message_id(entry):
+    """聊天消息写入数据库后回填会话记录中的 ID（写入失败时保持 None）"""
+    def callback(future):
+        if future.exception() is None:
+            entry['id'] = future.result()
+    return callback
+
+
+def get_state() -> ServerState:
+    """当前应用的状态"""
+    return current_app.extensions['server_v2']
+
+
+bp = Blueprint('server_v2', __name__)
 
 
 # ==================== API 路由 ====================
 
 # 获取 Persona 列表
-@app.route('/personas', methods=['GET'])
+@bp.route('/personas', methods=['GET'])
 def get_personas():
-    personas = db.get_all_personas()
+    personas = get_state().db.get_all_personas()
     return jsonify(personas)
 
 
 # 创建新 Persona
-@app.route('/personas', methods=['POST'])
+@bp.route('/personas', methods=['POST'])
 def create_persona():
     data = request.get_json()
     name = data.get('name')
     description = data.get('description', '')
-    
+
     if not name:
         return jsonify({'error': '缺少 Persona 名称'}), 400
-    
-    persona_id = db.create_persona(name, description)
+
+    persona_id = get_state().db.create_persona(name, description)
     return jsonify({'id': persona_id, 'name': name, 'description': description})
 
 
 # 切换模型
-@app.route('/switch-model', methods=['POST'])
+@bp.route('/switch-model', methods=['POST'])
 def switch_model():
+    state = get_state()
     data = request.get_json()
     persona = data.get('persona')
     model = data.get('model')
-    
+
     if not persona or not model:
         return jsonify({'error': '缺少必要参数'}), 400
-    
-    valid_models = [DEFAULT_MODEL, THINKING_MODEL]
-    if model not in valid_models:
-        return jsonify({'error': f'无效的模型名称。支持的模型: {", ".join(valid_models)}'}), 400
-    
-    current_models[persona] = model
-    return jsonify({'success': True, 'model': model})
-
 
-# 调用 LongCat API
-def call_longcat_api(model, messages, stream=True):
-    api_key = os.getenv('LONGCAT_API_KEY', '')
-    
-    if not api_key:
-        raise Exception('LONGCAT_API_KEY 未设置。请在 .env 文件中设置 API 密钥，或设置环境变量 LONGCAT_API_KEY。')
-    
-    request_body = {
-        'model': model,
-        'messages': messages,
-        'temperature': 0.7,
-    }
-    
-    if stream:
-        request_body['stream'] = True
-    
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}',
-    }
-    
-    if stream:
-        headers['Accept'] = 'text/event-stream, application/json'
-    
-    api_url = f'{LONGCAT_API_BASE}/v1/chat/completions'
-    
-    try:
-        response = requests.post(
-            api_url,
-            json=request_body,
-            headers=headers,
-            timeout=API_TIMEOUT,
-            stream=stream
-        )
-    except requests.Timeout:
-        raise Exception(f'API调用超时（{API_TIMEOUT * 1000:.0f}ms）')
-    except Exception as err:
-        raise err
-    
-    if response.status_code != 200:
-        error_text = response.text
-        error_message = f'API调用失败: {response.status_code}'
-        try:
-            error_data = response.json()
-            if 'error' in error_data:
-                error_info = error_data['error']
-                if isinstance(error_info, dict):
-                    error_message += f' - {error_info.get("message", error_info.get("code", "未知错误"))}'
-                else:
-                    error_message += f' - {error_info}'
-            if response.status_code == 401:
-                error_message += '\n提示：请检查 LONGCAT_API_KEY 是否正确设置。'
-        except:
-            error_message += f' - {error_text}'
-        raise Exception(error_message)
-    
-    return response
-
-
-# 生成记忆摘要
-def generate_memory_summary(persona_id, conversation):
-    try:
-        persona_obj = db.get_persona(persona_id)
-        
-        conversation_text = '\n'.join([f"{msg['role']}: {msg['content']}" for msg in conversation])
-        summary_prompt = f"""请为以下对话生成一个简洁的记忆摘要（1-2句话），重点关注重要信息和关键点：
-
-对话内容：
-{conversation_text}
+    if model not in state.valid_models:
+        return jsonify({'error': f'无效的模型名称。支持的模型: {", ".join(state.valid_models)}'}), 400
 
-记忆摘要："""
-        
-        messages = [
-            {'role': 'system', 'content': '你是一个专业的记忆摘要生成助手。请生成简洁、准确的中文摘要。'},
-            {'role': 'user', 'content': summary_prompt},
-        ]
-        
-        response = call_longcat_api(DEFAULT_MODEL, messages, stream=False)
-        data = response.json()
-        return data.get('choices', [{}])[0].get('message', {}).get('content', '')
-    except Exception as error:
-        logger.error(f'生成记忆摘要失败: {error}')
-        # 如果API调用失败，使用简单的摘要方法
-        last_messages = conversation[-4:]
-        return ' | '.join([msg['content'] for msg in last_messages])[:200]
+    state.current_models[persona] = model
+    return jsonify({'success': True, 'model': model})
 
 
 # 聊天接口 - 流式响应
-@app.route('/chat', methods=['POST'])
+@bp.route('/chat', methods=['POST'])
 def chat():
+    state = get_state()
     data = request.get_json()
     persona = data.get('persona')
     message = data.get('message')
     model = data.get('model')
-    
+
     if not persona or not message:
         return jsonify({'error': '缺少必要参数'}), 400
-    
+
+    db = state.db
+    chat_sessions = state.chat_sessions
+    conversation_summarizer = state.conversation_summarizer
+    trace = state.tracer.start('chat')
     try:
         # 验证并选择模型
-        valid_models = [DEFAULT_MODEL, THINKING_MODEL]
-        selected_model = model or current_models.get(persona, DEFAULT_MODEL)
-        if selected_model not in valid_models:
-            selected_model = DEFAULT_MODEL
-        
-        persona_obj = db.get_persona(persona)
-        
+        selected_model = model or state.current_models.get(persona, state.default_model)
+        if selected_model not in state.valid_models:
+            selected_model = state.default_model
+
+        with trace.span('persona_lookup'):
+            persona_obj = db.get_persona(persona)
+
         # 检索相关记忆
-        relevant_memories = memory_manager.retrieve_memories(persona, message, 3)
-        memory_context = ''
-        if relevant_memories:
-            memory_list = '\n'.join([
-                f"- {m['content']} ({'角色记忆' if m.get('type') == 'persona' else '公共记忆'})"
-                for m in relevant_memories
-            ])
-            memory_context = f'相关记忆：\n{memory_list}\n\n'
-        
-        # 构建消息历史
-        if persona not in chat_sessions:
-            chat_sessions[persona] = []
-        
-        # 添加系统提示词
-        system_content = f"{persona_obj.get('description', '') if persona_obj else ''}\n\n{memory_context}请根据以上信息和记忆，自然地回应用户。"
-        system_message = {
-            'role': 'system',
-            'content': system_content,
-        }
-        
-        # 构建完整消息列表
-        messages = [system_message] + chat_sessions[persona][-10:] + [{'role': 'user', 'content': message}]
-        
-        # 保存用户消息
-        chat_sessions[persona].append({
+        with trace.span('retrieve_memories'):
+            relevant_memories = state.memory_manager.retrieve_memories(persona, message, 3)
+
+        with trace.span('prompt_build'):
+            # 构建消息历史（重启后从数据库恢复尚未并入摘要的消息）
+            if persona not in chat_sessions:
+                CACHE_REQUESTS.labels(cache='chat_session', result='miss').inc()
+                chat_sessions[persona] = conversation_summarizer.load_history(persona)
+            else:
+                CACHE_REQUESTS.labels(cache='chat_session', result='hit').inc()
+
+            # 已并入滚动摘要的消息不再保留原文
+            summary, chat_sessions[persona] = conversation_summarizer.split_history(persona, chat_sessions[persona])
+
+            # 按 token 预算组装消息：固定前缀（描述 + 指令）在前，本轮记忆在历史之后
+            messages = state.prompt_builder.build(
+                persona_obj.get('description', '') if persona_obj else '',
+                message,
+                history=chat_sessions[persona],
+                memories=relevant_memories,
+                summary=summary,
+            )
+
+        # 保存用户消息（数据库写入由后台线程完成后回填 ID）
+        user_message = {
+            'id': None,
             'role': 'user',
             'content': message,
             'timestamp': datetime.now().isoformat(),
-        })
-        
-        # 保存到数据库
-        db.add_chat_message(persona, 'user', message, selected_model)
-        
-        # 调用 LongCat API
-        logger.info(f'[Chat] 调用 API - Persona: {persona}, Model: {selected_model}')
-        api_response = call_longcat_api(selected_model, messages, stream=True)
-        
-        logger.info(f'[Chat] API 响应状态: {api_response.status_code}')
-        
+        }
+        chat_sessions[persona].append(user_message)
+        with trace.span('db_write'):
+            state.chat_writer.submit(persona, 'user', message, selected_model) \
+                .add_done_callback(_record_message_id(user_message))
+
+        # 客户端可请求原样转发上游 SSE 帧（stream_format=sse 或 Accept: text/event-stream）
+        passthrough = data.get('stream_format') == 'sse' or \
+            'text/event-stream' in request.headers.get('Accept', '')
+
+        # 调用 LLM API
+        router = state.router
+        chat_client = state.chat_client
+        upstream_started = time.monotonic()
+        with trace.span('upstream_connect'):
+            if router:
+                routed = router.open_stream(messages, model=selected_model, passthrough=passthrough)
+                logger.info(f'[Chat] 路由到 {routed.backend.name} - Persona: {persona}')
+                relay = routed.relay
+                upstream = track_stream(routed, routed.backend.name, upstream_started)
+                api_response = routed.response
+            else:
+                logger.info(f'[Chat] 调用 API - Persona: {persona}, Provider: {chat_client.provider}, Model: {selected_model}')
+                api_response = chat_client.request(selected_model, messages, stream=True)
+                logger.info(f'[Chat] API 响应状态: {api_response.status_code}')
+                relay = chat_client.create_relay(passthrough=passthrough)
+                upstream = track_stream(chat_client.relay_response(api_response, relay), chat_client.provider, upstream_started)
+
         # 生成流式响应
         def generate():
-            full_response = ''
-            buffer = ''
-            
             try:
-                for line_bytes in api_response.iter_lines():
-                    if not line_bytes:
-                        continue
-                    
-                    line = line_bytes.decode('utf-8') if isinstance(line_bytes, bytes) else line_bytes
-                    
-                    if not line.strip():
-                        continue
-                    
-                    # 处理 SSE 格式: data: {...}
-                    if line.startswith('data: '):
-                        data_str = line[6:].strip()
-                        
-                        if data_str == '[DONE]':
-                            break
-                        
-                        try:
-                            chunk_data = json.loads(data_str)
-                            delta = chunk_data.get('choices', [{}])[0].get('delta', {})
-                            content = delta.get('content', '')
-                            
-                            if content:
-                                full_response += content
-                                yield content.encode('utf-8')
-                        
-                        except json.JSONDecodeError:
-                            logger.warning(f'JSON 解析失败: {data_str[:100]}')
-                            continue
-                
+                for chunk in upstream:
+                    trace.mark('first_token')
+                    yield chunk
+                trace.mark('stream_end')
+                full_response = relay.text
+
                 # 保存 AI 响应
-                chat_sessions[persona].append({
+                assistant_message = {
+                    'id': None,
                     'role': 'assistant',
                     'content': full_response,
                     'timestamp': datetime.now().isoformat(),
-                })
-                
-                # 保存到数据库
-                db.add_chat_message(persona, 'assistant', full_response, selected_model)
-                
-                # 生成记忆摘要
-                if len(chat_sessions[persona]) >= 2:
-                    last_conversation = chat_sessions[persona][-2:]
-                    summary = generate_memory_summary(persona, last_conversation)
-                    
-                    if summary:
-                        # 判断是否为公共记忆
-                        is_public = any(keyword in summary for keyword in ['通用', '公共', '一般', '普遍'])
-                        memory_manager.add_memory(persona, summary, is_public=is_public)
-                        logger.info(f'记忆已保存: {summary[:50]}...')
-            
+                }
+                chat_sessions[persona].append(assistant_message)
+                with trace.span('db_write'):
+                    state.chat_writer.submit(persona, 'assistant', full_response, selected_model) \
+                        .add_done_callback(_record_message_id(assistant_message))
+
+                with trace.span('summary_enqueue'):
+                    # 提交到后台生成记忆摘要（不阻塞响应结束）
+                    if len(chat_sessions[persona]) >= 2:
+                        state.summary_pipeline.submit(persona, chat_sessions[persona][-2:])
+
+                    # 未摘要的消息过多时在后台更新对话滚动摘要
+                    if conversation_summarizer.needs_update(persona, chat_sessions[persona]):
+                        state.conversation_pipeline.submit(persona, [])
+
             except Exception as e:
                 logger.error(f'流式响应生成失败: {e}')
-                yield f'错误: {str(e)}'.encode('utf-8')
-        
-        return Response(generate(), content_type='text/plain; charset=utf-8')
-    
+                if relay.passthrough:
+                    yield f'event: error\ndata: {json.dumps({"error": str(e)}, ensure_ascii=False)}\n\n'.encode('utf-8')
+                else:
+                    yield f'错误: {str(e)}'.encode('utf-8')
+            finally:
+                api_response.close()
+                trace.finish()
+
+        content_type = 'text/event-stream; charset=utf-8' if relay.passthrough else 'text/plain; charset=utf-8'
+        response = Response(generate(), content_type=content_type)
+        if trace.server_timing():
+            response.headers['Server-Timing'] = trace.server_timing()
+        return response
+
     except Exception as error:
         logger.error(f'聊天处理失败: {error}')
+        trace.finish()
         return jsonify({'error': str(error)}), 500
 
 
 # ==================== 记忆管理 API ====================
 
 # 获取记忆列表
-@app.route('/memories/<int:persona_id>', methods=['GET'])
+@bp.route('/memories/<int:persona_id>', methods=['GET'])
 def get_memories(persona_id):
-    """获取指定 Persona 的所有记忆"""
-    memories = memory_manager.get_all_memories(persona_id)
-    return jsonify(memories)
+    """
+    获取指定 Persona 的所有记忆
+
+    ?since=<游标> 时只返回游标之后的变更（见 MemoryManager.get_memory_delta）：
+    {cursor, reset, upserts, deletes}，没有变化时返回空的 304；since 为空时返回全部记忆和游标
+    """
+    memory_manager = get_state().memory_manager
+    since = request.args.get('since')
+    if since is None:
+        return jsonify(memory_manager.get_all_memories(persona_id))
+
+    delta = memory_manager.get_memory_delta(persona_id, since)
+    if delta is None:
+        return Response(status=304)
+    return jsonify(delta)
 
 
 # 获取实时记忆（支持搜索）
-@app.route('/memories-live/<int:persona_id>', methods=['GET'])
+@bp.route('/memories-live/<int:persona_id>', methods=['GET'])
 def get_memories_live(persona_id):
     """获取实时记忆，支持搜索"""
+    memory_manager = get_state().memory_manager
     query = request.args.get('query', '')
-    
+
     if query:
         # 使用语义检索
         memories = memory_manager.retrieve_memories(persona_id, query, limit=20)
     else:
         # 获取所有记忆
         memories = memory_manager.get_all_memories(persona_id)
-    
+
     return jsonify(memories)
 
 
 # 添加记忆
-@app.route('/memories', methods=['POST'])
+@bp.route('/memories', methods=['POST'])
 def add_memory():
     """手动添加记忆"""
     data = request.get_json()
     persona_id = data.get('personaId')
     content = data.get('content')
     is_public = data.get('isPublic', False)
-    
+
     if not persona_id or not content:
         return jsonify({'error': '缺少必要参数'}), 400
-    
-    memory = memory_manager.add_memory(persona_id, content, is_public=is_public)
+
+    memory = get_state().memory_manager.add_memory(persona_id, content, is_public=is_public)
     return jsonify(memory)
 
 
 # 更新记忆
-@app.route('/memories/<int:memory_id>', methods=['PUT'])
+@bp.route('/memories/<int:memory_id>', methods=['PUT'])
 def update_memory(memory_id):
     """更新记忆内容"""
     data = request.get_json()
     content = data.get('content')
-    
+
     if not content:
         return jsonify({'error': '缺少内容'}), 400
-    
-    success = memory_manager.update_memory(memory_id, content=content)
-    
+
+    success = get_state().memory_manager.update_memory(memory_id, content=content)
+
     if success:
         return jsonify({'success': True})
     else:
@@ -394,23 +604,74 @@ def update_memory(memory_id):
 
 
 # 删除记忆
-@app.route('/memories/<int:memory_id>', methods=['DELETE'])
+@bp.route('/memories/<int:memory_id>', methods=['DELETE'])
 def delete_memory(memory_id):
     """删除记忆"""
-    success = memory_manager.delete_memory(memory_id)
-    
+    success = get_state().memory_manager.delete_memory(memory_id)
+
     if success:
         return jsonify({'success': True})
     else:
         return jsonify({'error': '删除失败'}), 500
 
 
+# 路由器状态
+@bp.route('/router-stats', methods=['GET'])
+def get_router_stats():
+    """获取各 LLM 后端的延迟、错误率和熔断状态"""
+    router = get_state().router
+    if not router:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **router.get_stats()})
+
+
+# 摘要队列状态
+@bp.route('/summary-queue', methods=['GET'])
+def get_summary_queue_stats():
+    """获取记忆摘要流水线的队列深度和延迟统计"""
+    return jsonify(get_state().summary_pipeline.get_stats())
+
+
+# 聊天消息写入队列状态
+@bp.route('/chat-write-queue', methods=['GET'])
+def get_chat_write_stats():
+    """获取聊天消息写入线程的队列深度和组提交统计"""
+    return jsonify(get_state().chat_writer.get_stats())
+
+
+# 数据库语句统计
+@bp.route('/db-stats', methods=['GET'])
+def get_db_stats():
+    """获取每种 SQL 语句的次数、延迟分位数和最近的慢查询（?reset=1 读取后清空）"""
+    db = get_state().db
+    stats = db.get_query_stats(request.args.get('limit', type=int), request.args.get('sort', 'total_ms'))
+    if request.args.get('reset'):
+        db.reset_query_stats()
+    return jsonify(stats)
+
+
+# 最近的请求追踪
+@bp.route('/traces', methods=['GET'])
+def get_traces():
+    """获取最近请求的阶段耗时（需设置 REQUEST_TRACE=1）"""
+    tracer = get_state().tracer
+    limit = request.args.get('limit', type=int)
+    return jsonify({'enabled': tracer.enabled, 'traces': tracer.recent(limit)})
+
+
+# Prometheus 指标
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """输出 Prometheus 文本格式的指标"""
+    return Response(REGISTRY.render() + get_state().metrics.render(), content_type=CONTENT_TYPE)
+
+
 # 导出数据
-@app.route('/export', methods=['GET'])
+@bp.route('/export', methods=['GET'])
 def export_data():
     """导出所有数据"""
-    data = memory_manager.export_memories()
-    
+    data = get_state().memory_manager.export_memories()
+
     response = Response(
         json.dumps(data, ensure_ascii=False, indent=2),
         mimetype='application/json',
@@ -421,12 +682,86 @@ def export_data():
     return response
 
 
+# ==================== 应用工厂 ====================
+
+def register_metrics(state: ServerState):
+    """抓取 /metrics 时计算的指标（组件尚未初始化时不输出），注册到应用自己的 state.metrics"""
+    state.metrics.gauge_callback(
+        'memory_count', '每个 Persona 缓存中的记忆数',
+        lambda: {(str(pid),): len(memories) for pid, memories in state.memory_manager.memory_cache.items()}
+        if state.is_loaded('memory_manager') else {},
+        ['persona_id']
+    )
+    state.metrics.gauge_callback(
+        'chat_write_queue_depth', '等待写入数据库的聊天消息数',
+        lambda: state.chat_writer.get_stats()['queue_depth'] if state.is_loaded('chat_writer') else {},
+    )
+    state.metrics.gauge_callback(
+        'summary_queue_depth', '摘要流水线的队列深度',
+        lambda: {(name,): getattr(state, attr).get_stats()['queue_depth']
+                 for name, attr in (('memory', 'summary_pipeline'), ('conversation', 'conversation_pipeline'))
+                 if state.is_loaded(attr)},
+        ['pipeline']
+    )
+
+
+def create_app(config: dict = None) -> Flask:
+    """
+    创建 Flask 应用
+
+    Args:
+        config: 覆盖 DEFAULT_CONFIG 的配置项
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+
+    if app.config['LOAD_DOTENV']:
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    from flask_cors import CORS
+    CORS(app, resources={r"/*": {"origins": "*", "supports_credentials": True}})
+
+    state = ServerState(app.config)
+    app.extensions['server_v2'] = state
+    app.register_blueprint(bp)
+    register_metrics(state)
+
+    preload = app.config['PRELOAD']
+    if preload is None:
+        preload = _env_flag('SERVER_PRELOAD')
+    if preload:
+        state.preload()
+    if app.config['BACKGROUND']:
+        state.start_background()
+    return app
+
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # 兼容 `from server_v2 import app` / gunicorn server_v2:app：第一次访问时创建默认应用
+    global _default_app
+    if name == 'app':
+        with _default_app_lock:
+            if _default_app is None:
+                _default_app = create_app()
+        return _default_app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 # ==================== 启动服务器 ====================
 
 if __name__ == '__main__':
-    logger.info(f'🚀 服务器启动于 http://localhost:{PORT}')
-    
-    if not os.getenv('LONGCAT_API_KEY'):
-        logger.warning('⚠️  LONGCAT_API_KEY 未设置，API 调用将失败')
-    
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    app = create_app({'PRELOAD': True})
+    state = app.extensions['server_v2']
+    port = int(os.getenv('PORT', 3001))
+    logger.info(f'🚀 服务器启动于 http://localhost:{port}')
+
+    if not state.chat_client.config.is_configured():
+        logger.warning(f'⚠️  {state.chat_client.config.config.get("api_key_env")} 未设置，API 调用将失败')
+
+    app.run(host='0.0.0.0', port=port, debug=False)
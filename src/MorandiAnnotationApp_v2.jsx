@@ -8,6 +8,13 @@ import { Send, Brain, Zap, Download, RefreshCw, Menu, X, Search, Edit2, Trash2,
 const DEFAULT_MODEL = 'LongCat-Flash-Chat';
 const THINKING_MODEL = 'LongCat-Flash-Thinking';
 
+// 合并记忆增量：去掉删除和修改的记忆，加入新版本，按时间倒序
+const mergeMemoryDelta = (memories, delta) => {
+  const changed = new Set([...delta.deletes, ...delta.upserts.map((memory) => memory.id)]);
+  return [...memories.filter((memory) => !changed.has(memory.id)), ...delta.upserts]
+    .sort((a, b) => (b.timestamp || '').localeCompare(a.timestamp || ''));
+};
+
 export default function MorandiAnnotationApp() {
   const [personas, setPersonas] = useState([]);
   const [currentPersona, setCurrentPersona] = useState(null);
@@ -30,6 +37,8 @@ export default function MorandiAnnotationApp() {
   
   const messagesEndRef = useRef(null);
   const memoryEndRef = useRef(null);
+  // 增量同步游标 { personaId, cursor }
+  const memoryCursorRef = useRef(null);
 
   const loadPersonas = async () => {
     try {
@@ -55,19 +64,40 @@ export default function MorandiAnnotationApp() {
   };
 
   const loadMemories = async (personaId, query = '') => {
+    // 搜索结果替换整个列表，之后重新全量加载
+    if (query) {
+      try {
+        setMemoryLoading(true);
+        memoryCursorRef.current = null;
+        const res = await fetch(import.meta.env.VITE_API_BASE_URL +
+          `/memories-live/${personaId}?query=${encodeURIComponent(query)}`);
+        if (!res.ok) throw new Error('加载记忆失败');
+        setMemories(await res.json());
+      } catch (err) {
+        console.error('加载记忆失败:', err);
+      } finally {
+        setMemoryLoading(false);
+      }
+      return;
+    }
+
+    // 只读取上次之后的变更（304 表示没有变化）
+    const cursor = memoryCursorRef.current?.personaId === personaId ? memoryCursorRef.current.cursor : '';
     try {
-      setMemoryLoading(true);
-      const url = import.meta.env.VITE_API_BASE_URL + (query
-        ? `/memories-live/${personaId}?query=${encodeURIComponent(query)}`
-        : `/memories-live/${personaId}`);
-      const res = await fetch(url);
+      if (!cursor) setMemoryLoading(true);
+      const res = await fetch(import.meta.env.VITE_API_BASE_URL +
+        `/memories/${personaId}?since=${encodeURIComponent(cursor)}`);
+      if (res.status === 304) return;
       if (!res.ok) throw new Error('加载记忆失败');
       const data = await res.json();
-      setMemories(data);
+      // 不支持 since 的旧服务器（server.py 等）返回完整的记忆数组
+      const delta = Array.isArray(data) ? { reset: true, upserts: data } : data;
+      memoryCursorRef.current = delta.cursor ? { personaId, cursor: delta.cursor } : null;
+      setMemories((prev) => (delta.reset ? delta.upserts : mergeMemoryDelta(prev, delta)));
     } catch (err) {
       console.error('加载记忆失败:', err);
     } finally {
-      setMemoryLoading(false);
+      if (!cursor) setMemoryLoading(false);
     }
   };
 
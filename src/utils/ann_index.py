@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+近似最近邻（ANN）向量索引
+记忆数量很大时代替对全部向量的精确点积，支持增量插入/删除和持久化到磁盘。
+
+实现：
+    hnsw     纯 NumPy 实现的 HNSW（无额外依赖）
+    hnswlib  hnswlib（安装后可用）
+    faiss    faiss-cpu 的 IndexHNSWFlat（安装后可用）
+    auto     依次尝试 hnswlib、faiss，都未安装时使用纯 NumPy 实现
+
+向量需要先 L2 归一化，相似度为内积（即余弦相似度）
+"""
+
+import os
+import math
+import heapq
+import pickle
+import random
+import logging
+import threading
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DTYPE = np.float32
+FORMAT_VERSION = 1
+
+# 已删除（墓碑）节点超过该比例时重建索引
+REBUILD_RATIO = 0.25
+
+
+class ANNIndex:
+    """向量索引基类，键为记忆 ID"""
+
+    kind = 'base'
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 100, ef_search: int = 64):
+        """
+        Args:
+            dim: 向量维度
+            M: 每个节点的邻居数（越大召回越高、内存越大）
+            ef_construction: 构建时的候选集大小
+            ef_search: 查询时的候选集大小（越大召回越高、越慢）
+        """
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, key: Hashable) -> bool:
+        raise NotImplementedError
+
+    def keys(self) -> List[Hashable]:
+        raise NotImplementedError
+
+    def add(self, key: Hashable, vector: np.ndarray):
+        """添加向量（键已存在时替换）"""
+        raise NotImplementedError
+
+    def add_items(self, keys: List[Hashable], vectors: np.ndarray):
+        for key, vector in zip(keys, vectors):
+            self.add(key, vector)
+
+    def remove(self, key: Hashable) -> bool:
+        raise NotImplementedError
+
+    def set_ef(self, ef_search: int):
+        """调整查询时的候选集大小"""
+        self.ef_search = ef_search
+
+    def search(self, query: np.ndarray, k: int,
+               filter: Optional[Callable[[Hashable], bool]] = None) -> List[Tuple[Hashable, float]]:
+        """
+        查询最相似的 k 个向量
+
+        Args:
+            query: 归一化的查询向量
+            k: 返回数量
+            filter: 只返回 filter(key) 为 True 的结果
+
+        Returns:
+            [(键, 相似度), ...]，按相似度降序
+        """
+        raise NotImplementedError
+
+    def _get_state(self) -> Dict:
+        raise NotImplementedError
+
+    def _set_state(self, state: Dict):
+        raise NotImplementedError
+
+    def save(self, path: str, **metadata):
+        """保存到磁盘（先写临时文件再替换，避免读到写了一半的文件）"""
+        with self._lock:
+            payload = {
+                'version': FORMAT_VERSION,
+                'kind': self.kind,
+                'dim': self.dim,
+                'params': {'M': self.M, 'ef_construction': self.ef_construction, 'ef_search': self.ef_search},
+                'metadata': metadata,
+                'state': self._get_state(),
+            }
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> Tuple['ANNIndex', Dict]:
+        """从磁盘加载，返回 (索引, 保存时的元数据)"""
+        with open(path, 'rb') as f:
+            payload = pickle.load(f)
+        if payload.get('version') != FORMAT_VERSION:
+            raise ValueError(f'不支持的索引文件版本: {payload.get("version")}')
+        cls = INDEX_TYPES[payload['kind']]
+        index = cls(payload['dim'], **payload['params'])
+        index._set_state(payload['state'])
+        return index, payload['metadata']
+
+
+class HNSWIndex(ANNIndex):
+    """
+    纯 NumPy 的 HNSW 图索引
+
+    删除只标记墓碑（查询时跳过，但仍参与图遍历），墓碑过多时重建
+    """
+
+    kind = 'hnsw'
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 100, ef_search: int = 64,
+                 capacity: int = 1024, seed: int = 42):
+        super().__init__(dim, M, ef_construction, ef_search)
+        self.M0 = 2 * M  # 第 0 层允许更多邻居
+        self._level_mult = 1 / math.log(M)
+        self._rng = random.Random(seed)
+
+        self._data = np.zeros((capacity, dim), dtype=DTYPE)
+        self._keys: List[Hashable] = []           # 节点 -> 键
+        self._nodes: Dict[Hashable, int] = {}     # 键 -> 节点（不含已删除）
+        self._links: List[List[List[int]]] = []   # 节点 -> 层 -> 邻居
+        self._deleted: Set[int] = set()
+        self._entry = -1
+        self._max_level = -1
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._nodes
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._nodes)
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[Tuple[float, int]],
+                      ef: int, level: int) -> List[Tuple[float, int]]:
+        """在一层中贪心搜索，返回最相似的 ef 个节点 [(相似度, 节点)]，按相似度降序"""
+        visited = {node for _, node in entry_points}
+        candidates = [(-sim, node) for sim, node in entry_points]
+        heapq.heapify(candidates)
+        results = list(entry_points)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_sim, node = heapq.heappop(candidates)
+            if len(results) >= ef and -neg_sim < results[0][0]:
+                break
+
+            neighbours = [n for n in self._links[node][level] if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+
+            sims = self._data[neighbours] @ query
+            for neighbour, sim in zip(neighbours, sims.tolist()):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, neighbour))
+                    heapq.heappush(results, (sim, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted(results, reverse=True)
+
+    def _select_neighbours(self, candidates: List[Tuple[float, int]], m: int) -> List[int]:
+        """
+        启发式选择邻居：候选点比已选邻居更接近目标时才加入，保持图的连通方向多样，
+        不足 m 个时用被跳过的候选补齐
+        """
+        if len(candidates) <= m:
+            return [node for _, node in candidates]
+
+        nodes = [node for _, node in candidates]
+        vectors = self._data[nodes]
+        pairwise = (vectors @ vectors.T).tolist()  # 候选点两两之间的相似度
+
+        selected: List[int] = []
+        skipped: List[int] = []
+        for i, (sim, _) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            row = pairwise[i]
+            if selected and max(row[j] for j in selected) > sim:
+                skipped.append(i)
+            else:
+                selected.append(i)
+        return [nodes[i] for i in selected + skipped[:m - len(selected)]]
+
+    def _greedy_descend(self, query: np.ndarray, target_level: int) -> List[Tuple[float, int]]:
+        """从入口节点逐层下降到 target_level"""
+        entry = [(float(self._data[self._entry] @ query), self._entry)]
+        for level in range(self._max_level, target_level, -1):
+            entry = self._search_layer(query, entry, 1, level)[:1]
+        return entry
+
+    def add(self, key: Hashable, vector: np.ndarray):
+        with self._lock:
+            if key in self._nodes:
+                self._remove_node(key)
+
+            node = len(self._keys)
+            if node >= self._data.shape[0]:
+                grown = np.zeros((self._data.shape[0] * 2, self.dim), dtype=DTYPE)
+                grown[:node] = self._data[:node]
+                self._data = grown
+            self._data[node] = vector
+            query = self._data[node]
+            self._keys.append(key)
+            self._nodes[key] = node
+
+            level = int(-math.log(1 - self._rng.random()) * self._level_mult)
+            self._links.append([[] for _ in range(level + 1)])
+
+            if self._entry < 0:
+                self._entry, self._max_level = node, level
+                return
+
+            entry = self._greedy_descend(query, level)
+            for lc in range(min(level, self._max_level), -1, -1):
+                candidates = self._search_layer(query, entry, self.ef_construction, lc)
+                neighbours = self._select_neighbours(candidates, self.M)
+                self._links[node][lc] = neighbours
+
+                max_links = self.M0 if lc == 0 else self.M
+                for neighbour in neighbours:
+                    links = self._links[neighbour][lc]
+                    links.append(node)
+                    if len(links) > max_links:
+                        sims = self._data[links] @ self._data[neighbour]
+                        ranked = sorted(zip(sims.tolist(), links), reverse=True)
+                        self._links[neighbour][lc] = self._select_neighbours(ranked, max_links)
+                entry = candidates
+
+            if level > self._max_level:
+                self._entry, self._max_level = node, level
+
+    def _remove_node(self, key: Hashable) -> bool:
+        node = self._nodes.pop(key, None)
+        if node is None:
+            return False
+        self._deleted.add(node)
+        return True
+
+    def remove(self, key: Hashable) -> bool:
+        with self._lock:
+            removed = self._remove_node(key)
+            if removed and len(self._deleted) > max(64, REBUILD_RATIO * len(self._keys)):
+                self._rebuild()
+            return removed
+
+    def _rebuild(self):
+        """只用未删除的节点重建图"""
+        live = sorted(self._nodes.items(), key=lambda item: item[1])
+        keys = [key for key, _ in live]
+        vectors = self._data[[node for _, node in live]] if live else np.zeros((0, self.dim), dtype=DTYPE)
+        logger.info(f'[ANN] 重建 HNSW 索引: {len(keys)} 个节点（清除 {len(self._deleted)} 个墓碑）')
+
+        self._data = np.zeros((max(1024, len(keys)), self.dim), dtype=DTYPE)
+        self._keys, self._nodes, self._links = [], {}, []
+        self._deleted = set()
+        self._entry, self._max_level = -1, -1
+        for key, vector in zip(keys, vectors):
+            self.add(key, vector)
+
+    def search(self, query: np.ndarray, k: int,
+               filter: Optional[Callable[[Hashable], bool]] = None) -> List[Tuple[Hashable, float]]:
+        query = np.asarray(query, dtype=DTYPE)
+        with self._lock:
+            if not self._nodes:
+                return []
+
+            ef = max(self.ef_search, k)
+            entry = self._greedy_descend(query, 0)
+            while True:
+                candidates = self._search_layer(query, entry, ef, 0)
+                hits = [
+                    (self._keys[node], sim) for sim, node in candidates
+                    if node not in self._deleted and (filter is None or filter(self._keys[node]))
+                ]
+                # 被过滤掉的结果太多时扩大候选集
+                if len(hits) >= k or ef >= len(self._keys):
+                    return hits[:k]
+                ef = min(ef * 4, len(self._keys))
+
+    def _get_state(self) -> Dict:
+        return {
+            'data': self._data[:len(self._keys)].copy(),
+            'keys': self._keys,
+            'links': self._links,
+            'deleted': self._deleted,
+            'entry': self._entry,
+            'max_level': self._max_level,
+        }
+
+    def _set_state(self, state: Dict):
+        self._data = np.array(state['data'], dtype=DTYPE).reshape(-1, self.dim)
+        if self._data.shape[0] == 0:
+            self._data = np.zeros((1024, self.dim), dtype=DTYPE)
+        self._keys = list(state['keys'])
+        self._links = state['links']
+        self._deleted = set(state['deleted'])
+        self._nodes = {key: node for node, key in enumerate(self._keys) if node not in self._deleted}
+        self._entry = state['entry']
+        self._max_level = state['max_level']
+
+
+class HnswlibIndex(ANNIndex):
+    """hnswlib 索引（内积空间），删除使用 hnswlib 的 mark_deleted"""
+
+    kind = 'hnswlib'
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 100, ef_search: int = 64,
+                 capacity: int = 1024):
+        import hnswlib
+        super().__init__(dim, M, ef_construction, ef_search)
+        self._index = hnswlib.Index(space='ip', dim=dim)
+        self._index.init_index(max_elements=capacity, ef_construction=ef_construction, M=M,
+                               allow_replace_deleted=True)
+        self._index.set_ef(ef_search)
+        self._labels: Dict[Hashable, int] = {}  # 键 -> hnswlib 标签
+        self._keys: Dict[int, Hashable] = {}    # 标签 -> 键
+        self._next_label = 0
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._labels
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._labels)
+
+    def add(self, key: Hashable, vector: np.ndarray):
+        with self._lock:
+            self.remove(key)
+            if self._index.get_current_count() >= self._index.get_max_elements():
+                self._index.resize_index(self._index.get_max_elements() * 2)
+            label = self._next_label
+            self._next_label += 1
+            self._index.add_items(np.asarray(vector, dtype=DTYPE)[None, :], [label], replace_deleted=True)
+            self._labels[key] = label
+            self._keys[label] = key
+
+    def set_ef(self, ef_search: int):
+        self.ef_search = ef_search
+        self._index.set_ef(ef_search)
+
+    def remove(self, key: Hashable) -> bool:
+        with self._lock:
+            label = self._labels.pop(key, None)
+            if label is None:
+                return False
+            del self._keys[label]
+            self._index.mark_deleted(label)
+            return True
+
+    def search(self, query: np.ndarray, k: int,
+               filter: Optional[Callable[[Hashable], bool]] = None) -> List[Tuple[Hashable, float]]:
+        with self._lock:
+            k = min(k, len(self._labels))
+            if k == 0:
+                return []
+            label_filter = None
+            if filter is not None:
+                label_filter = lambda label: label in self._keys and filter(self._keys[label])
+            try:
+                labels, distances = self._index.knn_query(
+                    np.asarray(query, dtype=DTYPE)[None, :], k=k, filter=label_filter)
+            except RuntimeError:
+                return []  # 满足过滤条件的结果不足 k 个
+            # 内积空间的距离为 1 - 内积
+            return [(self._keys[label], 1.0 - float(distance))
+                    for label, distance in zip(labels[0].tolist(), distances[0].tolist())]
+
+    def _get_state(self) -> Dict:
+        return {'index': self._index, 'labels': self._labels, 'next_label': self._next_label}
+
+    def _set_state(self, state: Dict):
+        self._index = state['index']
+        self._index.set_ef(self.ef_search)
+        self._labels = state['labels']
+        self._keys = {label: key for key, label in self._labels.items()}
+        self._next_label = state['next_label']
+
+
+class FaissIndex(ANNIndex):
+    """
+    faiss IndexHNSWFlat（内积）
+
+    faiss 的 HNSW 索引不支持删除：删除只标记墓碑，墓碑过多时从剩余向量重建
+    """
+
+    kind = 'faiss'
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 100, ef_search: int = 64):
+        import faiss
+        super().__init__(dim, M, ef_construction, ef_search)
+        self._faiss = faiss
+        self._new_index()
+
+    def _new_index(self):
+        self._index = self._faiss.IndexHNSWFlat(self.dim, self.M, self._faiss.METRIC_INNER_PRODUCT)
+        self._index.hnsw.efConstruction = self.ef_construction
+        self._index.hnsw.efSearch = self.ef_search
+        self._keys: List[Hashable] = []         # faiss 内部序号 -> 键
+        self._positions: Dict[Hashable, int] = {}
+        self._deleted: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._positions
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._positions)
+
+    def add(self, key: Hashable, vector: np.ndarray):
+        self.add_items([key], np.asarray(vector, dtype=DTYPE)[None, :])
+
+    def add_items(self, keys: List[Hashable], vectors: np.ndarray):
+        with self._lock:
+            for key in keys:
+                self._mark_deleted(key)
+            start = len(self._keys)
+            self._index.add(np.ascontiguousarray(vectors, dtype=DTYPE))
+            for offset, key in enumerate(keys):
+                self._keys.append(key)
+                self._positions[key] = start + offset
+
+    def set_ef(self, ef_search: int):
+        self.ef_search = ef_search
+        self._index.hnsw.efSearch = ef_search
+
+    def _mark_deleted(self, key: Hashable) -> bool:
+        position = self._positions.pop(key, None)
+        if position is None:
+            return False
+        self._deleted.add(position)
+        return True
+
+    def remove(self, key: Hashable) -> bool:
+        with self._lock:
+            removed = self._mark_deleted(key)
+            if removed and len(self._deleted) > max(64, REBUILD_RATIO * len(self._keys)):
+                live = sorted(self._positions.items(), key=lambda item: item[1])
+                vectors = np.vstack([self._index.reconstruct(position) for _, position in live]) \
+                    if live else np.zeros((0, self.dim), dtype=DTYPE)
+                logger.info(f'[ANN] 重建 faiss 索引: {len(live)} 个向量')
+                self._new_index()
+                if live:
+                    self.add_items([key for key, _ in live], vectors)
+            return removed
+
+    def search(self, query: np.ndarray, k: int,
+               filter: Optional[Callable[[Hashable], bool]] = None) -> List[Tuple[Hashable, float]]:
+        query = np.ascontiguousarray(np.asarray(query, dtype=DTYPE)[None, :])
+        with self._lock:
+            total = len(self._keys)
+            fetch = min(total, k + len(self._deleted))
+            while fetch > 0:
+                sims, positions = self._index.search(query, fetch)
+                hits = [
+                    (self._keys[position], float(sim))
+                    for sim, position in zip(sims[0].tolist(), positions[0].tolist())
+                    if position >= 0 and position not in self._deleted
+                    and (filter is None or filter(self._keys[position]))
+                ]
+                if len(hits) >= k or fetch >= total:
+                    return hits[:k]
+                fetch = min(total, fetch * 4)
+            return []
+
+    def _get_state(self) -> Dict:
+        return {
+            'index': self._faiss.serialize_index(self._index),
+            'keys': self._keys,
+            'deleted': self._deleted,
+        }
+
+    def _set_state(self, state: Dict):
+        self._index = self._faiss.deserialize_index(state['index'])
+        self._index.hnsw.efSearch = self.ef_search
+        self._keys = list(state['keys'])
+        self._deleted = set(state['deleted'])
+        self._positions = {key: i for i, key in enumerate(self._keys) if i not in self._deleted}
+
+
+INDEX_TYPES = {
+    HNSWIndex.kind: HNSWIndex,
+    HnswlibIndex.kind: HnswlibIndex,
+    FaissIndex.kind: FaissIndex,
+}
+
+
+def create_ann_index(kind: str, dim: int, **params) -> ANNIndex:
+    """
+    创建向量索引
+
+    Args:
+        kind: hnsw / hnswlib / faiss / auto
+        dim: 向量维度
+    """
+    if kind == 'auto':
+        for candidate in (HnswlibIndex, FaissIndex):
+            try:
+                return candidate(dim, **params)
+            except ImportError:
+                continue
+        return HNSWIndex(dim, **params)
+    if kind not in INDEX_TYPES:
+        raise ValueError(f'未知的向量索引类型: {kind}，支持: auto, {", ".join(INDEX_TYPES)}')
+    return INDEX_TYPES[kind](dim, **params)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+聊天消息异步写入
+/chat 在请求线程中同步写入用户消息和 AI 回复，每条消息一次提交（一次 fsync），
+SQLite 写锁被占用时首个 token 要等写入完成。这里改为单个写入线程：
+
+    请求线程 submit() 放入队列后立即返回 Future（结果为消息 ID）
+    写入线程取出队列中已有的所有消息（最多 CHAT_WRITE_BATCH_SIZE 条），一次事务提交（组提交）
+    stop() 写完队列中剩余的消息后退出（退出前提交的消息仍进入队列，写入线程结束后才改为同步写入）
+
+持久性（CHAT_WRITE_FSYNC_INTERVAL 秒）：
+    0（默认）  每次组提交由 SQLite 同步写盘，提交完成即持久
+    N > 0      写入连接切换到 WAL 模式并使用 synchronous=NORMAL，提交只写入操作系统缓存，
+               写入线程每 N 秒对 WAL 文件 fsync 一次；进程崩溃不丢消息，断电或系统崩溃最多丢失最近 N 秒的消息
+               （WAL 模式会保存在数据库文件中，其他连接随之使用 WAL）
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from src.utils.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+CHAT_WRITE_BATCH = Histogram('chat_write_batch_size', '聊天消息每次组提交的条数', [],
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+CHAT_WRITE_SECONDS = Histogram('chat_write_seconds', '聊天消息组提交耗时（秒）')
+
+
+class ChatWriter:
+    """
+    聊天消息写入线程
+
+    db 最好是单独打开的 Database / ShardedDatabase 实例（独立的连接，持久性设置不影响其他写入）
+    """
+
+    def __init__(self, db, batch_size: int = None, fsync_interval: float = None, max_queue: int = None):
+        """
+        初始化写入线程
+
+        Args:
+            db: 数据库实例（需要 add_chat_messages）
+            batch_size: 每次组提交最多写入多少条消息
+            fsync_interval: fsync 间隔（秒），0 表示每次提交都同步写盘
+            max_queue: 队列容量（队列满时 submit 阻塞，消息不会被丢弃）
+        """
+        self.db = db
+        self.batch_size = batch_size or int(os.getenv('CHAT_WRITE_BATCH_SIZE', 64))
+        self.fsync_interval = fsync_interval if fsync_interval is not None else \
+            float(os.getenv('CHAT_WRITE_FSYNC_INTERVAL', 0))
+        self.max_queue = max_queue or int(os.getenv('CHAT_WRITE_QUEUE_SIZE', 10000))
+
+        self._queue: queue.Queue = queue.Queue(maxsize=self.max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()   # 保护 _thread / _accepting / _pending
+        self._accepting = False    # 写入线程接收新消息（停止时写入线程排空队列后置为 False）
+        self._stopping = False
+        self._pending = 0          # 已决定放入队列但尚未放入的消息数
+        self._dirty = False        # 有尚未 fsync 的提交
+        self._last_fsync = time.monotonic()
+
+        self._stats = {
+            'submitted': 0,
+            'written': 0,
+            'failed': 0,
+            'batches': 0,
+            'batch_max': 0,
+            'fsyncs': 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        """启动写入线程"""
+        with self._submit_lock:
+            if self._thread is not None:
+                return
+            if self.fsync_interval > 0:
+                for log in self.db.change_logs().values():
+                    conn = log.get_connection()
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute('PRAGMA synchronous=NORMAL')
+            self._accepting = True
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+            self._thread.start()
+        logger.info(f'聊天消息写入线程已启动: 每批最多 {self.batch_size} 条, '
+                    f'fsync {"每次提交" if self.fsync_interval <= 0 else f"每 {self.fsync_interval}s"}')
+
+    def submit(self, persona_id: int, role: str, content: str, model: str = None) -> Future:
+        """
+        提交一条聊天消息
+
+        Returns:
+            Future，写入后结果为消息 ID（写入线程未启动时在当前线程同步写入）
+        """
+        future = Future()
+        item = ((persona_id, role, content, model), future)
+        with self._lock:
+            self._stats['submitted'] += 1
+        with self._submit_lock:
+            thread = self._thread
+            accepting = self._accepting
+            if accepting:
+                self._pending += 1
+        if accepting:
+            # 在锁外放入（队列满时阻塞不影响 stop/start）；_pending 未归零前写入线程不会退出
+            try:
+                self._queue.put(item)
+            finally:
+                with self._submit_lock:
+                    self._pending -= 1
+            return future
+        if thread is not None:
+            # 写入线程正在退出：等它不再使用连接后再同步写入，避免两个线程在同一连接上交错执行事务
+            thread.join()
+        self._write([item])
+        return future
+
+    def _run(self):
+        """写入线程主循环：一次取出队列中已有的消息，组提交"""
+        while True:
+            try:
+                item = self._queue.get(timeout=self._wait_timeout())
+            except queue.Empty:
+                self._maybe_fsync()
+                if self._drained():
+                    break
+                continue
+
+            batch = []
+            done = 1
+            while True:
+                if item is not None:    # None 只用于唤醒写入线程
+                    batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                done += 1
+
+            if batch:
+                self._write(batch)
+            for _ in range(done):
+                self._queue.task_done()
+            self._maybe_fsync()
+            if self._drained():
+                break
+
+        if self._dirty:
+            self._fsync()
+
+    def _write(self, batch: List[Tuple[Tuple, Future]]):
+        """一次事务写入一批消息，并设置各自的 Future"""
+        try:
+            with CHAT_WRITE_SECONDS.time():
+                message_ids = self.db.add_chat_messages([message for message, _ in batch])
+        except Exception as e:
+            logger.error(f'聊天消息写入失败 ({len(batch)} 条): {e}')
+            with self._lock:
+                self._stats['failed'] += len(batch)
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        CHAT_WRITE_BATCH.observe(len(batch))
+        with self._lock:
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['batch_max'] = max(self._stats['batch_max'], len(batch))
+            self._dirty = True
+        for (_, future), message_id in zip(batch, message_ids):
+            future.set_result(message_id)
+
+    # ==================== 持久性 ====================
+
+    def _drained(self) -> bool:
+        """停止中且队列已排空、没有正在放入的消息：不再接收新消息，写入线程可以退出"""
+        with self._submit_lock:
+            if self._stopping and self._pending == 0 and self._queue.empty():
+                self._accepting = False
+            return not self._accepting
+
+    def _wait_timeout(self) -> Optional[float]:
+        """队列为空时最多等待多久（停止中定期检查是否排空，有未 fsync 的提交时到期后 fsync）"""
+        if self._stopping:
+            return 0.05
+        if self.fsync_interval <= 0 or not self._dirty:
+            return None
+        return max(self._last_fsync + self.fsync_interval - time.monotonic(), 0.0)
+
+    def _maybe_fsync(self):
+        if self.fsync_interval > 0 and self._dirty and \
+                time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def _fsync(self):
+        """把各数据库文件的 WAL 同步到磁盘"""
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+        if self.fsync_interval <= 0:
+            return
+        for log in self.db.change_logs().values():
+            path = f'{log.db_path}-wal'
+            if not os.path.exists(path):
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logger.error(f'fsync {path} 失败: {e}')
+        with self._lock:
+            self._stats['fsyncs'] += 1
+
+    # ==================== 停止 ====================
+
+    def flush(self):
+        """等待已提交的消息全部写入"""
+        if self.running:
+            self._queue.join()
+
+    def stop(self, timeout: float = 5.0):
+        """写完队列中剩余的消息（并 fsync）后停止写入线程，写入线程结束后的消息同步写入"""
+        with self._submit_lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+        try:
+            self._queue.put_nowait(None)    # 唤醒等待中的写入线程；队列满时写入线程本来就在忙
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        if thread.is_alive():
+            # 保留 _thread：之后的消息继续进入队列（或等写入线程结束），不会与写入线程共用连接
+            logger.warning(f'聊天消息写入线程未在 {timeout}s 内结束，剩余 {self._queue.qsize()} 条')
+            return
+        with self._submit_lock:
+            if self._thread is thread:
+                self._thread = None
+        logger.info('聊天消息写入线程已停止')
+
+    def get_stats(self) -> Dict:
+        """获取写入统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            'running': self.running,
+            'queue_depth': self._queue.qsize(),
+            'max_queue': self.max_queue,
+            'batch_size': self.batch_size,
+            'fsync_interval': self.fsync_interval,
+            'batch_avg': stats['written'] / stats['batches'] if stats['batches'] else 0.0,
+            **stats,
+        }
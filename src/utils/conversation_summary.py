@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+对话滚动摘要
+每个 Persona 维护一份增量更新的对话摘要（保存在 SQLite 的 conversation_summaries 表）：
+未摘要的消息超过 trigger 条时，把较早的消息并入摘要，只保留最近 keep_recent 条原文。
+提示词中用摘要代替较早的对话，长度基本不随对话轮数增长
+"""
+
+import os
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple
+from src.utils.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+def build_summary_messages(previous_summary: str, messages: List[Dict]) -> List[Dict]:
+    """构建"把新消息并入已有摘要"的 LLM 请求消息"""
+    conversation_text = '\n'.join([f"{msg['role']}: {msg['content']}" for msg in messages])
+    summary_prompt = f"""请把以下新的对话内容并入已有的对话摘要，生成一份更新后的摘要（不超过 300 字）。
+保留用户的关键信息、偏好和尚未结束的话题，省略寒暄和重复内容。
+
+已有摘要：
+{previous_summary or '（无）'}
+
+新的对话内容：
+{conversation_text}
+
+更新后的摘要："""
+
+    return [
+        {'role': 'system', 'content': '你是一个专业的对话摘要助手。请生成简洁、准确的中文摘要。'},
+        {'role': 'user', 'content': summary_prompt},
+    ]
+
+
+class ConversationSummarizer:
+    """
+    对话滚动摘要管理器
+
+    summarize(previous_summary, messages) 负责调用 LLM，把新消息并入已有摘要并返回新摘要
+    """
+
+    def __init__(self, db, summarize: Callable[[str, List[Dict]], str],
+                 keep_recent: int = None, trigger: int = None):
+        """
+        初始化摘要管理器
+
+        Args:
+            db: Database 实例
+            summarize: 摘要函数
+            keep_recent: 保留原文的最近消息条数
+            trigger: 未摘要消息达到多少条时更新摘要
+        """
+        self.db = db
+        self.summarize = summarize
+        self.keep_recent = keep_recent or int(os.getenv('ROLLING_SUMMARY_KEEP', 6))
+        self.trigger = max(trigger or int(os.getenv('ROLLING_SUMMARY_TRIGGER', 12)), self.keep_recent + 2)
+
+        self._cache: Dict[int, Dict] = {}  # persona_id -> {'summary', 'last_message_id'}
+        self._running = set()              # 正在更新摘要的 Persona
+        self._lock = threading.Lock()
+
+    def get(self, persona_id: int) -> Dict:
+        """获取 Persona 的当前摘要（没有摘要时 summary 为空、last_message_id 为 0）"""
+        with self._lock:
+            state = self._cache.get(persona_id)
+        CACHE_REQUESTS.labels(cache='conversation_summary', result='miss' if state is None else 'hit').inc()
+        if state is None:
+            row = self.db.get_conversation_summary(persona_id)
+            state = {
+                'summary': row['summary'] if row else '',
+                'last_message_id': row['last_message_id'] if row else 0,
+            }
+            with self._lock:
+                state = self._cache.setdefault(persona_id, state)
+        return state
+
+    def load_history(self, persona_id: int) -> List[Dict]:
+        """从数据库加载尚未并入摘要的消息（用于重启后恢复内存中的会话）"""
+        state = self.get(persona_id)
+        rows = self.db.get_chat_messages_after(persona_id, state['last_message_id'], limit=self.trigger * 2)
+        return [
+            {'id': row['id'], 'role': row['role'], 'content': row['content'], 'timestamp': row['created_at']}
+            for row in rows
+        ]
+
+    def split_history(self, persona_id: int, history: List[Dict]) -> Tuple[str, List[Dict]]:
+        """
+        拆分会话历史
+
+        Returns:
+            (摘要, 尚未并入摘要的消息)
+        """
+        state = self.get(persona_id)
+        last_id = state['last_message_id']
+        recent = [m for m in history if m.get('id') is None or m['id'] > last_id]
+        return state['summary'], recent
+
+    def needs_update(self, persona_id: int, history: List[Dict]) -> bool:
+        """未摘要的消息是否已达到更新阈值"""
+        _, recent = self.split_history(persona_id, history)
+        return len(recent) >= self.trigger
+
+    def update(self, persona_id: int) -> bool:
+        """
+        把较早的未摘要消息并入摘要（同一 Persona 同时只有一个更新在执行）
+
+        Returns:
+            摘要是否已更新
+        """
+        with self._lock:
+            if persona_id in self._running:
+                return False
+            self._running.add(persona_id)
+
+        try:
+            state = self.get(persona_id)
+            pending = self.db.get_chat_messages_after(persona_id, state['last_message_id'])
+            if len(pending) < self.trigger:
+                return False
+
+            # 保留的原文从用户消息开始
+            cut = len(pending) - self.keep_recent
+            while cut < len(pending) and pending[cut]['role'] != 'user':
+                cut += 1
+            folded = pending[:cut]
+            if not folded:
+                return False
+
+            summary = self.summarize(state['summary'], folded)
+            if not summary:
+                return False
+
+            last_message_id = folded[-1]['id']
+            self.db.save_conversation_summary(persona_id, summary, last_message_id)
+            with self._lock:
+                self._cache[persona_id] = {'summary': summary, 'last_message_id': last_message_id}
+            logger.info(f'对话摘要已更新: Persona {persona_id}, 并入 {len(folded)} 条消息')
+            return True
+        except Exception as e:
+            logger.error(f'更新对话摘要失败 (Persona {persona_id}): {e}')
+            return False
+        finally:
+            with self._lock:
+                self._running.discard(persona_id)
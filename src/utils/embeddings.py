@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+文本向量（Embedding）后端
+记忆写入时批量计算向量，以 float32 BLOB 存入数据库，检索时在连续的 NumPy 矩阵上做点积。
+
+通过环境变量选择后端：
+    EMBEDDING_BACKEND=hashing                    本地哈希向量（无需模型，用于测试）
+    EMBEDDING_BACKEND=local  EMBEDDING_MODEL=BAAI/bge-small-zh-v1.5
+                                                 本地 CPU 模型（需要 sentence-transformers）
+    EMBEDDING_BACKEND=openai EMBEDDING_MODEL=text-embedding-3-small
+                                                 api_config.PROVIDERS 中任一提供商的 /embeddings 接口
+未设置时记忆管理器继续使用词频向量
+"""
+
+import os
+import re
+import zlib
+import logging
+import threading
+from typing import Dict, Hashable, List, Optional
+import numpy as np
+import requests
+from api_config import APIConfig
+
+logger = logging.getLogger(__name__)
+
+DTYPE = np.float32
+
+
+def to_blob(vector: np.ndarray) -> bytes:
+    """向量 -> float32 BLOB"""
+    return np.asarray(vector, dtype=DTYPE).tobytes()
+
+
+def from_blob(blob: bytes) -> np.ndarray:
+    """float32 BLOB -> 向量"""
+    return np.frombuffer(blob, dtype=DTYPE)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """按行 L2 归一化（归一化后点积即余弦相似度）"""
+    vectors = np.asarray(vectors, dtype=DTYPE)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class EmbeddingBackend:
+    """向量后端基类"""
+
+    name = 'base'
+    dim = 0
+    min_score = 0.3  # 检索时的相关度阈值（不同后端的相似度分布不同）
+    process_safe = False  # 能否发送到维护进程池中计算（纯 CPU、无模型状态和连接）
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """批量计算归一化向量，返回形状为 (len(texts), dim) 的 float32 矩阵"""
+        raise NotImplementedError
+
+    def embed_one(self, text: str) -> np.ndarray:
+        return self.embed([text])[0]
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    本地哈希向量：中文按单字和双字、英文按单词做特征哈希
+
+    不需要模型和网络，结果确定，用于测试和离线环境
+    """
+
+    min_score = 0.1
+    process_safe = True
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for token in re.findall(r'[\u4e00-\u9fa5]+|[a-zA-Z0-9]+', text.lower()):
+            if '\u4e00' <= token[0] <= '\u9fa5':
+                features.extend(token)
+                features.extend(token[i:i + 2] for i in range(len(token) - 1))
+            else:
+                features.append(token)
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=DTYPE)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode('utf-8'))
+                vectors[row, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return normalize(vectors)
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """本地 CPU 模型（sentence-transformers）"""
+
+    def __init__(self, model_name: str = None):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError('本地向量模型需要安装 sentence-transformers: pip install sentence-transformers')
+
+        model_name = model_name or 'BAAI/bge-small-zh-v1.5'
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f'local:{model_name}'
+        self._lock = threading.Lock()  # 模型推理不保证线程安全
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.dim), dtype=DTYPE)
+        with self._lock:
+            vectors = self.model.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True)
+        return np.asarray(vectors, dtype=DTYPE)
+
+
+class APIEmbeddingBackend(EmbeddingBackend):
+    """OpenAI 兼容的 /embeddings 接口（Ollama 使用 /api/embed）"""
+
+    def __init__(self, provider: str = 'openai', model: str = None, batch_size: int = None):
+        self.config = APIConfig(provider)
+        self.model = model or self.config.config.get('embedding_model')
+        if not self.model:
+            raise ValueError(f'{self.config.config["name"]} 未配置向量模型，请设置 EMBEDDING_MODEL')
+        self.batch_size = batch_size or int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+        self.name = f'{self.config.provider}:{self.model}'
+        self.dim = 0  # 第一次请求后确定
+
+    def _request(self, texts: List[str]) -> List[List[float]]:
+        try:
+            response = self.config.get_session().post(
+                self.config.get_endpoint('embedding'),
+                json={'model': self.model, 'input': texts},
+                headers=self.config.get_headers(),
+                timeout=self.config.get_timeout(),
+            )
+        except requests.RequestException as err:
+            raise RuntimeError(f'向量接口请求失败: {err}')
+
+        if response.status_code != 200:
+            raise RuntimeError(f'向量接口调用失败: {response.status_code} - {response.text[:200]}')
+
+        data = response.json()
+        if 'embeddings' in data:
+            return data['embeddings']  # Ollama
+        return [item['embedding'] for item in sorted(data['data'], key=lambda item: item.get('index', 0))]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        rows = []
+        for start in range(0, len(texts), self.batch_size):
+            rows.extend(self._request(texts[start:start + self.batch_size]))
+        if not rows:
+            return np.zeros((0, self.dim), dtype=DTYPE)
+        vectors = normalize(np.array(rows, dtype=DTYPE))
+        self.dim = vectors.shape[1]
+        return vectors
+
+
+def get_embedding_backend(backend: str = None, model: str = None) -> Optional[EmbeddingBackend]:
+    """
+    按配置创建向量后端，未配置时返回 None
+
+    Args:
+        backend: hashing / local / 提供商 ID（默认读取 EMBEDDING_BACKEND）
+        model: 模型名称（默认读取 EMBEDDING_MODEL）
+    """
+    backend = (backend if backend is not None else os.getenv('EMBEDDING_BACKEND', '')).strip().lower()
+    model = model or os.getenv('EMBEDDING_MODEL') or None
+    if not backend:
+        return None
+    if backend == 'hashing':
+        return HashingEmbeddingBackend(int(os.getenv('EMBEDDING_DIM', 256)))
+    if backend == 'local':
+        return LocalEmbeddingBackend(model)
+    if backend in APIConfig.PROVIDERS:
+        return APIEmbeddingBackend(backend, model)
+    raise ValueError(f'未知的向量后端: {backend}')
+
+
+class EmbeddingMatrix:
+    """
+    连续存储的向量矩阵
+
+    按行保存归一化向量，容量不足时成倍扩容；删除时用最后一行填补空位，
+    检索时对整个矩阵做一次点积
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024):
+        self.dim = dim
+        self._matrix = np.zeros((capacity, dim), dtype=DTYPE)
+        self._keys: List[Hashable] = []
+        self._rows: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._rows
+
+    @property
+    def keys(self) -> List[Hashable]:
+        """与 similarities() 结果按行对应的键"""
+        return self._keys
+
+    def add(self, key: Hashable, vector: np.ndarray):
+        """添加或替换一行"""
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                row = len(self._keys)
+                if row >= self._matrix.shape[0]:
+                    grown = np.zeros((self._matrix.shape[0] * 2, self.dim), dtype=DTYPE)
+                    grown[:row] = self._matrix[:row]
+                    self._matrix = grown
+                self._keys.append(key)
+                self._rows[key] = row
+            self._matrix[row] = vector
+
+    def remove(self, key: Hashable) -> bool:
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                return False
+            last = len(self._keys) - 1
+            if row != last:
+                last_key = self._keys[last]
+                self._matrix[row] = self._matrix[last]
+                self._keys[row] = last_key
+                self._rows[last_key] = row
+            self._keys.pop()
+            return True
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        row = self._rows.get(key)
+        return None if row is None else self._matrix[row]
+
+    def similarities(self, query: np.ndarray) -> np.ndarray:
+        """查询向量与每一行的余弦相似度"""
+        return self._matrix[:len(self._keys)] @ np.asarray(query, dtype=DTYPE)
+
+    def similarity_map(self, query: np.ndarray) -> Dict[Hashable, float]:
+        """{键: 相似度}"""
+        with self._lock:
+            return dict(zip(self._keys, self.similarities(query).tolist()))
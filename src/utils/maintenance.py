@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+记忆维护任务的进程池
+合并相似记忆、重新计算向量都是纯 Python 的 CPU 计算，在服务进程中执行时会长时间持有 GIL，
+同一进程中所有请求线程都要等它。这里把这类计算拆成按 Persona 分片的纯函数：
+
+    plan_merges(shard)     -> 合并计划 [(删除的记忆 ID, 保留的记忆 ID), ...]
+    plan_vectorize(shard)  -> {记忆 ID: 词频向量}（以及可选的语义向量）
+
+分片只包含计算需要的数据（ID、权重、词频向量、语义向量矩阵），可以发送到子进程执行；
+记忆管理器收到计划后在本进程中校验（期间被修改或删除的记忆跳过），一次事务写回数据库并更新缓存。
+
+MEMORY_MAINTENANCE_WORKERS=N 时使用 N 个进程的进程池（spawn 启动，不继承服务的线程和锁），
+0（默认）时在当前线程中直接计算。
+"""
+
+import os
+import re
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_WORKERS = int(os.getenv('MEMORY_MAINTENANCE_WORKERS', 0))
+
+_WORDS = re.compile(r'[\u4e00-\u9fa5]+|[a-zA-Z]+')
+
+
+def vectorize(text: str) -> Dict[str, int]:
+    """简单的文本向量化（基于词频）"""
+    # 匹配中文字符和英文单词
+    vector = {}
+    for word in _WORDS.findall(text.lower()):
+        vector[word] = vector.get(word, 0) + 1
+    return vector
+
+
+def cosine_similarity(vec1: Dict[str, int], vec2: Dict[str, int]) -> float:
+    """计算词频向量的余弦相似度"""
+    if len(vec1) > len(vec2):
+        vec1, vec2 = vec2, vec1
+    dot_product = 0
+    for key, v1 in vec1.items():
+        v2 = vec2.get(key)
+        if v2:
+            dot_product += v1 * v2
+    if not dot_product:
+        return 0
+    norm1 = sum(v * v for v in vec1.values())
+    norm2 = sum(v * v for v in vec2.values())
+    return dot_product / ((norm1 ** 0.5) * (norm2 ** 0.5))
+
+
+# ==================== 分片计算（可在子进程中执行） ====================
+
+def plan_merges(shard: Dict) -> Dict:
+    """
+    计算一个 Persona 的合并计划
+
+    两条记忆相似度超过阈值时保留权重较高的一条（相同时保留先出现的），
+    被删除记忆的一半权重加到保留的记忆上；保留的记忆继续与后面的记忆比较。
+
+    Args:
+        shard: persona_id、threshold、ids、weights、vectors（词频向量），
+               可选 embeddings（语义向量矩阵，与 ids 按行对应）和 has_embedding（每行是否有效）
+
+    Returns:
+        {'persona_id': ..., 'merges': [(删除的记忆 ID, 保留的记忆 ID), ...]}（按执行顺序）
+    """
+    ids = shard['ids']
+    weights = list(shard['weights'])
+    vectors = shard['vectors']
+    threshold = shard['threshold']
+
+    # 都有语义向量的两条记忆使用点积，其余使用词频向量的余弦相似度
+    similarities = None
+    embeddings = shard.get('embeddings')
+    if embeddings is not None and len(embeddings):
+        similarities = embeddings @ embeddings.T
+        has_embedding = shard['has_embedding']
+
+    def similarity(a: int, b: int) -> float:
+        if similarities is not None and has_embedding[a] and has_embedding[b]:
+            return float(similarities[a, b])
+        return cosine_similarity(vectors[a], vectors[b])
+
+    merges = []
+    alive = list(range(len(ids)))
+    i = 0
+    while i < len(alive):
+        a = alive[i]
+        removed = False
+        j = i + 1
+        while j < len(alive):
+            b = alive[j]
+            if similarity(a, b) > threshold:
+                if weights[a] >= weights[b]:
+                    weights[a] += weights[b] * 0.5
+                    merges.append((ids[b], ids[a]))
+                    del alive[j]
+                else:
+                    weights[b] += weights[a] * 0.5
+                    merges.append((ids[a], ids[b]))
+                    del alive[i]
+                    removed = True
+                    break
+            else:
+                j += 1
+        if not removed:
+            i += 1
+    return {'persona_id': shard['persona_id'], 'merges': merges}
+
+
+def plan_vectorize(shard: Dict) -> Dict:
+    """
+    重新计算一个 Persona 的词频向量（提供 embedder 时同时计算语义向量）
+
+    Args:
+        shard: persona_id、ids、contents，可选 embedder（可在子进程中使用的向量后端）
+
+    Returns:
+        {'persona_id': ..., 'vectors': {记忆 ID: 词频向量}, 'embeddings': 语义向量矩阵或 None}
+    """
+    contents = shard['contents']
+    embedder = shard.get('embedder')
+    return {
+        'persona_id': shard['persona_id'],
+        'vectors': {memory_id: vectorize(content) for memory_id, content in zip(shard['ids'], contents)},
+        'embeddings': embedder.embed(contents) if embedder is not None and contents else None,
+    }
+
+
+# ==================== 进程池 ====================
+
+class _InlineExecutor(Executor):
+    """在调用线程中直接执行（MEMORY_MAINTENANCE_WORKERS=0）"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+INLINE = _InlineExecutor()
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(workers: int = None) -> Executor:
+    """
+    获取维护任务使用的执行器（同一进程内共享，第一次使用时创建）
+
+    Args:
+        workers: 进程数（默认 MEMORY_MAINTENANCE_WORKERS），0 表示在当前线程中执行
+    """
+    global _executor, _executor_pid
+    workers = MAINTENANCE_WORKERS if workers is None else workers
+    if workers <= 0:
+        return INLINE
+    with _executor_lock:
+        # fork 出的子进程不能使用父进程的进程池
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_pid = os.getpid()
+            logger.info(f'[Maintenance] 已创建 {workers} 个进程的维护进程池')
+        return _executor
+
+
+def shutdown_executor():
+    """关闭进程池（等待正在执行的任务）"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = None
+
+
+atexit.register(shutdown_executor)
+
+
+def run_sharded(fn: Callable[[Dict], Dict], shards: Iterable[Dict], executor: Executor = None) -> List[Dict]:
+    """把分片提交给执行器，返回各分片的结果（执行失败的分片记录日志后跳过）"""
+    executor = executor or get_executor()
+    futures = [(shard['persona_id'], executor.submit(fn, shard)) for shard in shards]
+    results = []
+    for persona_id, future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f'[Maintenance] Persona {persona_id} 的 {fn.__name__} 失败: {e}')
+    return results
@@ -5,6 +5,7 @@ import re
 import time
 from datetime import datetime
 from typing import Dict, List, Optional
+from src.utils.metrics import RETRIEVE_SECONDS, MAINTENANCE_SECONDS
 
 
 class MemoryManager:
@@ -77,6 +78,7 @@ class MemoryManager:
         
         return memory_obj
     
+    @RETRIEVE_SECONDS.time()
     def retrieve_memories(self, persona_id: int, query: str, limit: int = 5) -> List[Dict]:
         """检索相关记忆"""
         query_vector = self.vectorize(query)
@@ -107,6 +109,7 @@ class MemoryManager:
         results.sort(key=lambda x: x['score'], reverse=True)
         return results[:limit]
     
+    @MAINTENANCE_SECONDS.labels(job='decay').time()
     def apply_decay(self):
         """应用权重衰减"""
         # 对角色记忆应用衰减
@@ -127,6 +130,7 @@ class MemoryManager:
                 updated_public.append(memory)
         self.public_memories = updated_public
     
+    @MAINTENANCE_SECONDS.labels(job='merge').time()
     def merge_similar_memories(self, persona_id: int, threshold: float = 0.8):
         """合并相似记忆"""
         if persona_id not in self.memories:
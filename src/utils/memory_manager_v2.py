@@ -6,34 +6,69 @@
 支持向量化存储、语义检索、权重衰减和数据库持久化
 """
 
-import re
+import os
 import json
 import time
 import logging
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import sys
 from pathlib import Path
+import numpy as np
 
 # 添加项目根目录到路径
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
 from database import get_db
+from src.utils.embeddings import DTYPE, EmbeddingBackend, EmbeddingMatrix, get_embedding_backend, to_blob, from_blob
+from src.utils.ann_index import ANNIndex, create_ann_index
+from src.utils.vector_store import VectorStore
+from src.utils.metrics import RETRIEVE_SECONDS, MAINTENANCE_SECONDS
+from src.utils.maintenance import vectorize, cosine_similarity, plan_merges, plan_vectorize, run_sharded
 
 logger = logging.getLogger(__name__)
 
+# 增量同步中公共记忆的变更标记（与 Persona ID 共用一个字典）
+PUBLIC_MARK = 'public'
+
 
 class MemoryManager:
     """
     记忆管理器 - 支持数据库持久化
-    使用简单的向量相似度计算（余弦相似度）
-    在实际生产环境中，应该使用专业的向量数据库（如 Pinecone, Weaviate 等）
+    默认使用词频向量的余弦相似度；配置向量后端（见 embeddings.py）后
+    使用语义向量检索，向量保存在连续矩阵中，一次点积完成相似度计算；
+    记忆数量很大时可启用近似最近邻索引（MEMORY_ANN_INDEX，见 ann_index.py）；
+    多 worker 部署时可用 MEMORY_VECTOR_STORE 让各进程共享内存映射的向量文件（见 vector_store.py）；
+    合并相似记忆、重新计算向量可通过 MEMORY_MAINTENANCE_WORKERS 放到进程池中计算（见 maintenance.py）；
+    前端轮询通过 get_memory_delta 只读取上次之后的变更（游标为各变更日志的 seq）
     """
     
-    def __init__(self, use_database: bool = True):
-        """初始化记忆管理器"""
+    def __init__(self, use_database: bool = True, embedding_backend: Optional[EmbeddingBackend] = None,
+                 db=None):
+        """
+        初始化记忆管理器
+        
+        Args:
+            use_database: 是否使用数据库持久化
+            embedding_backend: 向量后端（默认按 EMBEDDING_BACKEND 创建，未配置时不使用）
+            db: 使用的 Database（默认全局实例）
+        """
         self.use_database = use_database
-        self.db = get_db() if use_database else None
+        self.db = (db or get_db()) if use_database else None
+        
+        # 语义向量（记忆 ID -> 矩阵中的一行）
+        self.embedder = embedding_backend if embedding_backend is not None else get_embedding_backend()
+        self.embeddings = None  # EmbeddingMatrix 或共享的 VectorStore
+        self._embedded: Dict[int, Dict] = {}  # 有向量的记忆: ID -> 记忆
+        
+        # 近似最近邻索引：记忆数达到 MEMORY_ANN_MIN_SIZE 后代替精确点积
+        self.ann_kind = os.getenv('MEMORY_ANN_INDEX', '').strip().lower()
+        self.ann_min_size = int(os.getenv('MEMORY_ANN_MIN_SIZE', 20000))
+        self.ann_save_every = int(os.getenv('MEMORY_ANN_SAVE_EVERY', 500))
+        self.ann_ef = int(os.getenv('MEMORY_ANN_EF', 64))
+        self.ann_index: Optional[ANNIndex] = None
+        self._ann_changes = 0
         
         # 内存缓存（用于快速访问）
         self.memory_cache: Dict[int, List[Dict]] = {}
@@ -43,69 +78,392 @@ class MemoryManager:
         self.decay_factor = 0.95  # 权重衰减因子
         self.max_memories_per_persona = 100  # 每个角色最大记忆数
         
+        # 跨进程缓存同步：按 seq 增量读取数据库变更日志（多 worker 部署时其他进程的写入）
+        # 分片数据库每个分片有独立编号的日志，分别记录位置 {分片号: seq}
+        self.change_seqs: Dict[int, int] = {}
+        self.sync_interval = float(os.getenv('MEMORY_SYNC_INTERVAL', 1.0))
+        self.changes_keep = int(os.getenv('MEMORY_CHANGES_KEEP', 100000))
+        self._last_sync = 0.0
+        self._sync_lock = threading.Lock()
+        # 数据库写入与对应的缓存修改、应用同步到的变更互斥：
+        # 否则同步可能在写入之后、加入缓存之前读到本进程的新记忆，缓存中出现两份
+        self._cache_lock = threading.RLock()
+        
+        # 增量同步：同步变更时记录每个 Persona（以及公共记忆）最近一次变更的 seq {分片号: {persona_id: seq}}，
+        # 游标在记录起点之后且没有相关变更时不需要查询数据库
+        self.delta_limit = int(os.getenv('MEMORY_DELTA_LIMIT', 1000))
+        self._change_marks: Dict[int, Dict] = {}
+        self._marks_since: Dict[int, int] = {}
+        
         # 如果使用数据库，加载现有记忆到缓存
+        self._cache_loaded = False
         if self.use_database:
             self._load_cache()
+        self._cache_loaded = True
     
     def _load_cache(self):
         """从数据库加载记忆到缓存"""
         try:
+            # 先记下变更日志的位置，加载期间其他进程的写入会在下次同步时补上
+            self.change_seqs = {key: log.get_change_seq_range()[1] for key, log in self.db.change_logs().items()}
+            self._marks_since = dict(self.change_seqs)
+            self._change_marks = {}
             all_memories = self.db.get_memories()
             for memory in all_memories:
                 persona_id = memory['persona_id']
                 if persona_id not in self.memory_cache:
                     self.memory_cache[persona_id] = []
-                
-                # 解析向量
-                vector = json.loads(memory['vector']) if memory['vector'] else {}
-                
-                memory_obj = {
-                    'id': memory['id'],
-                    'personaId': persona_id,
-                    'content': memory['content'],
-                    'vector': vector,
-                    'weight': memory['weight'],
-                    'timestamp': memory['created_at'],
-                    'isPublic': bool(memory['is_public']),
-                    'accessCount': 0,
-                }
-                self.memory_cache[persona_id].append(memory_obj)
+                self.memory_cache[persona_id].append(self._memory_from_row(memory))
             
             logger.info(f'从数据库加载了 {len(all_memories)} 条记忆')
+            
+            if self.embedder:
+                self._load_embeddings()
         except Exception as e:
             logger.error(f'加载缓存失败: {e}')
     
+    def _memory_from_row(self, memory: Dict) -> Dict:
+        """数据库行 -> 缓存中的记忆对象"""
+        # 解析向量
+        vector = json.loads(memory['vector']) if memory['vector'] else {}
+        
+        return {
+            'id': memory['id'],
+            'personaId': memory['persona_id'],
+            'content': memory['content'],
+            'vector': vector,
+            'weight': memory['weight'],
+            'timestamp': memory['created_at'],
+            'isPublic': bool(memory['is_public']),
+            'accessCount': 0,
+        }
+    
+    def reload_cache(self):
+        """丢弃进程内缓存，重新从数据库加载"""
+        with self._cache_lock:
+            self.memory_cache = {}
+            self._embedded = {}
+            if not isinstance(self.embeddings, VectorStore):
+                self.embeddings = None
+            self.ann_index = None
+            self._cache_loaded = False
+            self._load_cache()
+            self._cache_loaded = True
+    
+    @property
+    def change_seq(self) -> int:
+        """已同步到的变更日志位置（分片数据库为各分片之和，只用于日志和统计）"""
+        return sum(self.change_seqs.values())
+    
+    def sync_changes(self) -> int:
+        """
+        应用其他进程写入的记忆变更（新增、修改、删除）
+        
+        没有新变更时每个变更日志只需一次主键上的 MIN/MAX 查询
+        
+        Returns:
+            读取的变更条数
+        """
+        if not self.use_database or not self._sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            self._last_sync = time.time()
+            count = 0
+            for key, log in self.db.change_logs().items():
+                synced = self._sync_log(key, log)
+                if synced < 0:
+                    # 需要的变更已被清理（进程落后太多），整体重新加载
+                    logger.info('[Sync] 变更日志已被清理，重新加载记忆缓存')
+                    self.reload_cache()
+                    return count - synced
+                count += synced
+            if count:
+                logger.debug(f'[Sync] 同步了 {count} 条记忆变更 (seq={self.change_seq})')
+            return count
+        except Exception as e:
+            logger.error(f'[Sync] 同步记忆变更失败: {e}')
+            return 0
+        finally:
+            self._sync_lock.release()
+    
+    def _sync_log(self, key: int, log) -> int:
+        """读取一个变更日志的新记录，返回条数（需要的记录已被清理时返回负的落后条数）"""
+        seq = self.change_seqs.get(key, 0)
+        first, last = log.get_change_seq_range()
+        if last <= seq:
+            return 0
+        if first > seq + 1:
+            return -(last - seq)
+        
+        count = 0
+        while True:
+            changes = log.get_memory_changes(seq)
+            if not changes:
+                break
+            latest = {}  # 同一条记忆只看最后一次变更
+            for change in changes:
+                latest[change['memory_id']] = change['persona_id']
+            public_ids = self._apply_changes(latest)
+            
+            # 删除的记忆可能原来是公共记忆（本进程删除时缓存中已经没有）
+            marks = self._change_marks.setdefault(key, {})
+            for change in changes:
+                marks[change['persona_id']] = change['seq']
+                if change['op'] == 'delete' or change['memory_id'] in public_ids:
+                    marks[PUBLIC_MARK] = change['seq']
+            seq = self.change_seqs[key] = changes[-1]['seq']
+            count += len(changes)
+        return count
+    
+    def _maybe_sync(self):
+        if self.use_database and time.time() - self._last_sync >= self.sync_interval:
+            self.sync_changes()
+    
+    def _apply_changes(self, changes: Dict[int, int]) -> set:
+        """按数据库当前状态更新缓存 {记忆 ID: 角色 ID}（本进程自己的写入不会重复处理），返回更新前或更新后是公共记忆的 ID"""
+        with self._cache_lock:
+            rows = {row['id']: row for row in self.db.get_memories_by_ids(changes.keys())}
+            public_ids = {memory_id for memory_id, row in rows.items() if row['is_public']}
+            for memory_id, persona_id in changes.items():
+                memories = self.memory_cache.get(persona_id, [])
+                current = next((m for m in memories if m.get('id') == memory_id), None)
+                row = rows.get(memory_id)
+                if current is not None and current['isPublic']:
+                    public_ids.add(memory_id)
+                
+                if row is None:
+                    if current is not None:
+                        memories.remove(current)
+                        self._forget_embedding(current)
+                    continue
+                
+                if current is None:
+                    current = self._memory_from_row(row)
+                    self.memory_cache.setdefault(row['persona_id'], []).append(current)
+                elif current['content'] != row['content'] or current['isPublic'] != bool(row['is_public']):
+                    current['content'] = row['content']
+                    current['vector'] = self.vectorize(row['content'])
+                    current['isPublic'] = bool(row['is_public'])
+                else:
+                    continue
+                
+                if self.embedder:
+                    self._sync_embedding(current, row)
+            return public_ids
+    
+    def _sync_embedding(self, memory: Dict, row: Dict):
+        """使用写入方保存的向量（模型不一致时重新计算）"""
+        if isinstance(self.embeddings, VectorStore) and memory['id'] in self.embeddings:
+            self._embedded[memory['id']] = memory  # 写入方已写入共享向量文件
+            return
+        if row['embedding'] is not None and row['embedding_model'] == self.embedder.name:
+            self._index_embedding(memory, from_blob(row['embedding']))
+            return
+        vectors = self._embed([memory['content']])
+        if vectors is not None:
+            self._index_embedding(memory, vectors[0])
+        else:
+            self._forget_embedding(memory)
+    
+    def _load_embeddings(self):
+        """加载已保存的向量，缺失（或由其他模型生成）的向量批量计算后写回数据库"""
+        if self.vector_store_path:
+            self._load_vector_store(self.vector_store_path)
+            if self.ann_kind and len(self.embeddings):
+                self._load_ann_index()
+            return
+
+        stored = self.db.get_memory_embeddings(self.embedder.name)
+        missing = []
+        for memories in self.memory_cache.values():
+            for memory in memories:
+                blob = stored.get(memory['id'])
+                if blob is not None:
+                    self._index_embedding(memory, from_blob(blob))
+                else:
+                    missing.append(memory)
+        
+        if missing:
+            vectors = self._embed([m['content'] for m in missing])
+            if vectors is not None:
+                for memory, vector in zip(missing, vectors):
+                    self._index_embedding(memory, vector)
+                self.db.set_memory_embeddings(
+                    [(m['id'], to_blob(v)) for m, v in zip(missing, vectors)],
+                    self.embedder.name
+                )
+        logger.info(f'已加载 {len(stored)} 条记忆向量，新计算 {len(missing)} 条 ({self.embedder.name})')
+        
+        if self.ann_kind and self.embeddings is not None:
+            self._load_ann_index()
+    
+    @property
+    def vector_store_path(self) -> Optional[str]:
+        """共享向量文件目录（MEMORY_VECTOR_STORE=1 时放在数据库文件旁边）"""
+        setting = os.getenv('MEMORY_VECTOR_STORE', '').strip()
+        if not setting or setting.lower() in ('0', 'false', 'off') or not self.use_database:
+            return None
+        if setting.lower() in ('1', 'true', 'on'):
+            if self.db.db_path == ':memory:':
+                return None
+            return str(Path(self.db.db_path).with_suffix('.vectors'))
+        return setting
+
+    def _load_vector_store(self, path: str):
+        """
+        映射共享向量文件，只为文件中缺少的记忆读取或计算向量
+
+        多个 worker 同时启动时在文件锁内依次检查，只有第一个需要写入
+        """
+        store = VectorStore(path, self.embedder.name)
+        memories = {m['id']: m for ms in self.memory_cache.values() for m in ms}
+        with store.locked():
+            if not store.compatible:
+                logger.info('[VectorStore] 向量文件与当前向量模型不一致，重建')
+                store.reset()
+
+            existing = set(store.keys)
+            missing = [m for memory_id, m in memories.items() if memory_id not in existing]
+            # 其他 worker 在本进程加载缓存之后写入的记忆不算过期
+            stale = existing - memories.keys()
+            if stale:
+                stale &= existing - self.db.get_memory_ids()
+
+            if missing:
+                stored = self.db.get_memory_embeddings(self.embedder.name)
+                vectors = {m['id']: from_blob(stored[m['id']]) for m in missing if m['id'] in stored}
+                computed = [m for m in missing if m['id'] not in stored]
+                computed_vectors = self._embed([m['content'] for m in computed])
+                if computed_vectors is not None:
+                    vectors.update(zip([m['id'] for m in computed], computed_vectors))
+                    self.db.set_memory_embeddings(
+                        [(m['id'], to_blob(v)) for m, v in zip(computed, computed_vectors)],
+                        self.embedder.name
+                    )
+                store.add_many([
+                    (memory_id, vector, memories[memory_id]['personaId'],
+                     memories[memory_id]['isPublic'], memories[memory_id]['content'])
+                    for memory_id, vector in vectors.items()
+                ])
+            for memory_id in stale:
+                store.remove(memory_id)
+            store.maybe_compact()
+
+        self.embeddings = store
+        self._embedded = {memory_id: m for memory_id, m in memories.items() if memory_id in store}
+        logger.info(f'[VectorStore] 已映射 {len(store)} 条记忆向量（代号 {store.generation}），'
+                    f'新写入 {len(missing)} 条，删除 {len(stale)} 条 ({self.embedder.name})')
+
+    @property
+    def ann_index_path(self) -> Optional[str]:
+        """索引文件保存在数据库文件旁边（内存数据库不持久化）"""
+        if not self.use_database or self.db.db_path == ':memory:':
+            return None
+        return str(Path(self.db.db_path).with_suffix('.ann'))
+    
+    def _load_ann_index(self):
+        """加载磁盘上的索引并与当前向量同步；文件不存在或模型不一致时重建"""
+        path = self.ann_index_path
+        index = None
+        if path and os.path.exists(path):
+            try:
+                index, metadata = ANNIndex.load(path)
+                if metadata.get('embedding_model') != self.embedder.name or index.dim != self.embeddings.dim:
+                    logger.info('[ANN] 索引文件与当前向量模型不一致，重建索引')
+                    index = None
+            except Exception as e:
+                logger.error(f'[ANN] 加载索引失败，重建索引: {e}')
+                index = None
+        
+        if index is None:
+            index = create_ann_index(self.ann_kind, self.embeddings.dim, ef_search=self.ann_ef)
+        
+        # 增量同步：补充缺失的向量，删除已不存在的记忆
+        current = set(self.embeddings.keys)
+        stale = [key for key in index.keys() if key not in current]
+        for key in stale:
+            index.remove(key)
+        missing = [key for key in self.embeddings.keys if key not in index]
+        started_at = time.time()
+        for key in missing:
+            index.add(key, self.embeddings.get(key))
+        
+        self.ann_index = index
+        logger.info(f'[ANN] {index.kind} 索引就绪: {len(index)} 条向量'
+                    f'（新增 {len(missing)}，删除 {len(stale)}，耗时 {time.time() - started_at:.1f}s）')
+        if missing or stale:
+            self.save_ann_index()
+    
+    def save_ann_index(self):
+        """把索引写入磁盘"""
+        path = self.ann_index_path
+        if self.ann_index is None or not path:
+            return
+        try:
+            self.ann_index.save(path, embedding_model=self.embedder.name)
+            self._ann_changes = 0
+        except Exception as e:
+            logger.error(f'[ANN] 保存索引失败: {e}')
+    
+    def _ann_changed(self):
+        self._ann_changes += 1
+        if self._ann_changes >= self.ann_save_every:
+            self.save_ann_index()
+    
+    def _embed(self, texts: List[str]):
+        """批量计算向量，失败时返回 None（调用方退回词频向量）"""
+        if not self.embedder or not texts:
+            return None
+        try:
+            return self.embedder.embed(texts)
+        except Exception as e:
+            logger.error(f'计算记忆向量失败: {e}')
+            return None
+    
+    def _index_embedding(self, memory: Dict, vector):
+        if self.embeddings is None:
+            self.embeddings = EmbeddingMatrix(len(vector))
+        # 启动时没有任何向量：第一条记忆写入时创建空索引
+        if self.ann_index is None and self.ann_kind and self._cache_loaded:
+            self.ann_index = create_ann_index(self.ann_kind, len(vector), ef_search=self.ann_ef)
+        if isinstance(self.embeddings, VectorStore):
+            self.embeddings.add(memory['id'], vector, memory['personaId'], memory['isPublic'], memory['content'])
+        else:
+            self.embeddings.add(memory['id'], vector)
+        self._embedded[memory['id']] = memory
+        if self.ann_index is not None:
+            self.ann_index.add(memory['id'], vector)
+            self._ann_changed()
+    
+    def _forget_embedding(self, memory: Dict):
+        if self.embeddings is not None and 'id' in memory:
+            self.embeddings.remove(memory['id'])
+            self._embedded.pop(memory['id'], None)
+            if self.ann_index is not None and self.ann_index.remove(memory['id']):
+                self._ann_changed()
+    
+    def _similarity(self, memory1: Dict, memory2: Dict) -> float:
+        """两条记忆的相似度（都有语义向量时使用向量点积）"""
+        if self.embeddings is not None:
+            v1 = self.embeddings.get(memory1.get('id'))
+            v2 = self.embeddings.get(memory2.get('id'))
+            if v1 is not None and v2 is not None:
+                return float(v1 @ v2)
+        return self.cosine_similarity(memory1['vector'], memory2['vector'])
+    
     def vectorize(self, text: str) -> Dict[str, int]:
         """简单的文本向量化（基于词频）"""
-        # 匹配中文字符和英文单词
-        words = re.findall(r'[\u4e00-\u9fa5]+|[a-zA-Z]+', text.lower())
-        vector = {}
-        for word in words:
-            vector[word] = vector.get(word, 0) + 1
-        return vector
+        return vectorize(text)
     
     def cosine_similarity(self, vec1: Dict[str, int], vec2: Dict[str, int]) -> float:
         """计算余弦相似度"""
-        keys = set(vec1.keys()) | set(vec2.keys())
-        dot_product = 0
-        norm1 = 0
-        norm2 = 0
-        
-        for key in keys:
-            v1 = vec1.get(key, 0)
-            v2 = vec2.get(key, 0)
-            dot_product += v1 * v2
-            norm1 += v1 * v1
-            norm2 += v2 * v2
-        
-        if norm1 == 0 or norm2 == 0:
-            return 0
-        
-        return dot_product / ((norm1 ** 0.5) * (norm2 ** 0.5))
+        return cosine_similarity(vec1, vec2)
     
     def add_memory(self, persona_id: int, memory: str, is_public: bool = False) -> Dict:
         """添加记忆"""
         vector = self.vectorize(memory)
+        embeddings = self._embed([memory])
+        embedding = embeddings[0] if embeddings is not None else None
         
         memory_obj = {
             'personaId': persona_id,
@@ -117,57 +475,137 @@ class MemoryManager:
             'accessCount': 0,
         }
         
-        # 保存到数据库
-        if self.use_database:
-            try:
-                # 将向量字典转换为 JSON 字符串
-                vector_data = vector if vector else {}
-                memory_id = self.db.add_memory(
-                    persona_id=persona_id,
-                    content=memory,
-                    vector=vector_data,  # 传递字典,数据库模块会处理序列化
-                    weight=1.0,
-                    is_public=is_public
-                )
-                memory_obj['id'] = memory_id
-                logger.info(f'记忆已保存到数据库: ID={memory_id}')
-            except Exception as e:
-                logger.error(f'保存记忆到数据库失败: {e}')
+        with self._cache_lock:
+            # 保存到数据库
+            if self.use_database:
+                try:
+                    # 将向量字典转换为 JSON 字符串
+                    vector_data = vector if vector else {}
+                    memory_id = self.db.add_memory(
+                        persona_id=persona_id,
+                        content=memory,
+                        vector=vector_data,  # 传递字典,数据库模块会处理序列化
+                        weight=1.0,
+                        is_public=is_public,
+                        embedding=to_blob(embedding) if embedding is not None else None,
+                        embedding_model=self.embedder.name if embedding is not None else None
+                    )
+                    memory_obj['id'] = memory_id
+                    logger.info(f'记忆已保存到数据库: ID={memory_id}')
+                except Exception as e:
+                    logger.error(f'保存记忆到数据库失败: {e}')
+                    memory_obj['id'] = int(time.time() * 1000000)
+            else:
                 memory_obj['id'] = int(time.time() * 1000000)
-        else:
-            memory_obj['id'] = int(time.time() * 1000000)
+            
+            if embedding is not None:
+                self._index_embedding(memory_obj, embedding)
+            self._append_to_cache(persona_id, memory_obj)
+        return memory_obj
+    
+    def add_memories(self, persona_id: int, memories: List[Tuple[str, bool]]) -> List[Dict]:
+        """
+        批量添加记忆（数据库中一次事务写入）
         
-        # 更新缓存
+        Args:
+            persona_id: 角色 ID
+            memories: (记忆内容, 是否公共) 列表
+        """
+        timestamp = datetime.now().isoformat()
+        memory_objs = [{
+            'personaId': persona_id,
+            'content': content,
+            'vector': self.vectorize(content),
+            'weight': 1.0,
+            'timestamp': timestamp,
+            'isPublic': is_public,
+            'accessCount': 0,
+        } for content, is_public in memories]
+        
+        # 一次请求计算整批向量
+        embeddings = self._embed([m['content'] for m in memory_objs])
+        
+        with self._cache_lock:
+            if self.use_database:
+                try:
+                    memory_ids = self.db.add_memories([{
+                        'persona_id': persona_id,
+                        'content': m['content'],
+                        'vector': m['vector'],
+                        'weight': m['weight'],
+                        'is_public': m['isPublic'],
+                        'embedding': to_blob(embeddings[i]) if embeddings is not None else None,
+                        'embedding_model': self.embedder.name if embeddings is not None else None,
+                    } for i, m in enumerate(memory_objs)])
+                    for memory_obj, memory_id in zip(memory_objs, memory_ids):
+                        memory_obj['id'] = memory_id
+                    logger.info(f'批量保存 {len(memory_ids)} 条记忆到数据库')
+                except Exception as e:
+                    logger.error(f'批量保存记忆到数据库失败: {e}')
+            
+            for i, memory_obj in enumerate(memory_objs):
+                if 'id' not in memory_obj:
+                    memory_obj['id'] = int(time.time() * 1000000) + i
+                if embeddings is not None:
+                    self._index_embedding(memory_obj, embeddings[i])
+                self._append_to_cache(persona_id, memory_obj)
+        
+        return memory_objs
+    
+    def _append_to_cache(self, persona_id: int, memory_obj: Dict):
+        """加入缓存并限制每个角色的记忆数量（同一 ID 已在缓存中时替换，不会出现两份）"""
         if persona_id not in self.memory_cache:
             self.memory_cache[persona_id] = []
         
-        self.memory_cache[persona_id].append(memory_obj)
+        memories = self.memory_cache[persona_id]
+        for i, memory in enumerate(memories):
+            if memory.get('id') == memory_obj['id']:
+                memories[i] = memory_obj
+                return
+        memories.append(memory_obj)
         
         # 限制记忆数量
         if len(self.memory_cache[persona_id]) > self.max_memories_per_persona:
             removed = self.memory_cache[persona_id].pop(0)
+            self._forget_embedding(removed)
             if self.use_database and 'id' in removed:
                 try:
                     self.db.delete_memory(removed['id'])
                 except Exception as e:
                     logger.error(f'删除旧记忆失败: {e}')
-        
-        return memory_obj
     
+    @RETRIEVE_SECONDS.time()
     def retrieve_memories(self, persona_id: int, query: str, limit: int = 5) -> List[Dict]:
         """检索相关记忆"""
+        self._maybe_sync()
         query_vector = self.vectorize(query)
         results = []
         
+        # 语义检索：一次点积得到所有记忆的相似度，没有向量的记忆退回词频相似度
+        semantic_scores = None
+        threshold = 0.1
+        if self.embeddings is not None and len(self.embeddings):
+            query_embedding = self._embed([query])
+            if query_embedding is not None:
+                threshold = self.embedder.min_score
+                if self.ann_index is not None and len(self.ann_index) >= self.ann_min_size:
+                    return self._retrieve_ann(persona_id, query_embedding[0], limit, threshold)
+                semantic_scores = self.embeddings.similarity_map(query_embedding[0])
+        
+        def similarity_of(memory):
+            if semantic_scores is not None and memory.get('id') in semantic_scores:
+                return semantic_scores[memory['id']]
+            return self.cosine_similarity(query_vector, memory['vector'])
+        
         # 检索角色专属记忆
         if persona_id in self.memory_cache:
             for memory in self.memory_cache[persona_id]:
                 if memory['isPublic']:
                     continue  # 公共记忆单独处理
                 
-                similarity = self.cosine_similarity(query_vector, memory['vector'])
+                similarity = similarity_of(memory)
                 score = similarity * memory['weight']
-                if score > 0.1:  # 阈值
+                if score > threshold:  # 阈值
                     result = memory.copy()
                     result['score'] = score
                     result['type'] = 'persona'
@@ -183,9 +621,9 @@ class MemoryManager:
                 if not memory['isPublic']:
                     continue
                 
-                similarity = self.cosine_similarity(query_vector, memory['vector'])
+                similarity = similarity_of(memory)
                 score = similarity * memory['weight']
-                if score > 0.1:
+                if score > threshold:
                     result = memory.copy()
                     result['score'] = score
                     result['type'] = 'public'
@@ -199,8 +637,37 @@ class MemoryManager:
         results.sort(key=lambda x: x['score'], reverse=True)
         return results[:limit]
     
+    def _retrieve_ann(self, persona_id: int, query_embedding, limit: int, threshold: float) -> List[Dict]:
+        """通过近似最近邻索引检索（只考虑本角色记忆和公共记忆）"""
+        def allowed(memory_id):
+            memory = self._embedded.get(memory_id)
+            return memory is not None and (memory['isPublic'] or memory['personaId'] == persona_id)
+        
+        # 多取一些候选，再按 相似度 × 权重 排序
+        hits = self.ann_index.search(query_embedding, max(limit * 10, 50), filter=allowed)
+        
+        results = []
+        for memory_id, similarity in hits:
+            memory = self._embedded.get(memory_id)
+            if memory is None:
+                continue
+            score = similarity * memory['weight']
+            if score > threshold:
+                result = memory.copy()
+                result['score'] = score
+                result['type'] = 'public' if memory['isPublic'] else 'persona'
+                results.append(result)
+                
+                # 增加访问计数和权重
+                memory['accessCount'] += 1
+                memory['weight'] = min(memory['weight'] + 0.1, 2.0)
+        
+        results.sort(key=lambda x: x['score'], reverse=True)
+        return results[:limit]
+    
     def get_all_memories(self, persona_id: int, include_public: bool = True) -> List[Dict]:
         """获取所有记忆（用于显示）"""
+        self._maybe_sync()
         results = []
         
         # 获取角色记忆
@@ -227,27 +694,126 @@ class MemoryManager:
         results.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
         return results
     
+    # ==================== 增量同步 ====================
+    
+    def memory_cursor(self) -> str:
+        """当前的增量同步游标：各变更日志已同步到的 seq，按分片号用 . 连接（未分片时就是 seq）"""
+        return self._format_cursor(self.change_seqs)
+    
+    def _parse_cursor(self, cursor: Optional[str]) -> Optional[Dict[int, int]]:
+        """游标 -> {分片号: seq}（格式不对或分片数不一致时返回 None）"""
+        keys = sorted(self.change_seqs)
+        try:
+            seqs = [int(part) for part in cursor.split('.')] if cursor else []
+        except ValueError:
+            return None
+        if not keys or len(seqs) != len(keys):
+            return None
+        return dict(zip(keys, seqs))
+    
+    def get_memory_delta(self, persona_id: int, since: Optional[str], include_public: bool = True) -> Optional[Dict]:
+        """
+        获取游标之后 Persona 可见记忆（自己的记忆和公共记忆）的变更
+        
+        Args:
+            persona_id: 角色 ID
+            since: 上次返回的游标（为空时返回全部记忆）
+            include_public: 是否包含其他角色的公共记忆
+        
+        Returns:
+            没有变化时返回 None，否则返回
+            {'cursor': 新游标, 'reset': 是否为全部记忆, 'upserts': 新增或修改的记忆, 'deletes': 删除的记忆 ID}
+            游标无效、需要的变更已被清理或变更超过 delta_limit 条时 reset 为 True，upserts 为全部记忆
+        """
+        if not self.use_database:
+            return self._full_delta(persona_id, include_public)
+        self._maybe_sync()
+        seqs = self._parse_cursor(since)
+        if seqs is None:
+            return self._full_delta(persona_id, include_public)
+        if any(seq > self.change_seqs[key] for key, seq in seqs.items()):
+            self.sync_changes()  # 游标来自同步得更快的其他 worker
+        target = {key: max(seq, self.change_seqs[key]) for key, seq in seqs.items()}
+        if target == seqs:
+            return None
+        
+        # 同一条记忆只看最后一次变更
+        changes = {}
+        logs = self.db.change_logs()
+        for key, after in seqs.items():
+            if after >= target[key] or not self._maybe_changed(key, persona_id, after, include_public):
+                continue
+            first, _ = logs[key].get_change_seq_range()
+            rows = logs[key].get_memory_changes(after, self.delta_limit + 1)
+            if first > after + 1 or len(rows) > self.delta_limit:
+                return self._full_delta(persona_id, include_public)
+            for row in rows:
+                if row['seq'] <= target[key]:
+                    changes[row['memory_id']] = row
+        
+        upserts, deletes = [], []
+        for memory_id, change in changes.items():
+            memory = next((m for m in self.memory_cache.get(change['persona_id'], []) if m.get('id') == memory_id), None)
+            if memory is not None and self._visible(memory, persona_id, include_public):
+                result = memory.copy()
+                result['type'] = 'public' if memory['isPublic'] else 'persona'
+                upserts.append(result)
+            elif change['persona_id'] == persona_id or change['op'] != 'insert':
+                deletes.append(memory_id)
+        upserts.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+        return {'cursor': self._format_cursor(target), 'reset': False, 'upserts': upserts, 'deletes': deletes}
+    
+    def _maybe_changed(self, key: int, persona_id: int, after: int, include_public: bool) -> bool:
+        """游标之后变更日志 key 中是否可能有 Persona 可见记忆的变更（记录起点之前的游标总是视为可能）"""
+        if after < self._marks_since.get(key, 0):
+            return True
+        marks = self._change_marks.get(key, {})
+        return marks.get(persona_id, 0) > after or (include_public and marks.get(PUBLIC_MARK, 0) > after)
+    
+    @staticmethod
+    def _visible(memory: Dict, persona_id: int, include_public: bool) -> bool:
+        if memory['personaId'] == persona_id:
+            return include_public or not memory['isPublic']
+        return include_public and memory['isPublic']
+    
+    def _format_cursor(self, seqs: Dict[int, int]) -> str:
+        return '.'.join(str(seqs[key]) for key in sorted(seqs))
+    
+    def _full_delta(self, persona_id: int, include_public: bool) -> Dict:
+        cursor = self.memory_cursor()  # 先取游标：之后的变更下次会再发送一次
+        return {'cursor': cursor, 'reset': True, 'upserts': self.get_all_memories(persona_id, include_public),
+                'deletes': []}
+    
     def update_memory(self, memory_id: int, content: str = None) -> bool:
         """更新记忆内容"""
+        self.sync_changes()  # 记忆可能由其他进程写入
         try:
             if self.use_database:
-                if content:
-                    vector = self.vectorize(content)
-                    vector_data = vector if vector else {}
-                    self.db.update_memory(
-                        memory_id=memory_id,
-                        content=content,
-                        vector=vector_data
-                    )
-                
-                # 更新缓存
-                for persona_id, memories in self.memory_cache.items():
-                    for memory in memories:
-                        if memory.get('id') == memory_id:
-                            if content:
-                                memory['content'] = content
-                                memory['vector'] = self.vectorize(content)
-                            return True
+                embeddings = self._embed([content]) if content else None
+                with self._cache_lock:
+                    if content:
+                        vector = self.vectorize(content)
+                        vector_data = vector if vector else {}
+                        self.db.update_memory(
+                            memory_id=memory_id,
+                            content=content,
+                            vector=vector_data,
+                            embedding=to_blob(embeddings[0]) if embeddings is not None else None,
+                            embedding_model=self.embedder.name if embeddings is not None else None
+                        )
+                    
+                    # 更新缓存
+                    for persona_id, memories in self.memory_cache.items():
+                        for memory in memories:
+                            if memory.get('id') == memory_id:
+                                if content:
+                                    memory['content'] = content
+                                    memory['vector'] = self.vectorize(content)
+                                    if embeddings is not None:
+                                        self._index_embedding(memory, embeddings[0])
+                                    else:
+                                        self._forget_embedding(memory)
+                                return True
             
             return False
         except Exception as e:
@@ -256,23 +822,26 @@ class MemoryManager:
     
     def delete_memory(self, memory_id: int) -> bool:
         """删除记忆"""
-        try:
-            if self.use_database:
-                self.db.delete_memory(memory_id)
-            
-            # 从缓存中删除
-            for persona_id, memories in self.memory_cache.items():
-                for i, memory in enumerate(memories):
-                    if memory.get('id') == memory_id:
-                        memories.pop(i)
-                        logger.info(f'记忆已删除: ID={memory_id}')
-                        return True
-            
-            return False
-        except Exception as e:
-            logger.error(f'删除记忆失败: {e}')
-            return False
+        self.sync_changes()  # 记忆可能由其他进程写入
+        with self._cache_lock:
+            try:
+                if self.use_database:
+                    self.db.delete_memory(memory_id)
+                
+                # 从缓存中删除
+                for persona_id, memories in self.memory_cache.items():
+                    for i, memory in enumerate(memories):
+                        if memory.get('id') == memory_id:
+                            self._forget_embedding(memories.pop(i))
+                            logger.info(f'记忆已删除: ID={memory_id}')
+                            return True
+                
+                return False
+            except Exception as e:
+                logger.error(f'删除记忆失败: {e}')
+                return False
     
+    @MAINTENANCE_SECONDS.labels(job='decay').time()
     def apply_decay(self):
         """应用权重衰减"""
         logger.info('开始应用权重衰减...')
@@ -290,61 +859,174 @@ class MemoryManager:
         
         # 删除权重过低的记忆
         removed_count = 0
-        for persona_id, memories in list(self.memory_cache.items()):
-            to_remove = []
-            for i, memory in enumerate(memories):
-                if memory['weight'] < 0.1:
-                    to_remove.append(i)
-                    if self.use_database and 'id' in memory:
-                        try:
-                            self.db.delete_memory(memory['id'])
-                        except Exception as e:
-                            logger.error(f'删除低权重记忆失败: {e}')
+        with self._cache_lock:
+            for persona_id, memories in list(self.memory_cache.items()):
+                to_remove = []
+                for i, memory in enumerate(memories):
+                    if memory['weight'] < 0.1:
+                        to_remove.append(i)
+                        if self.use_database and 'id' in memory:
+                            try:
+                                self.db.delete_memory(memory['id'])
+                            except Exception as e:
+                                logger.error(f'删除低权重记忆失败: {e}')
+                
+                # 从后向前删除，避免索引错乱
+                for i in reversed(to_remove):
+                    self._forget_embedding(memories.pop(i))
+                    removed_count += 1
             
-            # 从后向前删除，避免索引错乱
-            for i in reversed(to_remove):
-                memories.pop(i)
-                removed_count += 1
-        
         logger.info(f'权重衰减完成，删除了 {removed_count} 条低权重记忆')
+        
+        if self._ann_changes:
+            self.save_ann_index()
+        if isinstance(self.embeddings, VectorStore):
+            self.embeddings.maybe_compact()
+        if self.use_database:
+            try:
+                self.db.prune_memory_changes(self.changes_keep)
+            except Exception as e:
+                logger.error(f'清理记忆变更日志失败: {e}')
     
-    def merge_similar_memories(self, threshold: float = 0.8):
-        """合并相似记忆"""
-        logger.info('开始合并相似记忆...')
-        merged_count = 0
+    @MAINTENANCE_SECONDS.labels(job='merge').time()
+    def merge_similar_memories(self, threshold: float = 0.8, executor=None) -> int:
+        """
+        合并相似记忆
         
-        for persona_id, memories in self.memory_cache.items():
-            i = 0
-            while i < len(memories):
-                j = i + 1
-                while j < len(memories):
-                    similarity = self.cosine_similarity(memories[i]['vector'], memories[j]['vector'])
-                    
-                    if similarity > threshold:
-                        # 合并记忆：保留权重较高的，删除另一个
-                        if memories[i]['weight'] >= memories[j]['weight']:
-                            to_remove = memories.pop(j)
-                            memories[i]['weight'] += to_remove['weight'] * 0.5
-                        else:
-                            to_remove = memories.pop(i)
-                            memories[j]['weight'] += to_remove['weight'] * 0.5
-                            i -= 1
-                            break
-                        
-                        # 从数据库删除
-                        if self.use_database and 'id' in to_remove:
-                            try:
-                                self.db.delete_memory(to_remove['id'])
-                            except Exception as e:
-                                logger.error(f'删除合并记忆失败: {e}')
-                        
-                        merged_count += 1
-                    else:
-                        j += 1
-                
-                i += 1
+        按 Persona 分片计算合并计划（MEMORY_MAINTENANCE_WORKERS > 0 时在进程池中计算，不占用本进程的 GIL），
+        再一次事务删除被合并的记忆并更新保留记忆的权重；计算期间被修改或删除的记忆不参与合并。
         
+        Args:
+            threshold: 相似度阈值
+            executor: 执行器（默认见 maintenance.get_executor）
+        
+        Returns:
+            合并的记忆对数
+        """
+        logger.info('开始合并相似记忆...')
+        snapshot = {}  # 记忆 ID -> (记忆对象, 计算时的词频向量)
+        shards = []
+        for persona_id, memories in list(self.memory_cache.items()):
+            memories = [m for m in memories if 'id' in m]
+            if len(memories) < 2:
+                continue
+            shard = {
+                'persona_id': persona_id,
+                'threshold': threshold,
+                'ids': [m['id'] for m in memories],
+                'weights': [m['weight'] for m in memories],
+                'vectors': [m['vector'] for m in memories],
+            }
+            if self.embeddings is not None:
+                vectors = [self.embeddings.get(m['id']) for m in memories]
+                if any(v is not None for v in vectors):
+                    dim = next(len(v) for v in vectors if v is not None)
+                    shard['has_embedding'] = [v is not None for v in vectors]
+                    shard['embeddings'] = np.array([v if v is not None else np.zeros(dim) for v in vectors],
+                                                   dtype=DTYPE)
+            snapshot.update((m['id'], (m, m['vector'])) for m in memories)
+            shards.append(shard)
+        
+        plans = run_sharded(plan_merges, shards, executor)
+        merged_count = self._apply_merge_plans(plans, snapshot)
         logger.info(f'记忆合并完成，合并了 {merged_count} 对相似记忆')
+        return merged_count
+    
+    def _unchanged(self, snapshot: Dict[int, Tuple[Dict, Dict]]) -> set:
+        """快照中仍在缓存里且内容没有变化的记忆 ID（更新内容时会替换词频向量）"""
+        cached = {id(m) for memories in list(self.memory_cache.values()) for m in memories}
+        return {memory_id for memory_id, (memory, vector) in snapshot.items()
+                if id(memory) in cached and memory['vector'] is vector}
+    
+    def _apply_merge_plans(self, plans: List[Dict], snapshot: Dict[int, Tuple[Dict, Dict]]) -> int:
+        """校验合并计划并应用到缓存和数据库（数据库一次事务）"""
+        unchanged = self._unchanged(snapshot)
+        removed = {}   # 记忆 ID -> 记忆
+        kept = {}      # 记忆 ID -> 记忆（权重有变化）
+        for plan in plans:
+            for removed_id, kept_id in plan['merges']:
+                if removed_id not in unchanged or kept_id not in unchanged or kept_id in removed:
+                    continue
+                memory, keeper = snapshot[removed_id][0], snapshot[kept_id][0]
+                keeper['weight'] += memory['weight'] * 0.5
+                removed[removed_id] = memory
+                kept[kept_id] = keeper
+        if not removed:
+            return 0
+        
+        with self._cache_lock:
+            if self.use_database:
+                try:
+                    self.db.apply_memory_plan(
+                        list(removed),
+                        {memory_id: m['weight'] for memory_id, m in kept.items() if memory_id not in removed}
+                    )
+                except Exception as e:
+                    logger.error(f'保存记忆合并结果失败: {e}')
+            
+            # 替换列表而不是原地删除，检索线程可以继续遍历旧列表
+            for persona_id in {m['personaId'] for m in removed.values()}:
+                self.memory_cache[persona_id] = [m for m in self.memory_cache.get(persona_id, [])
+                                                 if m.get('id') not in removed]
+            for memory in removed.values():
+                self._forget_embedding(memory)
+        return len(removed)
+    
+    @MAINTENANCE_SECONDS.labels(job='revectorize').time()
+    def revectorize_memories(self, executor=None) -> int:
+        """
+        重新计算所有记忆的词频向量（向量后端可以在子进程中使用时同时重新计算语义向量），
+        按 Persona 分片计算后一次事务写回数据库；计算期间内容被修改或删除的记忆跳过
+        
+        Args:
+            executor: 执行器（默认见 maintenance.get_executor）
+        
+        Returns:
+            更新的记忆数
+        """
+        embedder = self.embedder if self.embedder is not None and self.embedder.process_safe else None
+        snapshot = {}
+        shards = []
+        for persona_id, memories in list(self.memory_cache.items()):
+            memories = [m for m in memories if 'id' in m]
+            if not memories:
+                continue
+            shards.append({
+                'persona_id': persona_id,
+                'ids': [m['id'] for m in memories],
+                'contents': [m['content'] for m in memories],
+                'embedder': embedder,
+            })
+            snapshot.update((m['id'], (m, m['vector'])) for m in memories)
+        
+        results = run_sharded(plan_vectorize, shards, executor)
+        unchanged = self._unchanged(snapshot)
+        updated = []  # (记忆, 词频向量, 语义向量)
+        for result in results:
+            embeddings = result['embeddings']
+            for row, (memory_id, vector) in enumerate(result['vectors'].items()):
+                if memory_id in unchanged:
+                    updated.append((snapshot[memory_id][0], vector,
+                                    embeddings[row] if embeddings is not None else None))
+        
+        if self.use_database and updated:
+            try:
+                self.db.set_memory_vectors(
+                    [(m['id'], vector) for m, vector, _ in updated],
+                    [(m['id'], to_blob(e)) for m, _, e in updated if e is not None],
+                    embedder.name if embedder is not None else None
+                )
+            except Exception as e:
+                logger.error(f'保存记忆向量失败: {e}')
+        
+        for memory, vector, embedding in updated:
+            memory['vector'] = vector
+            if embedding is not None:
+                if self.ann_index is not None:
+                    self.ann_index.remove(memory['id'])
+                self._index_embedding(memory, embedding)
+        logger.info(f'重新计算了 {len(updated)} 条记忆的向量')
+        return len(updated)
     
     def export_memories(self) -> Dict:
         """导出所有记忆"""
@@ -360,7 +1042,7 @@ class MemoryManager:
         """导入记忆数据"""
         if self.use_database:
             self.db.import_data(data)
-            self._load_cache()
+            self.reload_cache()
         else:
             if 'memories' in data:
                 self.memory_cache = data['memories']
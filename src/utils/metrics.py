@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+进程内指标注册表（Prometheus 文本格式，无第三方依赖）
+各模块在导入时定义自己的指标，服务的 /metrics 接口调用 REGISTRY.render() 输出：
+
+    DB_SECONDS = Histogram('sqlite_method_seconds', 'Database 方法耗时', ['method'])
+    with DB_SECONDS.labels(method='get_memories').time():
+        ...
+
+    REQUESTS = Counter('cache_requests_total', '缓存命中', ['cache', 'result'])
+    REQUESTS.labels(cache='summary', result='hit').inc()
+
+    REGISTRY.gauge_callback('memory_count', '每个角色的记忆数', lambda: {('1',): 42}, ['persona_id'])
+
+引用某个应用实例状态的回调指标注册到该应用自己的 Registry（同名指标后注册的会替换先注册的），
+/metrics 输出 REGISTRY.render() + 应用注册表的 render()
+
+多 worker 部署时每个进程有独立的注册表（抓取时按实例区分）
+"""
+
+import time
+import math
+import threading
+import functools
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """指标基类：按标签值保存子指标"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **labels):
+        """按标签值获取子指标"""
+        if labels:
+            values = tuple(str(labels[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} 需要标签 {self.labelnames}')
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        """没有标签的指标直接使用唯一的子指标"""
+        return self.labels()
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        return [f'{name}{_format_labels(labelnames, values)} {_format_value(self.value)}']
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value: float):
+        with self._lock:
+            self.value = float(value)
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def inc(self, amount: float = 1):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default().dec(amount)
+
+
+class CallbackGauge(_Metric):
+    """抓取时调用 callback 取值：返回数值，或 {标签值元组: 数值}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable, labelnames: Sequence[str] = (),
+                 registry=None):
+        self.callback = callback
+        super().__init__(name, documentation, labelnames, registry)
+
+    def collect(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        try:
+            values = self.callback()
+        except Exception as e:
+            return lines + [f'# 取值失败: {_escape(e)}']
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            labels = tuple(str(v) for v in (labels if isinstance(labels, tuple) else (labels,)))
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(float(value))}')
+        return lines
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """记录代码块的耗时（秒）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f'{name}_bucket{_format_labels(labelnames, values, le)} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}')
+        lines.append(f'{name}_count{_format_labels(labelnames, values)} {count}')
+        return lines
+
+
+class Histogram(_Metric):
+    """分桶直方图（累计计数、总和、次数）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS, registry=None):
+        buckets = tuple(sorted(buckets))
+        if buckets[-1] != math.inf:
+            buckets += (math.inf,)
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        """注册指标（同名指标后注册的替换先注册的，便于重新加载模块）"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def clear(self):
+        """注销所有指标"""
+        with self._lock:
+            self._metrics.clear()
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable,
+                       labelnames: Sequence[str] = ()) -> CallbackGauge:
+        return CallbackGauge(name, documentation, callback, labelnames, registry=self)
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def instrument_methods(histogram: Histogram, exclude: Iterable[str] = ()):
+    """
+    类装饰器：记录每个公开方法的耗时（标签 method=方法名）
+
+    用法:
+        @instrument_methods(DB_SECONDS, exclude=('close',))
+        class Database: ...
+    """
+    exclude = set(exclude)
+
+    def wrap(name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.labels(method=name).observe(time.perf_counter() - started)
+        return wrapper
+
+    def decorate(cls):
+        for name, func in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not callable(func):
+                continue
+            setattr(cls, name, wrap(name, func))
+        return cls
+    return decorate
+
+
+# ==================== 跨模块共享的指标 ====================
+
+CACHE_REQUESTS = Counter('cache_requests_total', '缓存访问次数（result=hit/miss）', ['cache', 'result'])
+
+RETRIEVE_SECONDS = Histogram('memory_retrieve_seconds', '记忆检索耗时（秒）')
+MAINTENANCE_SECONDS = Histogram('memory_maintenance_seconds', '记忆维护任务耗时（秒）', ['job'],
+                                buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900))
+
+LLM_TTFT_SECONDS = Histogram('llm_time_to_first_token_seconds', '上游 LLM 首个 token 的延迟', ['provider'])
+LLM_STREAM_SECONDS = Histogram('llm_stream_duration_seconds', '上游 LLM 流式响应总时长', ['provider', 'status'])
+
+
+class StreamTimer:
+    """
+    记录一次上游流式调用的首 token 延迟和总时长
+
+    started_at 应取发起请求之前的 time.monotonic()
+    """
+
+    def __init__(self, provider: str, started_at: float = None):
+        self.provider = provider
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self._finished = False
+
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            LLM_TTFT_SECONDS.labels(provider=self.provider).observe(self.first_token_at - self.started_at)
+
+    def finish(self, status: str = 'ok'):
+        if not self._finished:
+            self._finished = True
+            LLM_STREAM_SECONDS.labels(provider=self.provider, status=status).observe(
+                time.monotonic() - self.started_at)
+
+
+def track_stream(chunks: Iterable[bytes], provider: str, started_at: float = None) -> Iterator[bytes]:
+    """包装上游输出的迭代器，记录首 token 延迟和流式总时长"""
+    timer = StreamTimer(provider, started_at)
+    status = 'error'
+    try:
+        for chunk in chunks:
+            if chunk:
+                timer.first_token()
+            yield chunk
+        status = 'ok'
+    except GeneratorExit:
+        status = 'aborted'  # 客户端断开
+        raise
+    finally:
+        timer.finish(status)
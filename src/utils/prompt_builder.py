@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+聊天提示词组装
+按 token 预算组装发送给 LLM 的消息列表：
+  1. 固定前缀：Persona 描述 + 回复指令（每轮相同，便于提供商侧的前缀缓存）
+  2. 对话摘要：较早对话的滚动摘要（只在摘要更新时变化，见 conversation_summary.py）
+  3. 对话历史：按预算保留最近的消息，起点按固定步长移动，避免每轮都改变前缀
+  4. 动态上下文：本轮检索到的记忆（每轮不同，放在历史之后）
+  5. 用户本轮消息
+
+token 数按字符估算：CJK 字符约 1 token/字，其他文本约 4 字符/token
+"""
+
+import os
+import re
+import math
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INSTRUCTION = '请根据以上信息和记忆，自然地回应用户。'
+
+# CJK 统一表意文字、扩展 A、兼容表意文字、日文假名、全角标点
+_CJK_PATTERN = re.compile('[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def estimate_messages_tokens(messages: List[Dict]) -> int:
+    """估算消息列表的 token 数"""
+    return sum(estimate_tokens(m.get('content', '')) + MESSAGE_OVERHEAD for m in messages)
+
+
+def truncate_to_tokens(text: str, max_tokens: int, suffix: str = '…') -> str:
+    """把文本截断到 max_tokens 以内（保留开头）"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - estimate_tokens(suffix))
+    used = 0
+    for i, char in enumerate(text):
+        used += 1 if _CJK_PATTERN.match(char) else 0.25
+        if used > budget:
+            return text[:i] + suffix
+    return text
+
+
+class PromptBuilder:
+    """按 token 预算组装聊天消息"""
+
+    def __init__(self, max_tokens: int = None, memory_tokens: int = None,
+                 summary_tokens: int = None, message_tokens: int = None, max_history: int = None,
+                 history_step: int = None, instruction: str = DEFAULT_INSTRUCTION):
+        """
+        初始化提示词组装器
+
+        Args:
+            max_tokens: 整个提示词的 token 预算
+            memory_tokens: 记忆上下文的 token 预算
+            summary_tokens: 对话摘要的 token 预算
+            message_tokens: 单条历史消息的 token 上限（超出时截断）
+            max_history: 最多保留的历史消息条数
+            history_step: 历史起点移动的步长（条），越大前缀越稳定
+            instruction: 固定的回复指令
+        """
+        self.max_tokens = max_tokens or int(os.getenv('PROMPT_MAX_TOKENS', 3000))
+        self.memory_tokens = memory_tokens or int(os.getenv('PROMPT_MEMORY_TOKENS', 600))
+        self.summary_tokens = summary_tokens or int(os.getenv('PROMPT_SUMMARY_TOKENS', 400))
+        self.message_tokens = message_tokens or int(os.getenv('PROMPT_MESSAGE_TOKENS', 500))
+        self.max_history = max_history or int(os.getenv('PROMPT_MAX_HISTORY', 20))
+        self.history_step = history_step or int(os.getenv('PROMPT_HISTORY_STEP', 4))
+        self.instruction = instruction
+
+    def build_prefix(self, persona_description: str) -> str:
+        """固定前缀：只依赖 Persona，不包含任何每轮变化的内容"""
+        description = (persona_description or '').strip()
+        return f'{description}\n\n{self.instruction}' if description else self.instruction
+
+    def build_memory_context(self, memories: List[Dict]) -> str:
+        """把检索到的记忆格式化为上下文，超出预算的记忆被舍弃"""
+        if not memories:
+            return ''
+
+        header = '相关记忆：'
+        lines = []
+        used = estimate_tokens(header)
+        for m in memories:
+            line = f"- {m['content']} ({'角色记忆' if m.get('type') == 'persona' else '公共记忆'})"
+            line = truncate_to_tokens(line, self.message_tokens)
+            cost = estimate_tokens(line) + 1
+            if used + cost > self.memory_tokens:
+                break
+            lines.append(line)
+            used += cost
+
+        if not lines:
+            return ''
+        return header + '\n' + '\n'.join(lines)
+
+    def select_history(self, history: List[Dict], budget: int) -> List[Dict]:
+        """
+        选取放入提示词的历史消息
+
+        起点只在 history_step 的整数倍上移动：历史增长时前缀保持不变，
+        直到超出预算才整体向后跳一步
+        """
+        total = len(history)
+        start = max(0, total - self.max_history)
+        start = (start + self.history_step - 1) // self.history_step * self.history_step
+
+        messages = [
+            {'role': m['role'], 'content': truncate_to_tokens(m.get('content', ''), self.message_tokens)}
+            for m in history
+        ]
+        costs = [estimate_tokens(m['content']) + MESSAGE_OVERHEAD for m in messages]
+
+        while start < total and sum(costs[start:]) > budget:
+            start += self.history_step
+        selected = messages[start:]
+
+        # 历史需要从用户消息开始（部分提供商要求 user / assistant 交替）
+        while selected and selected[0]['role'] != 'user':
+            selected = selected[1:]
+        return selected
+
+    def build(self, persona_description: str, message: str,
+              history: Optional[List[Dict]] = None,
+              memories: Optional[List[Dict]] = None,
+              summary: str = '') -> List[Dict]:
+        """
+        组装消息列表
+
+        Args:
+            persona_description: Persona 描述
+            message: 用户本轮消息
+            history: 之前的对话 [{'role', 'content', ...}]（已并入摘要的消息不应包含在内）
+            memories: 检索到的相关记忆
+            summary: 较早对话的滚动摘要
+
+        Returns:
+            发送给 LLM 的消息列表
+        """
+        messages = [{'role': 'system', 'content': self.build_prefix(persona_description)}]
+        if summary:
+            messages.append({
+                'role': 'system',
+                'content': '之前的对话摘要：\n' + truncate_to_tokens(summary, self.summary_tokens),
+            })
+        user_message = {'role': 'user', 'content': message}
+
+        memory_context = self.build_memory_context(memories)
+        context_messages = [{'role': 'system', 'content': memory_context}] if memory_context else []
+
+        used = estimate_messages_tokens(messages + context_messages + [user_message])
+        messages += self.select_history(history or [], self.max_tokens - used)
+        messages += context_messages
+        messages.append(user_message)
+
+        logger.debug(f'[Prompt] {len(messages)} 条消息, 约 {estimate_messages_tokens(messages)} tokens')
+        return messages
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLite 语句统计与慢查询日志
+
+通过 sqlite3.connect(factory=TimedConnection) 接入，不需要改动各处的 cursor.execute 调用：
+    每条语句（空白归一化，IN (?, ?, ...) 合并为一类）的执行次数、总耗时、最大耗时和延迟分桶
+    超过阈值的语句记录到慢查询日志，并附带 EXPLAIN QUERY PLAN（按语句缓存）
+    COMMIT / ROLLBACK 单独统计（包含落盘时间，with conn: 块的提交同样计入）
+
+一条语句的耗时 = execute() + 之后在同一游标上 fetch（或直接迭代游标）的时间，
+在游标再次 execute、结果取完、close() 或被回收时计入统计。
+每条语句和每行结果都经过 Python 包装，有额外开销，默认关闭（见 database.py 的 DB_QUERY_STATS）。
+"""
+
+import re
+import time
+import logging
+import threading
+import sqlite3
+from collections import deque
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# 延迟分桶（毫秒）
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+
+# 只对这些语句执行 EXPLAIN QUERY PLAN
+_EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE', 'WITH')
+
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+
+
+def normalize_sql(sql: str) -> str:
+    """归一化语句：合并空白，IN (?, ?, ...) 视为同一语句"""
+    return _IN_LIST.sub('IN (?, ...)', ' '.join(sql.split()))
+
+
+class _StatementStats:
+    __slots__ = ('count', 'total', 'max', 'rows', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS_MS)
+
+    def observe(self, elapsed_ms: float, rows: int):
+        self.count += 1
+        self.total += elapsed_ms
+        self.max = max(self.max, elapsed_ms)
+        self.rows += rows
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, q: float) -> float:
+        """按分桶估计分位数（返回所在桶的上界，最后一桶返回最大值）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class QueryStats:
+    """
+    语句统计
+
+    参数:
+        slow_ms: 慢查询阈值（毫秒），None 表示不记录慢查询
+        explain: 慢查询是否附带 EXPLAIN QUERY PLAN
+        max_statements: 最多单独统计多少种语句（其余计入 '<other>'）
+        slow_log_size: 保留最近多少条慢查询
+    """
+
+    def __init__(self, slow_ms: Optional[float] = 100.0, explain: bool = True,
+                 max_statements: int = 500, slow_log_size: int = 100):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.max_statements = max_statements
+        self._statements: Dict[str, _StatementStats] = {}
+        self._keys: Dict[str, str] = {}  # 原始语句 -> 归一化语句
+        self._plans: Dict[str, str] = {}
+        self._slow = deque(maxlen=slow_log_size)
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, elapsed: float, rows: int = 0, conn: sqlite3.Connection = None, params=()):
+        """记录一条语句的耗时（秒）"""
+        key = self._keys.get(sql)
+        if key is None:
+            key = normalize_sql(sql)
+            if len(self._keys) < self.max_statements * 4:
+                self._keys[sql] = key
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            stats = self._statements.get(key)
+            if stats is None:
+                if len(self._statements) >= self.max_statements:
+                    key = '<other>'
+                stats = self._statements.setdefault(key, _StatementStats())
+            stats.observe(elapsed_ms, rows)
+
+        if self.slow_ms is not None and elapsed_ms >= self.slow_ms:
+            plan = self._query_plan(key, sql, params, conn)
+            with self._lock:
+                self._slow.append({'sql': key, 'ms': round(elapsed_ms, 3), 'rows': rows,
+                                   'plan': plan, 'at': time.time()})
+            logger.warning(f'[SlowQuery] {elapsed_ms:.1f}ms rows={rows} {key}' + (f'\n  plan: {plan}' if plan else ''))
+
+    def _query_plan(self, key: str, sql: str, params, conn) -> str:
+        if not self.explain or conn is None or not key.lstrip('( ').upper().startswith(_EXPLAINABLE):
+            return ''
+        plan = self._plans.get(key)
+        if plan is None:
+            try:
+                # 用普通游标执行，避免计入统计
+                rows = sqlite3.Cursor(conn).execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+                plan = '; '.join(str(row[-1]) for row in rows)
+            except sqlite3.Error as e:
+                plan = f'EXPLAIN 失败: {e}'
+            self._plans[key] = plan
+        return plan
+
+    def snapshot(self, limit: int = None, sort: str = 'total_ms') -> Dict:
+        """
+        统计快照
+
+        返回:
+            statements: 每种语句的 count / total_ms / avg_ms / max_ms / p50_ms / p95_ms / p99_ms / rows（按 sort 降序）
+            slow_queries: 最近的慢查询（新的在前）
+        """
+        with self._lock:
+            statements = [{
+                'sql': sql,
+                'count': stats.count,
+                'total_ms': round(stats.total, 3),
+                'avg_ms': round(stats.total / stats.count, 3) if stats.count else 0.0,
+                'max_ms': round(stats.max, 3),
+                'p50_ms': round(stats.percentile(0.5), 3),
+                'p95_ms': round(stats.percentile(0.95), 3),
+                'p99_ms': round(stats.percentile(0.99), 3),
+                'rows': stats.rows,
+            } for sql, stats in self._statements.items()]
+            slow = list(self._slow)[::-1]
+        statements.sort(key=lambda s: s[sort], reverse=True)
+        return {
+            'slow_threshold_ms': self.slow_ms,
+            'statements': statements[:limit] if limit else statements,
+            'slow_queries': slow,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._slow.clear()
+
+
+class TimedCursor(sqlite3.Cursor):
+    """记录每条语句耗时（execute + fetch）的游标"""
+
+    _sql = None
+
+    def _complete(self):
+        sql = self._sql
+        if sql is not None:
+            self._sql = None
+            stats = getattr(self.connection, 'query_stats', None)
+            if stats is not None:
+                rows = self._rows if self._rows else max(self.rowcount, 0)
+                stats.record(sql, self._elapsed, rows, self.connection, self._params)
+
+    def execute(self, sql, parameters=()):
+        if self._sql is not None:
+            self._complete()
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._elapsed = time.perf_counter() - started
+            self._sql, self._params, self._rows = sql, parameters, 0
+
+    def executemany(self, sql, seq_of_parameters):
+        if self._sql is not None:
+            self._complete()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._elapsed = time.perf_counter() - started
+            # EXPLAIN 使用第一组参数
+            first = seq_of_parameters[0] if isinstance(seq_of_parameters, (list, tuple)) and seq_of_parameters else ()
+            self._sql, self._params, self._rows = sql, first, 0
+
+    def _fetch(self, call, done):
+        if self._sql is None:
+            return call()
+        started = time.perf_counter()
+        result = call()
+        self._elapsed += time.perf_counter() - started
+        if done(result):
+            self._complete()
+        return result
+
+    def fetchone(self):
+        row = self._fetch(super().fetchone, lambda row: row is None)
+        if row is not None and self._sql is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._fetch(lambda: super(TimedCursor, self).fetchmany(size), lambda rows: len(rows) < size)
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        if self._sql is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        self._complete()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._sql is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += time.perf_counter() - started
+            self._complete()
+            raise
+        self._elapsed += time.perf_counter() - started
+        self._rows += 1
+        return row
+
+    def close(self):
+        self._complete()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._complete()
+        except Exception:
+            pass
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3.connect(factory=TimedConnection) 创建的连接，设置 query_stats 后开始统计"""
+
+    query_stats: Optional[QueryStats] = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            if self.query_stats is not None:
+                self.query_stats.record('COMMIT', time.perf_counter() - started)
+
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            if self.query_stats is not None:
+                self.query_stats.record('ROLLBACK', time.perf_counter() - started)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # sqlite3.Connection 的 with 块在 C 中直接提交/回滚，不经过上面的 commit()/rollback()
+        if exc_type is not None:
+            self.rollback()
+            return False
+        try:
+            self.commit()
+        except Exception:
+            self.rollback()
+            raise
+        return False
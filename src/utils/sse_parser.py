@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SSE 流解析与转发
+直接在原始字节上增量解析 Server-Sent Events，避免逐行解码和重复编码；
+安装了 orjson 时使用 orjson 解析 JSON
+"""
+
+import json
+import logging
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+    json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+DONE_MARKER = b'[DONE]'
+
+
+class SSEParser:
+    """
+    增量 SSE 解析器
+
+    feed() 接收任意切分的字节块，返回已完整的事件列表 [(原始帧, data 字段), ...]
+    """
+
+    def __init__(self):
+        self._buffer = b''
+        self._frame_lines: List[bytes] = []
+        self._data_lines: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[Tuple[bytes, bytes]]:
+        """解析一个字节块"""
+        events = []
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()  # 最后一段可能不完整
+
+        for line in lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+
+            if not line:
+                # 空行表示一个事件结束
+                if self._data_lines:
+                    events.append(self._dispatch())
+                else:
+                    self._frame_lines = []
+                continue
+
+            self._frame_lines.append(line)
+            if line.startswith(b'data:'):
+                value = line[5:]
+                if value.startswith(b' '):
+                    value = value[1:]
+                self._data_lines.append(value)
+            # 注释行（:）以及 event/id/retry 字段只保留在原始帧中
+
+        return events
+
+    def flush(self) -> List[Tuple[bytes, bytes]]:
+        """流结束时输出未以空行结尾的最后一个事件"""
+        if self._buffer:
+            events = self.feed(b'\n\n')
+        else:
+            events = self.feed(b'\n')
+        self._buffer = b''
+        return events
+
+    def _dispatch(self) -> Tuple[bytes, bytes]:
+        frame = b'\n'.join(self._frame_lines) + b'\n\n'
+        data = b'\n'.join(self._data_lines)
+        self._frame_lines = []
+        self._data_lines = []
+        return frame, data
+
+
+class NDJSONParser:
+    """
+    增量 NDJSON 解析器（Ollama 流式格式），接口与 SSEParser 相同
+
+    每个非空行就是一个事件，原始帧为该行本身
+    """
+
+    def __init__(self):
+        self._buffer = b''
+
+    def feed(self, chunk: bytes) -> List[Tuple[bytes, bytes]]:
+        lines = (self._buffer + chunk).split(b'\n')
+        self._buffer = lines.pop()
+        return [(line + b'\n', line) for line in (l.strip() for l in lines) if line]
+
+    def flush(self) -> List[Tuple[bytes, bytes]]:
+        line = self._buffer.strip()
+        self._buffer = b''
+        return [(line + b'\n', line)] if line else []
+
+
+def iter_sse_events(chunks: Iterable[bytes]) -> Iterator[Tuple[bytes, bytes]]:
+    """从字节块迭代器中解析 SSE 事件"""
+    parser = SSEParser()
+    for chunk in chunks:
+        if chunk:
+            yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+def sniff_stream_format(content_type: str, head: bytes) -> str:
+    """
+    根据 Content-Type 和响应开头的字节判断上游实际返回的格式
+
+    Returns:
+        'sse'、'ndjson' 或 'json'（忽略 stream 参数、返回完整 JSON 的后端）
+    """
+    content_type = (content_type or '').lower()
+    if 'text/event-stream' in content_type:
+        return 'sse'
+    if 'ndjson' in content_type:
+        return 'ndjson'
+
+    stripped = head.lstrip()
+    if stripped.startswith((b'data:', b'event:', b'id:', b':')):
+        return 'sse'
+    if 'application/json' in content_type or stripped.startswith((b'{', b'[')):
+        # 多行 JSON 对象视为 NDJSON
+        first_line, _, rest = stripped.partition(b'\n')
+        if rest.strip() and first_line.rstrip().endswith(b'}'):
+            return 'ndjson'
+        return 'json'
+    return 'sse'
+
+
+def parse_delta_content(data: bytes) -> Optional[str]:
+    """
+    从 OpenAI 兼容的流式数据块中提取增量文本
+
+    Returns:
+        增量文本；无法解析时返回 None
+    """
+    try:
+        chunk_data = json_loads(data)
+    except ValueError:
+        logger.warning(f'JSON 解析失败: {data[:100]!r}')
+        return None
+
+    choices = chunk_data.get('choices') if isinstance(chunk_data, dict) else None
+    if not choices:
+        return None
+    delta = choices[0].get('delta') or {}
+    return delta.get('content') or None
+
+
+class StreamRelay:
+    """
+    把上游 SSE 流转发给客户端，同时累积完整回复
+
+    passthrough=False 时输出纯文本增量（UTF-8 字节）；
+    passthrough=True 时原样转发上游的 SSE 帧。
+    parser / parse_content 可替换为其他提供商的格式（见 llm_client.LLMClient.create_relay）
+    """
+
+    def __init__(self, passthrough: bool = False, parser=None,
+                 parse_content: Callable[[bytes], Optional[str]] = parse_delta_content):
+        self.passthrough = passthrough
+        self.parser = parser or SSEParser()
+        self.parse_content = parse_content
+        self.parts: List[str] = []
+        self.done = False
+        self.source_format = 'sse'  # 上游实际返回的格式（见 sniff_stream_format）
+
+    @property
+    def text(self) -> str:
+        """目前为止收到的完整回复"""
+        return ''.join(self.parts)
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """处理一个上游字节块，返回需要发送给客户端的数据"""
+        return self._handle(self.parser.feed(chunk))
+
+    def flush(self) -> List[bytes]:
+        """上游流结束时调用"""
+        return self._handle(self.parser.flush())
+
+    def _handle(self, events: List[Tuple[bytes, bytes]]) -> List[bytes]:
+        output = []
+        for frame, data in events:
+            if self.done:
+                break
+
+            if data == DONE_MARKER:
+                self.done = True
+                if self.passthrough:
+                    output.append(frame)
+                break
+
+            content = self.parse_content(data)
+            if content:
+                self.parts.append(content)
+                if not self.passthrough:
+                    output.append(content.encode('utf-8'))
+
+            if self.passthrough:
+                output.append(frame)
+        return output
+
+    def relay(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """转发整个上游流"""
+        for chunk in chunks:
+            if chunk:
+                yield from self.feed(chunk)
+            if self.done:
+                return
+        yield from self.flush()
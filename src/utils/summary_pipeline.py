@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+记忆摘要生成流水线
+使用有界队列 + 固定数量的工作线程在后台生成记忆摘要，
+队列满时按策略丢弃任务，并统计队列深度和排队延迟。
+批量模式下按 Persona 累积多轮对话（最多 N 轮或 T 秒），一次性交给工作线程摘要
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 队列满时的处理策略
+DROP_NEWEST = 'drop_newest'  # 丢弃新提交的任务
+DROP_OLDEST = 'drop_oldest'  # 丢弃队列中最旧的任务
+BLOCK = 'block'              # 阻塞等待，超时后丢弃新任务
+DROP_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+
+class SummaryPipeline:
+    """
+    记忆摘要流水线
+
+    handler(persona_id, conversation) 在工作线程中执行，负责调用 LLM 生成摘要并保存；
+    提供 batch_handler(persona_id, conversations) 时启用批量模式
+    """
+
+    def __init__(self, handler: Callable[[int, List[Dict]], None],
+                 max_queue: int = None, workers: int = None,
+                 drop_policy: str = None, block_timeout: float = 0.5,
+                 batch_handler: Callable[[int, List[List[Dict]]], None] = None,
+                 batch_size: int = None, batch_interval: float = None):
+        """
+        初始化流水线
+
+        Args:
+            handler: 处理单个任务的函数
+            max_queue: 队列容量（批量模式下按批计数）
+            workers: 工作线程数
+            drop_policy: 队列满时的策略（drop_newest / drop_oldest / block）
+            block_timeout: block 策略下的最长等待时间（秒）
+            batch_handler: 批量处理函数，传入后启用批量模式
+            batch_size: 每个 Persona 累积多少轮对话后提交一批
+            batch_interval: 累积的对话最多等待多少秒后提交
+        """
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.batch_size = batch_size or int(os.getenv('SUMMARY_BATCH_SIZE', 5))
+        self.batch_interval = batch_interval or float(os.getenv('SUMMARY_BATCH_INTERVAL', 10))
+        self.max_queue = max_queue or int(os.getenv('SUMMARY_QUEUE_SIZE', 100))
+        self.workers = workers or int(os.getenv('SUMMARY_WORKERS', 2))
+        self.drop_policy = drop_policy or os.getenv('SUMMARY_DROP_POLICY', DROP_OLDEST)
+        if self.drop_policy not in DROP_POLICIES:
+            raise ValueError(f'无效的丢弃策略: {self.drop_policy}，支持: {", ".join(DROP_POLICIES)}')
+        self.block_timeout = block_timeout
+
+        self._queue: queue.Queue = queue.Queue(maxsize=self.max_queue)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()    # 停止后不再接收新任务，工作线程处理完队列后退出
+
+        # 批量模式: persona_id -> [(提交时间, 对话), ...]
+        self._pending: Dict[int, List[Tuple[float, List[Dict]]]] = {}
+        self._flush_event = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+        # 统计数据
+        self._stats = {
+            'submitted': 0,
+            'batches': 0,
+            'processed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'lag_total': 0.0,
+            'lag_max': 0.0,
+            'lag_last': 0.0,
+            'process_time_total': 0.0,
+        }
+
+    def start(self):
+        """启动工作线程"""
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    name=f'summary-worker-{i}',
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            if self.batch_handler:
+                self._flush_event.clear()
+                self._flusher = threading.Thread(target=self._flush_loop, name='summary-flusher', daemon=True)
+                self._flusher.start()
+        logger.info(f'记忆摘要流水线已启动: {self.workers} 个工作线程, 队列容量 {self.max_queue}, 策略 {self.drop_policy}')
+
+    @property
+    def batch_mode(self) -> bool:
+        return self.batch_handler is not None
+
+    def submit(self, persona_id: int, conversation: List[Dict]) -> bool:
+        """
+        提交摘要任务
+
+        Returns:
+            任务是否进入队列（被丢弃时返回 False）
+        """
+        now = time.monotonic()
+        batch = None
+
+        with self._lock:
+            self._stats['submitted'] += 1
+            if self.batch_mode:
+                pending = self._pending.setdefault(persona_id, [])
+                pending.append((now, list(conversation)))
+                if len(pending) < self.batch_size:
+                    return True
+                batch = self._pending.pop(persona_id)
+
+        if batch is not None:
+            return self._enqueue_batch(persona_id, batch)
+        return self._enqueue((now, persona_id, [list(conversation)]))
+
+    def _enqueue_batch(self, persona_id: int, batch: List[Tuple[float, List[Dict]]]) -> bool:
+        """把累积的对话作为一个任务放入队列（排队延迟从最早一轮开始计算）"""
+        with self._lock:
+            self._stats['batches'] += 1
+        return self._enqueue((batch[0][0], persona_id, [conversation for _, conversation in batch]))
+
+    def _flush_loop(self):
+        """批量模式下定期提交等待超时的对话"""
+        while not self._flush_event.wait(min(self.batch_interval / 2, 1.0)):
+            self.flush(expired_only=True)
+
+    def flush(self, expired_only: bool = False):
+        """
+        提交累积中的对话
+
+        Args:
+            expired_only: 只提交等待超过 batch_interval 的 Persona
+        """
+        deadline = time.monotonic() - self.batch_interval
+        with self._lock:
+            ready = [
+                pid for pid, pending in self._pending.items()
+                if not expired_only or pending[0][0] <= deadline
+            ]
+            batches = [(pid, self._pending.pop(pid)) for pid in ready]
+        for persona_id, batch in batches:
+            self._enqueue_batch(persona_id, batch)
+
+    def _enqueue(self, item: Tuple[float, int, List[List[Dict]]]) -> bool:
+        """按丢弃策略放入队列"""
+        persona_id = item[1]
+
+        if self._stopping.is_set():
+            self._record_drop(persona_id)
+            return False
+
+        if self.drop_policy == BLOCK:
+            try:
+                self._queue.put(item, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                self._record_drop(persona_id)
+                return False
+
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.drop_policy == DROP_OLDEST:
+            try:
+                oldest = self._queue.get_nowait()
+                self._queue.task_done()
+                if oldest is None:
+                    # 停止信号不能丢弃：放回队列，丢弃新任务
+                    self._queue.put_nowait(None)
+                    raise queue.Full
+                self._record_drop(oldest[1])
+            except (queue.Empty, queue.Full):
+                pass
+            try:
+                self._queue.put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+
+        self._record_drop(persona_id)
+        return False
+
+    def _record_drop(self, persona_id: int):
+        with self._lock:
+            self._stats['dropped'] += 1
+        reason = '流水线已停止' if self._stopping.is_set() else '记忆摘要队列已满'
+        logger.warning(f'{reason}，丢弃任务 (Persona {persona_id})')
+
+    def _worker(self):
+        """工作线程主循环"""
+        while True:
+            try:
+                # 停止后不再阻塞等待：队列取空即退出（队列满时 stop 放不进停止信号）
+                item = self._queue.get(timeout=0.1 if self._stopping.is_set() else None)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.task_done()
+                break
+
+            enqueued_at, persona_id, conversations = item
+            started_at = time.monotonic()
+            lag = started_at - enqueued_at
+
+            try:
+                if self.batch_mode:
+                    self.batch_handler(persona_id, conversations)
+                else:
+                    self.handler(persona_id, conversations[0])
+                succeeded = True
+            except Exception as e:
+                logger.error(f'记忆摘要任务失败 (Persona {persona_id}): {e}')
+                succeeded = False
+            finally:
+                self._queue.task_done()
+
+            with self._lock:
+                self._stats['processed' if succeeded else 'failed'] += 1
+                self._stats['lag_total'] += lag
+                self._stats['lag_last'] = lag
+                self._stats['lag_max'] = max(self._stats['lag_max'], lag)
+                self._stats['process_time_total'] += time.monotonic() - started_at
+
+    def join(self):
+        """等待队列中的任务全部完成"""
+        self._queue.join()
+
+    def stop(self, timeout: float = 5.0):
+        """提交累积中的对话，处理完剩余任务后停止工作线程"""
+        if self._flusher:
+            self._flush_event.set()
+            self._flusher.join(timeout)
+            self._flusher = None
+        self.flush()
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+            self._stopping.set()
+        for _ in threads:
+            try:
+                self._queue.put_nowait(None)    # 唤醒等待中的工作线程
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout)
+
+    def get_stats(self) -> Dict:
+        """获取流水线统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            pending_turns = sum(len(pending) for pending in self._pending.values())
+        finished = stats['processed'] + stats['failed']
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_queue': self.max_queue,
+            'workers': self.workers,
+            'drop_policy': self.drop_policy,
+            'batch_mode': self.batch_mode,
+            'pending_turns': pending_turns,
+            'batches': stats['batches'],
+            'submitted': stats['submitted'],
+            'processed': stats['processed'],
+            'failed': stats['failed'],
+            'dropped': stats['dropped'],
+            'lag_avg': stats['lag_total'] / finished if finished else 0.0,
+            'lag_max': stats['lag_max'],
+            'lag_last': stats['lag_last'],
+            'process_time_avg': stats['process_time_total'] / finished if finished else 0.0,
+        }
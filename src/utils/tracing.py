@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+请求追踪与采样剖析（默认关闭）
+
+REQUEST_TRACE=1 时记录每次请求各阶段的耗时（span），并通过 Server-Timing 响应头返回；
+REQUEST_TRACE_PROFILE_EVERY=N 时每 N 个请求完整剖析一次，结果写入 REQUEST_TRACE_PROFILE_DIR。
+
+    trace = tracer.start('chat')
+    with trace.span('retrieve_memories'):
+        ...
+    trace.mark('first_token')           # 相对请求开始的时间点，只记录第一次
+    response.headers['Server-Timing'] = trace.server_timing()
+    trace.finish()
+
+剖析器：
+    cprofile     标准库 cProfile，输出 .prof（python -m pstats / snakeviz 查看）
+    pyinstrument 输出 .html（安装后可用，未安装时退回 cProfile）
+
+流式响应的首 token / 结束等阶段发生在响应头发出之后，只能在 /traces 和日志中看到。
+剖析器在当前线程启用，请求结束时需在同一线程调用 finish()（Flask 的流式生成器满足这一点）；
+同一时间只剖析一个请求，异步服务中的剖析结果会包含事件循环上并发的其他请求。
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import itertools
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = os.getenv('REQUEST_TRACE', '').lower() in ('1', 'true', 'yes')
+TRACE_PROFILE_EVERY = int(os.getenv('REQUEST_TRACE_PROFILE_EVERY', 0))
+TRACE_PROFILE_DIR = os.getenv('REQUEST_TRACE_PROFILE_DIR') or str(Path(__file__).parent.parent.parent / 'profiles')
+TRACE_PROFILER = os.getenv('REQUEST_TRACE_PROFILER', 'cprofile').lower()
+TRACE_KEEP = int(os.getenv('REQUEST_TRACE_KEEP', 100))
+
+
+class _CProfileSampler:
+    extension = '.prof'
+
+    def __init__(self):
+        import cProfile
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def save(self, path: str):
+        self._profile.dump_stats(path)
+
+
+class _PyinstrumentSampler:
+    extension = '.html'
+
+    def __init__(self):
+        from pyinstrument import Profiler
+        self._profile = Profiler()
+
+    def start(self):
+        self._profile.start()
+
+    def stop(self):
+        self._profile.stop()
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self._profile.output_html())
+
+
+def create_sampler(kind: str = 'cprofile'):
+    """创建剖析器；pyinstrument 未安装时退回 cProfile"""
+    if kind == 'pyinstrument':
+        try:
+            return _PyinstrumentSampler()
+        except ImportError:
+            logger.warning('pyinstrument 未安装，使用 cProfile')
+    return _CProfileSampler()
+
+
+class RequestTrace:
+    """一次请求的阶段耗时记录"""
+
+    def __init__(self, name: str, request_id: int, sampler=None, on_finish=None):
+        self.name = name
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: List[Dict] = []     # {'name', 'start', 'duration'}（毫秒，相对请求开始）
+        self.marks: Dict[str, float] = {}
+        self.total: Optional[float] = None
+        self.profile_path: Optional[str] = None
+        self._sampler = sampler
+        self._on_finish = on_finish
+        if sampler is not None:
+            try:
+                sampler.start()
+            except Exception as e:
+                # 同一线程已有剖析器在运行时放弃本次采样
+                logger.warning(f'启动剖析器失败: {e}')
+                self._sampler = None
+
+    def _elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    @contextmanager
+    def span(self, name: str):
+        """记录代码块的耗时"""
+        start = self._elapsed_ms()
+        try:
+            yield
+        finally:
+            self.spans.append({'name': name, 'start': round(start, 3),
+                               'duration': round(self._elapsed_ms() - start, 3)})
+
+    def mark(self, name: str):
+        """记录相对请求开始的时间点（同名只记录第一次）"""
+        if name not in self.marks:
+            self.marks[name] = round(self._elapsed_ms(), 3)
+
+    def server_timing(self) -> str:
+        """生成 Server-Timing 响应头（已记录的阶段）"""
+        entries = [f'{span["name"]};dur={span["duration"]:.1f}' for span in self.spans]
+        entries += [f'{name};dur={offset:.1f};desc="since start"' for name, offset in self.marks.items()]
+        entries.append(f'total;dur={self._elapsed_ms():.1f}')
+        return ', '.join(entries)
+
+    def finish(self):
+        """结束追踪：停止剖析器并保存结果（可重复调用）"""
+        if self.total is not None:
+            return
+        self.total = round(self._elapsed_ms(), 3)
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._on_finish:
+            self._on_finish(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'id': self.request_id,
+            'startedAt': self.started_at,
+            'total': self.total,
+            'spans': self.spans,
+            'marks': self.marks,
+            'profile': self.profile_path,
+        }
+
+
+class _NullTrace:
+    """追踪关闭时使用的空实现"""
+
+    request_id = 0
+    total = None
+
+    @contextmanager
+    def span(self, name: str):
+        yield
+
+    def mark(self, name: str):
+        pass
+
+    def server_timing(self) -> str:
+        return ''
+
+    def finish(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class RequestTracer:
+    """
+    请求追踪器
+
+    参数:
+        enabled: 是否记录阶段耗时
+        profile_every: 每 N 个请求剖析一次（0 表示不剖析）
+        profile_dir: 剖析结果目录
+        profiler: cprofile / pyinstrument
+        keep: 保留最近多少条追踪记录（/traces 接口）
+    """
+
+    def __init__(self, enabled: bool = TRACE_ENABLED, profile_every: int = TRACE_PROFILE_EVERY,
+                 profile_dir: str = TRACE_PROFILE_DIR, profiler: str = TRACE_PROFILER, keep: int = TRACE_KEEP):
+        self.enabled = enabled
+        self.profile_every = max(0, profile_every)
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self._ids = itertools.count(1)
+        self._recent = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._profiling = False  # 同一时间只剖析一个请求
+
+    def start(self, name: str):
+        """开始追踪一次请求；关闭时返回空实现"""
+        if not self.enabled:
+            return NULL_TRACE
+        request_id = next(self._ids)
+        sampler = None
+        if self.profile_every and request_id % self.profile_every == 0:
+            with self._lock:
+                if not self._profiling:
+                    self._profiling = True
+                    sampler = create_sampler(self.profiler)
+        trace = RequestTrace(name, request_id, sampler, on_finish=self._finished)
+        if sampler is not None and trace._sampler is None:
+            self._profiling = False
+        return trace
+
+    def _finished(self, trace: RequestTrace):
+        if trace._sampler is not None:
+            try:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(trace.started_at))
+                base = os.path.join(self.profile_dir, f'{trace.name}-{stamp}-{trace.request_id}')
+                trace._sampler.save(base + trace._sampler.extension)
+                trace.profile_path = base + trace._sampler.extension
+                with open(base + '.json', 'w', encoding='utf-8') as f:
+                    json.dump(trace.to_dict(), f, ensure_ascii=False, indent=2)
+            except Exception as e:
+                logger.error(f'保存剖析结果失败: {e}')
+
+        with self._lock:
+            if trace._sampler is not None:
+                self._profiling = False
+            self._recent.append(trace.to_dict())
+
+        phases = ' '.join([f'{span["name"]}={span["duration"]:.1f}' for span in trace.spans] +
+                          [f'@{name}={offset:.1f}' for name, offset in trace.marks.items()])
+        logger.info(f'[Trace] {trace.name}#{trace.request_id} {trace.total:.1f}ms {phases}'
+                    + (f' → {trace.profile_path}' if trace.profile_path else ''))
+
+    def recent(self, limit: int = None) -> List[Dict]:
+        """最近的追踪记录（新的在前）"""
+        with self._lock:
+            traces = list(self._recent)[::-1]
+        return traces[:limit] if limit else traces
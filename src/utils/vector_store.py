@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+多进程共享的向量存储（内存映射文件）
+多 worker 部署时，各进程不再各自持有一份完整的向量矩阵，而是映射同一组文件：
+
+    <目录>/CURRENT          当前代号（原子替换）
+    <目录>/base-<代号>.vec  快照：文件头 + 元数据列 + float32 向量矩阵 + 记忆内容（按 ID 排序）
+    <目录>/log-<代号>.vec   追加日志：快照之后新增、替换和删除的记忆
+
+快照通过 np.memmap 只读映射，所有进程共享同一份页缓存；日志中的少量记录读入进程内的小矩阵。
+日志超过阈值后由任一进程合并为新一代快照（compact），其他进程下次访问时发现代号变化并重新映射。
+写入和合并通过目录下的文件锁（fcntl.flock）互斥；没有 fcntl 的平台（Windows）只支持单进程使用。
+
+接口与 EmbeddingMatrix 一致（add / remove / get / keys / similarity_map），可直接替换
+"""
+
+import os
+import struct
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+import numpy as np
+
+from src.utils.embeddings import DTYPE, EmbeddingMatrix
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MVS1'
+VERSION = 1
+
+# 文件头: 魔数、版本、维度、条数、内容区字节数、向量模型名
+HEADER = struct.Struct('<4sIIQQ64s')
+HEADER_SIZE = 128
+
+# 元数据列（每条记忆一行，与向量矩阵按行对应）
+META_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('persona_id', '<i8'),
+    ('content_offset', '<u8'),
+    ('content_length', '<u4'),
+    ('is_public', 'u1'),
+    ('_pad', 'V3'),
+])
+
+# 日志记录: 操作、记忆 ID、角色 ID、是否公共、内容字节数；之后是内容和向量（仅 PUT）
+RECORD = struct.Struct('<BqqBI')
+OP_PUT = 1
+OP_DELETE = 2
+
+
+def _align(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class VectorStore:
+    """
+    内存映射的共享向量存储
+
+    读操作前会检查 CURRENT 和日志长度（几次系统调用），自动跟上其他进程的写入
+    """
+
+    def __init__(self, directory: str, model: str = '',
+                 compact_min: int = None, compact_ratio: float = None):
+        """
+        打开（或创建）向量存储
+
+        Args:
+            directory: 存储目录
+            model: 向量模型名称（与文件头不一致时 compatible 为 False，需要 reset）
+            compact_min: 日志至少积累多少条记录才合并
+            compact_ratio: 日志记录数超过快照条数的该比例时合并
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.model = model
+        self.compact_min = compact_min or int(os.getenv('VECTOR_STORE_COMPACT_MIN', 1000))
+        self.compact_ratio = compact_ratio or float(os.getenv('VECTOR_STORE_COMPACT_RATIO', 0.2))
+
+        self.dim: Optional[int] = None
+        self.compatible = True
+        self.generation: Optional[int] = None
+
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+
+        self._mmap = None
+        self._base_meta = np.zeros(0, dtype=META_DTYPE)
+        self._base_vectors = np.zeros((0, 0), dtype=DTYPE)
+        self._base_content = np.zeros(0, dtype=np.uint8)
+        self._live = np.zeros(0, dtype=bool)  # 快照中未被日志删除或替换的行（进程私有，每条 1 字节）
+
+        self._log_offset = 0
+        self._log_records = 0
+        self._overlay: Optional[EmbeddingMatrix] = None  # 日志中的向量
+        self._overlay_meta: Dict[int, Tuple[int, bool, bytes]] = {}
+
+        self.refresh()
+
+    # ------------------------------------------------------------------
+    # 文件与锁
+    # ------------------------------------------------------------------
+
+    def _base_path(self, generation: int) -> Path:
+        return self.directory / f'base-{generation}.vec'
+
+    def _log_path(self, generation: int) -> Path:
+        return self.directory / f'log-{generation}.vec'
+
+    def _read_current(self) -> Optional[int]:
+        try:
+            return int((self.directory / 'CURRENT').read_text().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @contextmanager
+    def locked(self):
+        """进程间互斥（可重入）：写日志、合并、以及需要"检查后写入"的初始化都在锁内进行"""
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                self._lock_file = open(self.directory / 'LOCK', 'a+b')
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    # ------------------------------------------------------------------
+    # 读取
+    # ------------------------------------------------------------------
+
+    def refresh(self):
+        """跟上其他进程的写入：代号变化时重新映射快照，否则读取日志的新增部分"""
+        with self._lock:
+            for _ in range(3):
+                generation = self._read_current()
+                try:
+                    if generation != self.generation:
+                        self._open(generation)
+                    self._read_log()
+                    return
+                except FileNotFoundError:
+                    continue  # 读取 CURRENT 之后旧文件恰好被合并删除，重试
+            logger.warning('[VectorStore] 向量文件在读取时被反复替换')
+
+    def _open(self, generation: Optional[int]):
+        """映射一代快照（日志从头读取）"""
+        self.generation = generation
+        self._log_offset = 0
+        self._log_records = 0
+        self._overlay = None
+        self._overlay_meta = {}
+        self._mmap = None
+        self.compatible = True
+
+        if generation is None:
+            self.dim = None
+            self._base_meta = np.zeros(0, dtype=META_DTYPE)
+            self._base_vectors = np.zeros((0, 0), dtype=DTYPE)
+            self._base_content = np.zeros(0, dtype=np.uint8)
+            self._live = np.zeros(0, dtype=bool)
+            return
+
+        mm = np.memmap(self._base_path(generation), dtype=np.uint8, mode='r')
+        magic, version, dim, count, content_size, model = HEADER.unpack(mm[:HEADER.size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'无法识别的向量文件: {self._base_path(generation)}')
+        model = model.rstrip(b'\0').decode('utf-8')
+
+        vectors_offset = _align(HEADER_SIZE + count * META_DTYPE.itemsize)
+        content_offset = vectors_offset + count * dim * DTYPE().itemsize
+
+        # 以下都是映射内存上的视图，不复制数据
+        self._mmap = mm
+        self.dim = dim
+        self.compatible = not self.model or model == self.model
+        self._base_meta = np.frombuffer(mm, dtype=META_DTYPE, count=count, offset=HEADER_SIZE)
+        self._base_vectors = np.frombuffer(
+            mm, dtype=DTYPE, count=count * dim, offset=vectors_offset
+        ).reshape(count, dim)
+        self._base_content = mm[content_offset:content_offset + content_size]
+        self._live = np.ones(count, dtype=bool)
+
+    def _read_log(self):
+        """读取日志中尚未应用的完整记录（正在写入的半条记录留到下次）"""
+        if self.generation is None:
+            return
+        path = self._log_path(self.generation)
+        size = os.path.getsize(path)
+        if size <= self._log_offset:
+            return
+        with open(path, 'rb') as f:
+            f.seek(self._log_offset)
+            data = f.read(size - self._log_offset)
+
+        vector_size = self.dim * DTYPE().itemsize
+        pos = 0
+        while pos + RECORD.size <= len(data):
+            op, key, persona_id, is_public, content_length = RECORD.unpack_from(data, pos)
+            start = pos + RECORD.size
+            end = start + content_length + (vector_size if op == OP_PUT else 0)
+            if end > len(data):
+                break
+
+            row = self._base_row(key)
+            if row is not None:
+                self._live[row] = False
+            if op == OP_PUT:
+                if self._overlay is None:
+                    self._overlay = EmbeddingMatrix(self.dim, capacity=256)
+                vector = np.frombuffer(data, dtype=DTYPE, count=self.dim, offset=start + content_length)
+                self._overlay.add(key, vector)
+                self._overlay_meta[key] = (persona_id, bool(is_public), data[start:start + content_length])
+            elif self._overlay is not None:
+                self._overlay.remove(key)
+                self._overlay_meta.pop(key, None)
+
+            self._log_records += 1
+            pos = end
+        self._log_offset += pos
+
+    def _base_row(self, key: Hashable) -> Optional[int]:
+        """快照中的行号（快照按 ID 排序，二分查找，不需要进程私有的索引字典）"""
+        ids = self._base_meta['id']
+        row = int(np.searchsorted(ids, key))
+        if row < len(ids) and ids[row] == key:
+            return row
+        return None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return int(self._live.sum()) + (len(self._overlay) if self._overlay is not None else 0)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    @property
+    def keys(self) -> List[Hashable]:
+        """与 similarities() 结果按行对应的键"""
+        self.refresh()
+        with self._lock:
+            keys = self._base_meta['id'][self._live].tolist()
+            if self._overlay is not None:
+                keys += self._overlay.keys
+            return keys
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            if self._overlay is not None and key in self._overlay:
+                return self._overlay.get(key)
+            row = self._base_row(key)
+            if row is not None and self._live[row]:
+                return self._base_vectors[row]
+            return None
+
+    def metadata(self, key: Hashable) -> Optional[Dict]:
+        """记忆的元数据 {'id', 'persona_id', 'is_public', 'content'}"""
+        with self._lock:
+            if key in self._overlay_meta:
+                persona_id, is_public, content = self._overlay_meta[key]
+            else:
+                row = self._base_row(key)
+                if row is None or not self._live[row]:
+                    return None
+                meta = self._base_meta[row]
+                persona_id, is_public = int(meta['persona_id']), bool(meta['is_public'])
+                start = int(meta['content_offset'])
+                content = self._base_content[start:start + int(meta['content_length'])].tobytes()
+            return {'id': key, 'persona_id': persona_id, 'is_public': is_public,
+                    'content': content.decode('utf-8')}
+
+    def similarities(self, query: np.ndarray) -> np.ndarray:
+        """查询向量与每一行的余弦相似度（顺序与 keys 一致）"""
+        self.refresh()
+        query = np.asarray(query, dtype=DTYPE)
+        with self._lock:
+            parts = [(self._base_vectors @ query)[self._live]] if len(self._live) else []
+            if self._overlay is not None:
+                parts.append(self._overlay.similarities(query))
+            return np.concatenate(parts) if parts else np.zeros(0, dtype=DTYPE)
+
+    def similarity_map(self, query: np.ndarray) -> Dict[Hashable, float]:
+        """{键: 相似度}"""
+        self.refresh()
+        query = np.asarray(query, dtype=DTYPE)
+        with self._lock:
+            scores = {}
+            if len(self._live):
+                live = self._live
+                scores = dict(zip(self._base_meta['id'][live].tolist(),
+                                  (self._base_vectors @ query)[live].tolist()))
+            if self._overlay is not None:
+                scores.update(self._overlay.similarity_map(query))
+            return scores
+
+    # ------------------------------------------------------------------
+    # 写入
+    # ------------------------------------------------------------------
+
+    def add(self, key: int, vector: np.ndarray, persona_id: int = 0,
+            is_public: bool = False, content: str = ''):
+        """添加或替换一条记忆的向量"""
+        self.add_many([(key, vector, persona_id, is_public, content)])
+
+    def add_many(self, items: Iterable[Tuple[int, np.ndarray, int, bool, str]]):
+        """批量添加 (记忆 ID, 向量, 角色 ID, 是否公共, 内容)，一次写入日志"""
+        items = list(items)
+        if not items:
+            return
+        with self.locked():
+            self.refresh()
+            if self.generation is None or not self.dim:
+                self._write_generation([], np.zeros((0, len(items[0][1])), dtype=DTYPE))
+            chunks = []
+            for key, vector, persona_id, is_public, content in items:
+                content = content.encode('utf-8')
+                vector = np.asarray(vector, dtype=DTYPE)
+                if vector.shape != (self.dim,):
+                    raise ValueError(f'向量维度不一致: {vector.shape} != ({self.dim},)')
+                chunks += [RECORD.pack(OP_PUT, key, persona_id, int(bool(is_public)), len(content)),
+                           content, vector.tobytes()]
+            self._append(b''.join(chunks))
+
+    def remove(self, key: int) -> bool:
+        with self.locked():
+            self.refresh()
+            if key not in self:
+                return False
+            self._append(RECORD.pack(OP_DELETE, key, 0, 0, 0))
+            return True
+
+    def _append(self, data: bytes):
+        """追加到当前日志（调用方持有锁），然后应用到本进程"""
+        with open(self._log_path(self.generation), 'ab') as f:
+            f.write(data)
+            f.flush()
+        self._read_log()
+
+    # ------------------------------------------------------------------
+    # 合并
+    # ------------------------------------------------------------------
+
+    def needs_compaction(self) -> bool:
+        return self._log_records >= max(self.compact_min, self.compact_ratio * len(self._base_meta))
+
+    def maybe_compact(self) -> bool:
+        """日志超过阈值时合并（已有其他进程在合并时跳过）"""
+        self.refresh()
+        if not self.needs_compaction():
+            return False
+        return self.compact(force=False)
+
+    def compact(self, force: bool = True) -> bool:
+        """把快照和日志合并为新一代快照"""
+        with self.locked():
+            self.refresh()
+            if self.generation is None or (not force and not self.needs_compaction()):
+                return False
+
+            rows = np.flatnonzero(self._live)
+            meta = self._base_meta[rows]
+            records = []
+            for row_meta in meta:
+                start = int(row_meta['content_offset'])
+                records.append((int(row_meta['id']), int(row_meta['persona_id']), bool(row_meta['is_public']),
+                                self._base_content[start:start + int(row_meta['content_length'])].tobytes()))
+            vectors = [self._base_vectors[rows]]
+            if self._overlay is not None and len(self._overlay):
+                overlay_keys = list(self._overlay.keys)
+                for key in overlay_keys:
+                    persona_id, is_public, content = self._overlay_meta[key]
+                    records.append((key, persona_id, is_public, content))
+                vectors.append(np.stack([self._overlay.get(key) for key in overlay_keys]))
+
+            log_records = self._log_records
+            self._write_generation(records, np.concatenate(vectors))
+            logger.info(f'[VectorStore] 合并完成: 代号 {self.generation}, {len(records)} 条向量'
+                        f'（合并日志 {log_records} 条）')
+            return True
+
+    def reset(self):
+        """清空存储并按当前模型开始新的一代（模型变化时调用）"""
+        with self.locked():
+            self.refresh()
+            if self.generation is not None:
+                self._write_generation([], np.zeros((0, 0), dtype=DTYPE), dim=0)
+
+    def _write_generation(self, records: List[Tuple[int, int, bool, bytes]], vectors: np.ndarray,
+                          dim: int = None):
+        """写出新一代快照和空日志，原子切换 CURRENT，并删除上一代文件（调用方持有锁）"""
+        dim = vectors.shape[1] if dim is None else dim
+        order = np.argsort(np.array([r[0] for r in records], dtype=np.int64), kind='stable')
+
+        meta = np.zeros(len(records), dtype=META_DTYPE)
+        contents = []
+        offset = 0
+        for i, index in enumerate(order.tolist()):
+            key, persona_id, is_public, content = records[index]
+            meta[i] = (key, persona_id, offset, len(content), int(is_public), b'\0' * 3)
+            contents.append(content)
+            offset += len(content)
+        if len(records):
+            vectors = np.ascontiguousarray(vectors[order], dtype=DTYPE)
+
+        previous = self.generation
+        generation = (previous or 0) + 1
+        base_path = self._base_path(generation)
+        tmp_path = base_path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            header = HEADER.pack(MAGIC, VERSION, dim, len(records), offset, self.model.encode('utf-8')[:64])
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            f.write(meta.tobytes())
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+            if len(records):
+                f.write(vectors.tobytes())
+            f.write(b''.join(contents))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, base_path)
+        open(self._log_path(generation), 'wb').close()
+
+        current_tmp = self.directory / 'CURRENT.tmp'
+        current_tmp.write_text(str(generation))
+        os.replace(current_tmp, self.directory / 'CURRENT')
+
+        # 其他进程已映射的旧文件在 POSIX 上仍然有效，直到它们切换到新一代
+        if previous is not None:
+            for path in (self._base_path(previous), self._log_path(previous)):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+        self._open(generation)
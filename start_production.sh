@@ -15,7 +15,7 @@ export ENV=production
 
 # 启动后端服务器
 echo "📡 启动后端服务器..."
-python3 server_v2.py &
+python3 serve.py &   # prefork 多进程，worker 数由 WEB_CONCURRENCY 指定（默认 CPU 核数）
 SERVER_PID=$!
 
 # 等待服务器启动
@@ -59,6 +59,16 @@ def test_database():
         assert len(memories) == 0
         logger.info(f'✅ 删除记忆成功')
         
+        # 测试批量添加记忆
+        ids = db.add_memories([
+            {'persona_id': pid, 'content': '用户喜欢爬山'},
+            {'persona_id': pid, 'content': '用户会说日语', 'is_public': True},
+        ])
+        assert len(ids) == 2 and len(db.get_memories(pid)) == 2
+        for memory_id in ids:
+            db.delete_memory(memory_id)
+        logger.info(f'✅ 批量添加记忆: {len(ids)} 条')
+        
         # 测试聊天记录
         db.add_chat_message(pid, 'user', '你好')
         db.add_chat_message(pid, 'assistant', '你好！有什么可以帮助你的吗？')
@@ -197,6 +207,13 @@ def test_api_config():
         assert 'messages' in body
         logger.info(f'✅ 请求体构建成功')
         
+        # 测试共享连接池
+        session = config.get_session()
+        assert session is APIConfig('longcat').get_session()
+        connect_timeout, read_timeout = config.get_timeout()
+        assert connect_timeout > 0 and read_timeout > 0
+        logger.info(f'✅ 连接池共享: 连接超时 {connect_timeout}s, 读取超时 {read_timeout}s')
+        
         logger.info('✅ API 配置模块测试通过\n')
         return True
         
@@ -207,6 +224,1323 @@ def test_api_config():
         return False
 
 
+def test_summary_pipeline():
+    """测试记忆摘要流水线"""
+    logger.info('=' * 50)
+    logger.info('测试记忆摘要流水线')
+    logger.info('=' * 50)
+    
+    try:
+        import time
+        import threading
+        from src.utils.summary_pipeline import SummaryPipeline
+        
+        # 测试任务处理
+        handled = []
+        pipeline = SummaryPipeline(lambda pid, conv: handled.append((pid, conv)), max_queue=10, workers=2)
+        pipeline.start()
+        for i in range(5):
+            assert pipeline.submit(1, [{'role': 'user', 'content': f'消息 {i}'}])
+        pipeline.join()
+        stats = pipeline.get_stats()
+        assert len(handled) == 5 and stats['processed'] == 5
+        logger.info(f'✅ 处理任务: {stats["processed"]} 个, 平均排队延迟 {stats["lag_avg"] * 1000:.2f}ms')
+        pipeline.stop()
+        
+        # 测试队列满时丢弃最旧任务
+        release = threading.Event()
+        pipeline = SummaryPipeline(lambda pid, conv: release.wait(), max_queue=2, workers=1, drop_policy='drop_oldest')
+        pipeline.start()
+        for i in range(5):
+            pipeline.submit(i, [])
+        stats = pipeline.get_stats()
+        assert stats['queue_depth'] <= 2 and stats['dropped'] >= 2
+        logger.info(f'✅ 队列满时丢弃: {stats["dropped"]} 个任务')
+        
+        # 队列满时停止不阻塞，停止后提交的任务被拒绝，工作线程处理完队列后全部退出
+        threads = list(pipeline._threads)
+        stopper = threading.Thread(target=pipeline.stop)
+        stopper.start()
+        while not pipeline._stopping.is_set():
+            time.sleep(0.01)
+        assert pipeline.submit(9, []) is False
+        release.set()
+        stopper.join(5)
+        assert not stopper.is_alive() and not any(t.is_alive() for t in threads)
+        assert pipeline.get_stats()['queue_depth'] == 0
+        logger.info('✅ 队列满时停止，工作线程全部退出')
+        
+        # 测试批量模式：累积 3 轮后合并为一个任务
+        batches = []
+        pipeline = SummaryPipeline(None, workers=1, batch_size=3, batch_interval=60,
+                                   batch_handler=lambda pid, convs: batches.append((pid, len(convs))))
+        pipeline.start()
+        for i in range(4):
+            pipeline.submit(1, [{'role': 'user', 'content': f'消息 {i}'}])
+        pipeline.join()
+        assert batches == [(1, 3)] and pipeline.get_stats()['pending_turns'] == 1
+        pipeline.stop()
+        assert batches == [(1, 3), (1, 1)]
+        logger.info(f'✅ 批量模式: {len(batches)} 批')
+        
+        logger.info('✅ 记忆摘要流水线测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 记忆摘要流水线测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_sse_parser():
+    """测试 SSE 流解析"""
+    logger.info('=' * 50)
+    logger.info('测试 SSE 流解析')
+    logger.info('=' * 50)
+    
+    try:
+        import json
+        from src.utils.sse_parser import SSEParser, StreamRelay
+        
+        stream = b''.join(
+            f'data: {json.dumps({"choices": [{"delta": {"content": token}}]}, ensure_ascii=False)}\r\n\r\n'.encode('utf-8')
+            for token in ['你好', '，', 'world']
+        ) + b': keep-alive\n\ndata: [DONE]\n\n'
+        
+        # 测试任意切分的字节块（包括切断 UTF-8 多字节字符）
+        for size in (1, 3, 7, len(stream)):
+            chunks = [stream[i:i + size] for i in range(0, len(stream), size)]
+            relay = StreamRelay()
+            output = b''.join(relay.relay(chunks))
+            assert output.decode('utf-8') == '你好，world' and relay.text == '你好，world' and relay.done
+        logger.info(f'✅ 增量解析: {relay.text}')
+        
+        # 测试原样转发 SSE 帧
+        relay = StreamRelay(passthrough=True)
+        frames = list(relay.relay([stream]))
+        assert len(frames) == 4 and frames[-1] == b'data: [DONE]\n\n'
+        assert relay.text == '你好，world'
+        logger.info(f'✅ SSE 帧转发: {len(frames)} 帧')
+        
+        # 测试多行 data 字段
+        events = SSEParser().feed(b'data: a\ndata: b\n\n')
+        assert events[0][1] == b'a\nb'
+        logger.info(f'✅ 多行 data 字段解析成功')
+        
+        # 测试上游响应格式识别
+        from src.utils.sse_parser import sniff_stream_format
+        assert sniff_stream_format('text/event-stream', b'') == 'sse'
+        assert sniff_stream_format('application/json', b'{"choices": []}') == 'json'
+        assert sniff_stream_format('', b'data: {}') == 'sse'
+        assert sniff_stream_format('application/json', b'{"a": 1}\n{"a": 2}\n') == 'ndjson'
+        logger.info(f'✅ 响应格式识别')
+        
+        logger.info('✅ SSE 流解析测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ SSE 流解析测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_llm_client():
+    """测试 LLM 客户端的提供商适配"""
+    logger.info('=' * 50)
+    logger.info('测试 LLM 客户端')
+    logger.info('=' * 50)
+    
+    try:
+        import json
+        from llm_client import LLMClient
+        
+        # 测试各提供商的非流式响应解析
+        assert LLMClient('openai').config.extract_response_content(
+            {'choices': [{'message': {'content': '你好'}}]}) == '你好'
+        assert LLMClient('anthropic').config.extract_response_content(
+            {'content': [{'type': 'text', 'text': '你好'}]}) == '你好'
+        assert LLMClient('ollama').config.extract_response_content(
+            {'message': {'content': '你好'}}) == '你好'
+        logger.info(f'✅ 非流式响应解析')
+        
+        # 测试 Anthropic SSE 流
+        relay = LLMClient('anthropic').create_relay()
+        stream = b''.join(
+            f'event: {t}\ndata: {json.dumps(d)}\n\n'.encode('utf-8') for t, d in [
+                ('message_start', {'type': 'message_start'}),
+                ('content_block_delta', {'type': 'content_block_delta', 'delta': {'text': 'Hi'}}),
+                ('message_stop', {'type': 'message_stop'}),
+            ]
+        )
+        assert b''.join(relay.relay([stream])) == b'Hi'
+        logger.info(f'✅ Anthropic 流式解析')
+        
+        # 测试 Ollama NDJSON 流
+        relay = LLMClient('ollama').create_relay(passthrough=True)
+        lines = [{'message': {'content': '你'}, 'done': False}, {'message': {'content': '好'}, 'done': True}]
+        stream = b'\n'.join(json.dumps(line).encode('utf-8') for line in lines)
+        assert b''.join(relay.relay([stream])).decode('utf-8') == '你好' and not relay.passthrough
+        logger.info(f'✅ Ollama 流式解析')
+        
+        logger.info('✅ LLM 客户端测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ LLM 客户端测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_provider_router():
+    """测试提供商路由的排序和熔断"""
+    logger.info('=' * 50)
+    logger.info('测试提供商路由')
+    logger.info('=' * 50)
+    
+    try:
+        from llm_client import LLMClient
+        from provider_router import ProviderRouter, Backend, OPEN, CLOSED
+        
+        fast = Backend(LLMClient('longcat'), 'LongCat-Flash-Chat')
+        slow = Backend(LLMClient('openai'), 'gpt-4', failure_threshold=2, cooldown=0)
+        router = ProviderRouter([slow, fast])
+        
+        # 测试按首 token 延迟排序
+        for _ in range(5):
+            fast.record_success(0.1)
+            slow.record_success(0.8)
+        assert router.rank()[0] is fast
+        assert router.rank('gpt-4') == [slow]
+        logger.info(f'✅ 按延迟排序: {[b.name for b in router.rank()]}')
+        
+        # 测试熔断：连续失败后打开，冷却后只放行一个试探请求
+        slow.record_failure()
+        slow.record_failure()
+        assert slow.state == OPEN
+        assert slow.acquire() and not slow.acquire()
+        slow.record_success(0.5)
+        assert slow.state == CLOSED
+        logger.info(f'✅ 熔断与恢复')
+        
+        # 使用可控延迟的模拟后端测试 open_stream
+        import time
+        import threading
+        from llm_client import LLMError
+        from src.utils.sse_parser import StreamRelay
+        
+        class StubResponse:
+            def __init__(self, delay, text, stream=True):
+                self.delay = delay
+                self.text = text
+                self.stream = stream
+                self.headers = {'Content-Type': 'text/event-stream' if stream else 'application/json'}
+                self.closed = threading.Event()
+            
+            def iter_content(self, chunk_size=None):
+                if self.closed.wait(self.delay):
+                    raise ConnectionError('连接已关闭')
+                if not self.stream:
+                    # 忽略 stream 参数的后端：完整 JSON 分两块到达
+                    yield f'{{"choices": [{{"message": '.encode('utf-8')
+                    yield f'{{"content": "{self.text}"}}}}]}}'.encode('utf-8')
+                    return
+                yield f'data: {{"choices": [{{"delta": {{"content": "{self.text}"}}}}]}}\n\n'.encode('utf-8')
+                yield b'data: [DONE]\n\n'
+            
+            def close(self):
+                self.closed.set()
+        
+        class StubClient(LLMClient):
+            def __init__(self, name, delay=0.0, status=None, stream=True):
+                super().__init__('longcat')
+                self.provider = name
+                self.delay = delay
+                self.status = status
+                self.stream = stream
+                self.responses = []
+            
+            def request(self, model, messages, stream=True):
+                if self.status:
+                    raise LLMError(f'API调用失败: {self.status}', self.status)
+                response = StubResponse(self.delay, self.provider, self.stream)
+                self.responses.append(response)
+                return response
+        
+        def consume(stream):
+            return b''.join(stream).decode('utf-8')
+        
+        # 对冲：主后端超过对冲延迟后请求下一个后端，先返回者胜出，落败的连接立即关闭
+        slow_client, fast_client = StubClient('slow', delay=2.0), StubClient('fast', delay=0.05)
+        router = ProviderRouter([Backend(slow_client, 'm'), Backend(fast_client, 'm')], hedge=True, hedge_delay=0.1)
+        router.backends[1].record_success(1.0)  # 让 slow 排在前面
+        started = time.monotonic()
+        assert consume(router.open_stream([])) == 'fast'
+        assert slow_client.responses[0].closed.wait(0.5) and time.monotonic() - started < 1.0
+        assert router.get_stats()['hedge_wins'] == 1
+        logger.info('✅ 对冲请求胜出，落败的连接被关闭')
+        
+        # 切换：5xx 计入熔断，4xx 不计入
+        broken, healthy = Backend(StubClient('broken', status=503), 'm'), Backend(StubClient('healthy'), 'm')
+        router = ProviderRouter([broken, healthy])
+        assert consume(router.open_stream([])) == 'healthy'
+        assert broken.consecutive_failures == 1 and router.get_stats()['failovers'] == 1
+        bad_request = Backend(StubClient('bad', status=400), 'm', failure_threshold=1)
+        try:
+            ProviderRouter([bad_request]).open_stream([])
+            assert False, '4xx 应抛出 LLMError'
+        except LLMError as e:
+            assert e.status_code == 400
+        assert bad_request.state == CLOSED and bad_request.consecutive_failures == 0
+        logger.info('✅ 失败切换，4xx 不触发熔断')
+        
+        # 忽略 stream 参数、返回完整 JSON 的后端同样能解析出内容
+        stream = ProviderRouter([Backend(StubClient('plain', stream=False), 'm')]).open_stream([])
+        assert consume(stream) == 'plain' and stream.relay.source_format == 'json'
+        logger.info('✅ 路由器识别非流式 JSON 响应')
+        
+        # 两个请求同时返回：未被采用的结果也会被关闭
+        from provider_router import _Race, RoutedStream
+        race = _Race()
+        streams = [RoutedStream(b, StubResponse(0, b.name), StreamRelay(), iter(()), [], 0) for b in (broken, healthy)]
+        for stream in streams:
+            race.put((stream.backend, stream, None))
+        race.finish(race.results.get_nowait()[1])
+        assert not streams[0].response.closed.is_set() and streams[1].response.closed.is_set()
+        logger.info('✅ 同时返回的多余结果被关闭')
+        
+        logger.info('✅ 提供商路由测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 提供商路由测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_prompt_builder():
+    """测试提示词组装的 token 预算和固定前缀"""
+    logger.info('=' * 50)
+    logger.info('测试提示词组装')
+    logger.info('=' * 50)
+    
+    try:
+        from src.utils.prompt_builder import PromptBuilder, estimate_tokens, estimate_messages_tokens
+        
+        # 测试 token 估算：CJK 按字计，英文约 4 字符/token
+        assert estimate_tokens('你好世界') == 4
+        assert estimate_tokens('hello world!') == 3
+        logger.info(f'✅ token 估算')
+        
+        builder = PromptBuilder(max_tokens=300, max_history=20, history_step=4)
+        history = [
+            {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'第{i}条消息' * 5}
+            for i in range(40)
+        ]
+        memories = [{'content': '用户喜欢猫', 'type': 'persona'}]
+        
+        # 测试预算：历史按预算截断，动态记忆放在固定前缀之后
+        messages = builder.build('我是一个测试角色', '你好', history=history, memories=memories)
+        assert estimate_messages_tokens(messages) <= 300
+        assert messages[0]['content'].startswith('我是一个测试角色')
+        assert '用户喜欢猫' not in messages[0]['content']
+        assert messages[-1] == {'role': 'user', 'content': '你好'}
+        assert messages[1]['role'] == 'user'
+        logger.info(f'✅ 按预算保留 {len(messages) - 3} 条历史, 约 {estimate_messages_tokens(messages)} tokens')
+        
+        # 测试前缀稳定：新增一轮对话后，前缀（系统提示 + 已有历史）不变
+        next_messages = builder.build('我是一个测试角色', '再见', history=history + [
+            {'role': 'user', 'content': '你好'}, {'role': 'assistant', 'content': '你好呀'}
+        ], memories=[])
+        assert next_messages[:len(messages) - 2] == messages[:-2]
+        logger.info(f'✅ 前缀稳定')
+        
+        logger.info('✅ 提示词组装测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 提示词组装测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_conversation_summary():
+    """测试对话滚动摘要"""
+    logger.info('=' * 50)
+    logger.info('测试对话滚动摘要')
+    logger.info('=' * 50)
+    
+    try:
+        from database import Database
+        from src.utils.conversation_summary import ConversationSummarizer
+        
+        db = Database(':memory:')
+        pid = db.create_persona('测试助手', '这是一个测试助手')
+        
+        calls = []
+        def summarize(previous_summary, messages):
+            calls.append(len(messages))
+            return (previous_summary + ' ' if previous_summary else '') + f'摘要{len(messages)}'
+        
+        summarizer = ConversationSummarizer(db, summarize, keep_recent=4, trigger=8)
+        history = []
+        for i in range(10):
+            role = 'user' if i % 2 == 0 else 'assistant'
+            message_id = db.add_chat_message(pid, role, f'消息{i}')
+            history.append({'id': message_id, 'role': role, 'content': f'消息{i}'})
+        
+        # 测试达到阈值后并入较早的消息，只保留最近 keep_recent 条原文
+        assert summarizer.needs_update(pid, history)
+        assert summarizer.update(pid)
+        summary, recent = summarizer.split_history(pid, history)
+        assert calls == [6] and summary == '摘要6'
+        assert [m['content'] for m in recent] == ['消息6', '消息7', '消息8', '消息9']
+        assert not summarizer.needs_update(pid, recent)
+        logger.info(f'✅ 滚动摘要: {summary}, 保留 {len(recent)} 条原文')
+        
+        # 测试摘要持久化：新的实例从数据库恢复摘要和未摘要的消息
+        restored = ConversationSummarizer(db, summarize, keep_recent=4, trigger=8)
+        assert restored.get(pid)['summary'] == '摘要6'
+        assert [m['content'] for m in restored.load_history(pid)] == ['消息6', '消息7', '消息8', '消息9']
+        logger.info(f'✅ 摘要持久化')
+        
+        db.close()
+        logger.info('✅ 对话滚动摘要测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 对话滚动摘要测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_embeddings():
+    """测试语义向量后端和向量矩阵"""
+    logger.info('=' * 50)
+    logger.info('测试语义向量')
+    logger.info('=' * 50)
+    
+    try:
+        import numpy as np
+        from database import Database
+        from src.utils.embeddings import HashingEmbeddingBackend, EmbeddingMatrix, to_blob, from_blob
+        from src.utils.memory_manager_v2 import MemoryManager
+        
+        backend = HashingEmbeddingBackend(dim=64)
+        vectors = backend.embed(['用户喜欢吃苹果', '用户住在北京'])
+        assert vectors.shape == (2, 64) and vectors.dtype == np.float32
+        assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+        assert np.array_equal(from_blob(to_blob(vectors[0])), vectors[0])
+        logger.info(f'✅ 批量计算向量: {vectors.shape}')
+        
+        # 测试向量矩阵的扩容和删除
+        matrix = EmbeddingMatrix(64, capacity=1)
+        for i, vector in enumerate(vectors):
+            matrix.add(i, vector)
+        matrix.remove(0)
+        assert len(matrix) == 1 and matrix.keys == [1]
+        assert abs(matrix.similarity_map(vectors[1])[1] - 1.0) < 1e-5
+        logger.info(f'✅ 向量矩阵')
+        
+        # 测试向量以 BLOB 形式保存并按模型读取
+        db = Database(':memory:')
+        pid = db.create_persona('测试助手', '')
+        mid = db.add_memory(pid, '用户喜欢吃苹果', embedding=to_blob(vectors[0]), embedding_model=backend.name)
+        assert np.array_equal(from_blob(db.get_memory_embeddings(backend.name)[mid]), vectors[0])
+        assert 'embedding' not in db.get_memory(mid)
+        db.close()
+        logger.info(f'✅ 向量持久化')
+        
+        # 测试记忆管理器使用向量检索
+        manager = MemoryManager(use_database=False, embedding_backend=backend)
+        manager.add_memories(1, [('用户喜欢吃苹果', False), ('用户住在北京', False), ('今天天气很好', True)])
+        results = manager.retrieve_memories(1, '苹果好吃吗', 2)
+        assert results and results[0]['content'] == '用户喜欢吃苹果'
+        manager.delete_memory(results[0]['id'])
+        assert len(manager.embeddings) == 2
+        logger.info(f'✅ 语义检索: {results[0]["content"]} ({results[0]["score"]:.2f})')
+        
+        logger.info('✅ 语义向量测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 语义向量测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_ann_index():
+    """测试近似最近邻索引"""
+    logger.info('=' * 50)
+    logger.info('测试近似最近邻索引')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        import numpy as np
+        from src.utils.ann_index import ANNIndex, HNSWIndex
+        from src.utils.embeddings import HashingEmbeddingBackend, normalize
+        from src.utils.memory_manager_v2 import MemoryManager
+        
+        rng = np.random.default_rng(0)
+        data = normalize(rng.normal(size=(500, 32)))
+        index = HNSWIndex(32, M=8, ef_construction=64)
+        index.add_items(list(range(500)), data)
+        
+        # 测试召回率（与精确检索比较）
+        hits = 0
+        for query in data[:50]:
+            expected = set(np.argsort(-(data @ query))[:10].tolist())
+            hits += len(expected & {key for key, _ in index.search(query, 10)})
+        recall = hits / 500
+        assert recall >= 0.9
+        logger.info(f'✅ recall@10: {recall:.2f}')
+        
+        # 测试增量删除和过滤
+        for key in range(0, 500, 2):
+            index.remove(key)
+        results = index.search(data[1], 5, filter=lambda key: key % 4 == 1)
+        assert len(index) == 250 and results[0][0] == 1
+        assert all(key % 4 == 1 for key, _ in results)
+        logger.info(f'✅ 删除与过滤')
+        
+        # 测试持久化
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.ann')
+            index.save(path, embedding_model='test')
+            loaded, metadata = ANNIndex.load(path)
+            assert metadata['embedding_model'] == 'test' and len(loaded) == 250
+            assert loaded.search(data[3], 3) == index.search(data[3], 3)
+        logger.info(f'✅ 索引持久化')
+        
+        # 测试记忆管理器通过索引检索
+        os.environ['MEMORY_ANN_INDEX'] = 'hnsw'
+        os.environ['MEMORY_ANN_MIN_SIZE'] = '1'
+        try:
+            manager = MemoryManager(use_database=False, embedding_backend=HashingEmbeddingBackend(dim=64))
+        finally:
+            del os.environ['MEMORY_ANN_INDEX'], os.environ['MEMORY_ANN_MIN_SIZE']
+        manager.add_memories(1, [('用户喜欢吃苹果', False), ('用户住在北京', False)])
+        manager.add_memories(2, [('用户喜欢苹果手机', False)])
+        results = manager.retrieve_memories(1, '苹果好吃吗', 3)
+        assert manager.ann_index is not None and len(manager.ann_index) == 3
+        assert [r['content'] for r in results] == ['用户喜欢吃苹果']
+        logger.info(f'✅ 记忆检索使用 {manager.ann_index.kind} 索引')
+        
+        logger.info('✅ 近似最近邻索引测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 近似最近邻索引测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_vector_store():
+    """测试共享向量文件"""
+    logger.info('=' * 50)
+    logger.info('测试共享向量文件')
+    logger.info('=' * 50)
+    
+    try:
+        import tempfile
+        import numpy as np
+        from src.utils.embeddings import normalize
+        from src.utils.vector_store import VectorStore
+        
+        rng = np.random.default_rng(0)
+        data = normalize(rng.normal(size=(50, 16)))
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            # 两个实例模拟两个 worker 进程
+            writer = VectorStore(tmp, 'test')
+            reader = VectorStore(tmp, 'test')
+            writer.add_many([(i, data[i], i % 3, i % 2 == 0, f'记忆{i}') for i in range(50)])
+            assert len(reader.keys) == 50 and reader.metadata(7)['content'] == '记忆7'
+            logger.info(f'✅ 追加日志对其他进程可见')
+            
+            # 合并后读取方切换到新一代快照（内存映射）
+            writer.remove(3)
+            writer.compact()
+            scores = reader.similarity_map(data[5])
+            assert reader.generation == writer.generation and 3 not in scores
+            assert max(scores, key=scores.get) == 5
+            assert not reader._base_vectors.flags.owndata and not reader._base_vectors.flags.writeable
+            logger.info(f'✅ 快照合并: 代号 {reader.generation}, {len(reader)} 条向量')
+            
+            # 模型变化时需要重建
+            assert not VectorStore(tmp, 'other').compatible
+            logger.info(f'✅ 模型校验')
+        
+        logger.info('✅ 共享向量文件测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 共享向量文件测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_cache_coherence():
+    """测试跨进程缓存同步"""
+    logger.info('=' * 50)
+    logger.info('测试跨进程缓存同步')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        import database
+        from src.utils.embeddings import HashingEmbeddingBackend
+        from src.utils.memory_manager_v2 import MemoryManager
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            previous = database._db_instance
+            database._db_instance = database.Database(os.path.join(tmp, 'memory.db'))
+            try:
+                # 两个管理器模拟两个 worker（各自持有记忆缓存）
+                pid = database._db_instance.create_persona('同步测试', '')
+                worker1 = MemoryManager(embedding_backend=HashingEmbeddingBackend(dim=64))
+                worker2 = MemoryManager(embedding_backend=HashingEmbeddingBackend(dim=64))
+                
+                memory = worker1.add_memory(pid, '用户喜欢吃苹果')
+                worker1.add_memory(pid, '用户住在北京')
+                assert worker2.sync_changes() == 2
+                results = worker2.retrieve_memories(pid, '苹果好吃吗', 3)
+                assert [r['content'] for r in results] == ['用户喜欢吃苹果']
+                logger.info(f'✅ 新增同步 (seq={worker2.change_seq})')
+                
+                worker2.update_memory(memory['id'], '用户喜欢吃香蕉')
+                worker1.sync_changes()
+                assert worker1.retrieve_memories(pid, '香蕉', 3)[0]['content'] == '用户喜欢吃香蕉'
+                assert worker2.sync_changes() == 1 and worker2.sync_changes() == 0
+                logger.info(f'✅ 修改同步')
+                
+                worker1.delete_memory(memory['id'])
+                worker2.sync_changes()
+                assert [m['content'] for m in worker2.get_all_memories(pid)] == ['用户住在北京']
+                assert memory['id'] not in worker2.embeddings
+                logger.info(f'✅ 删除同步')
+                
+                # 变更日志被清理后落后的进程整体重新加载
+                worker1.add_memory(pid, '用户养了一只猫')
+                worker1.add_memory(pid, '用户喜欢爬山')
+                database._db_instance.prune_memory_changes(1)
+                worker2.sync_changes()
+                assert len(worker2.get_all_memories(pid)) == 3
+                logger.info(f'✅ 日志清理后重新加载')
+                
+                # 同步发生在写入数据库之后、修改缓存之前：等写入方改完缓存，不会出现两份或删除失败
+                import threading
+                db = worker1.db
+                written, release = threading.Event(), threading.Event()
+                
+                def paused(method):
+                    def call(*args, **kwargs):
+                        result = method(*args, **kwargs)
+                        written.set()
+                        release.wait(5)
+                        return result
+                    return call
+                
+                def race(name, *args):
+                    written.clear()
+                    release.clear()
+                    setattr(db, name, paused(getattr(type(db), name).__get__(db)))
+                    results = []
+                    writer = threading.Thread(target=lambda: results.append(getattr(worker1, name)(*args)))
+                    writer.start()
+                    assert written.wait(5)
+                    syncer = threading.Thread(target=worker1.sync_changes)
+                    syncer.start()
+                    syncer.join(0.2)
+                    release.set()
+                    writer.join(5)
+                    syncer.join(5)
+                    delattr(db, name)
+                    return results[0]
+                
+                guitar = race('add_memory', pid, '用户会弹吉他')
+                ids = [m['id'] for m in worker1.get_all_memories(pid)]
+                assert ids.count(guitar['id']) == 1 and len(ids) == len(set(ids))
+                assert race('delete_memory', guitar['id']) is True
+                assert guitar['id'] not in [m['id'] for m in worker1.get_all_memories(pid)]
+                
+                # 同一线程内先同步到了新记忆，加入缓存时按 ID 替换
+                db.add_memory = lambda *args, **kwargs: (type(db).add_memory(db, *args, **kwargs), worker1.sync_changes())[0]
+                piano = worker1.add_memory(pid, '用户会弹钢琴')
+                del db.add_memory
+                assert [m['id'] for m in worker1.get_all_memories(pid)].count(piano['id']) == 1
+                logger.info(f'✅ 写入与同步并发时缓存不重复')
+            finally:
+                database._db_instance.close()
+                database._db_instance = previous
+        
+        logger.info('✅ 跨进程缓存同步测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 跨进程缓存同步测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_metrics():
+    """测试指标注册表"""
+    logger.info('=' * 50)
+    logger.info('测试指标注册表')
+    logger.info('=' * 50)
+    
+    try:
+        from src.utils.metrics import Registry, Counter, Histogram, StreamTimer, track_stream, instrument_methods
+        
+        registry = Registry()
+        hits = Counter('test_hits_total', '命中次数', ['cache', 'result'], registry=registry)
+        hits.labels(cache='summary', result='hit').inc()
+        hits.labels('summary', 'hit').inc(2)
+        latency = Histogram('test_seconds', '耗时', ['method'], buckets=(0.1, 1), registry=registry)
+        latency.labels(method='get').observe(0.05)
+        latency.labels(method='get').observe(0.5)
+        registry.gauge_callback('test_memory_count', '记忆数', lambda: {('1',): 3, ('2',): 0}, ['persona_id'])
+        
+        text = registry.render()
+        assert 'test_hits_total{cache="summary",result="hit"} 3' in text
+        assert 'test_seconds_bucket{method="get",le="0.1"} 1' in text
+        assert 'test_seconds_bucket{method="get",le="+Inf"} 2' in text
+        assert 'test_seconds_count{method="get"} 2' in text
+        assert 'test_memory_count{persona_id="1"} 3' in text
+        logger.info('✅ 计数器 / 直方图 / 回调指标')
+        
+        @instrument_methods(latency, exclude=('skip',))
+        class Store:
+            def get(self):
+                return 1
+            
+            def skip(self):
+                return 2
+        
+        assert Store().get() == 1 and Store().skip() == 2
+        assert latency.labels(method='get').count == 3 and ('skip',) not in latency._children
+        logger.info('✅ 方法耗时装饰器')
+        
+        # 流式响应：正常结束 / 中途出错 / 客户端断开
+        assert list(track_stream(iter([b'a', b'b']), 'mock')) == [b'a', b'b']
+        
+        def failing():
+            yield b'a'
+            raise IOError('upstream closed')
+        
+        try:
+            list(track_stream(failing(), 'mock'))
+        except IOError:
+            pass
+        aborted = track_stream(iter([b'a', b'b']), 'mock')
+        next(aborted)
+        aborted.close()
+        
+        from src.utils.metrics import LLM_STREAM_SECONDS, LLM_TTFT_SECONDS
+        assert LLM_TTFT_SECONDS.labels(provider='mock').count == 3
+        for status in ('ok', 'error', 'aborted'):
+            assert LLM_STREAM_SECONDS.labels(provider='mock', status=status).count == 1
+        timer = StreamTimer('mock')
+        timer.finish()
+        timer.finish('error')
+        assert LLM_STREAM_SECONDS.labels(provider='mock', status='ok').count == 2
+        logger.info('✅ 首 token 延迟与流式时长')
+        
+        logger.info('✅ 指标注册表测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 指标注册表测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_request_tracing():
+    """测试请求追踪"""
+    logger.info('=' * 50)
+    logger.info('测试请求追踪')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import time
+        import tempfile
+        import pstats
+        from src.utils.tracing import RequestTracer, NULL_TRACE
+        
+        assert RequestTracer(enabled=False).start('chat') is NULL_TRACE
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            tracer = RequestTracer(enabled=True, profile_every=2, profile_dir=tmp)
+            for _ in range(3):
+                trace = tracer.start('chat')
+                with trace.span('retrieve_memories'):
+                    time.sleep(0.01)
+                trace.mark('first_token')
+                trace.mark('first_token')
+                header = trace.server_timing()
+                trace.finish()
+                trace.finish()
+            
+            assert header.startswith('retrieve_memories;dur=') and 'first_token;dur=' in header
+            assert 'total;dur=' in header
+            recent = tracer.recent()
+            assert [t['id'] for t in recent] == [3, 2, 1] and len(recent[0]['marks']) == 1
+            assert recent[0]['spans'][0]['duration'] >= 10
+            logger.info(f'✅ Server-Timing: {header}')
+            
+            # 每 2 个请求剖析一次
+            profiles = sorted(os.listdir(tmp))
+            assert len(profiles) == 2 and recent[1]['profile'].endswith('.prof')
+            assert recent[0]['profile'] is None and recent[2]['profile'] is None
+            pstats.Stats(recent[1]['profile'])
+            logger.info(f'✅ 采样剖析: {profiles}')
+        
+        logger.info('✅ 请求追踪测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 请求追踪测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_query_stats():
+    """测试 SQL 语句统计与慢查询日志"""
+    logger.info('=' * 50)
+    logger.info('测试 SQL 语句统计')
+    logger.info('=' * 50)
+    
+    try:
+        from database import Database
+        from src.utils.query_stats import QueryStats
+        
+        db = Database(':memory:', QueryStats(slow_ms=None))
+        pid = db.create_persona('测试', '')
+        ids = [db.add_memory(pid, f'记忆 {i}') for i in range(20)]
+        db.get_memories(pid)
+        db.get_memories_by_ids(ids[:3])
+        db.get_memories_by_ids(ids[:5])
+        for memory_id in ids[:4]:
+            db.update_memory_weight(memory_id, 0.5)
+        
+        stats = {s['sql']: s for s in db.get_query_stats()['statements']}
+        assert stats['UPDATE memories SET weight = ? WHERE id = ?']['count'] == 4
+        by_ids = [s for sql, s in stats.items() if 'WHERE id IN (?, ...)' in sql]
+        assert len(by_ids) == 1 and by_ids[0]['count'] == 2 and by_ids[0]['rows'] == 8
+        memories = [s for sql, s in stats.items() if 'persona_id = ? OR is_public = 1' in sql][0]
+        assert memories['rows'] == 20 and memories['p99_ms'] <= memories['max_ms']
+        assert stats['COMMIT']['count'] >= 25
+        logger.info(f'✅ 语句统计: {len(stats)} 种语句')
+        
+        # 阈值为 0 时每条语句都记为慢查询，并附带查询计划
+        db.query_stats.slow_ms = 0
+        db.get_memories(pid)
+        slow = db.get_query_stats()['slow_queries'][0]
+        assert 'idx_memory_persona' in slow['plan'], slow
+        logger.info(f'✅ 慢查询计划: {slow["plan"]}')
+        
+        # 直接迭代游标时，读取的行数和时间同样计入
+        db.reset_query_stats()
+        assert len([row for row in db.get_connection().execute('SELECT id FROM memories')]) == 20
+        stats = {s['sql']: s for s in db.get_query_stats()['statements']}
+        assert stats['SELECT id FROM memories']['count'] == 1 and stats['SELECT id FROM memories']['rows'] == 20
+        logger.info('✅ 迭代游标计入统计')
+        
+        # with conn: 块中的批量写入同样计入 COMMIT，异常时计入 ROLLBACK
+        db.reset_query_stats()
+        db.add_chat_messages([(pid, 'user', '你好', None), (pid, 'assistant', '你好！', None)])
+        db.add_memories([{'persona_id': pid, 'content': '批量记忆', 'vector': {}}])
+        try:
+            with db.get_connection() as conn:
+                conn.execute('DELETE FROM memories')
+                raise RuntimeError('回滚')
+        except RuntimeError:
+            pass
+        stats = {s['sql']: s for s in db.get_query_stats()['statements']}
+        assert stats['COMMIT']['count'] == 2 and stats['ROLLBACK']['count'] == 1
+        assert len(db.get_memories(pid)) == 21
+        logger.info('✅ with 块的提交和回滚计入统计')
+        
+        db.reset_query_stats()
+        assert db.get_query_stats()['statements'] == []
+        db.close()
+        
+        logger.info('✅ SQL 语句统计测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ SQL 语句统计测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_app_factory():
+    """测试 server_v2 应用工厂（延迟初始化）"""
+    logger.info('=' * 50)
+    logger.info('测试应用工厂')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        import server_v2
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            app = server_v2.create_app({
+                'DB_PATH': os.path.join(tmp, 'memory.db'), 'PRELOAD': False, 'BACKGROUND': False, 'LOAD_DOTENV': False,
+            })
+            state = app.extensions['server_v2']
+            assert not state.is_loaded('db') and not state.is_loaded('memory_manager')
+            logger.info('✅ 创建应用时未打开数据库')
+            
+            client = app.test_client()
+            personas = client.get('/personas').get_json()
+            assert len(personas) == 4 and state.is_loaded('db') and not state.is_loaded('memory_manager')
+            
+            memory = client.post('/memories', json={'personaId': personas[0]['id'], 'content': '用户喜欢爬山'}).get_json()
+            assert state.is_loaded('memory_manager') and state.memory_manager.db is state.db
+            assert [m['id'] for m in client.get(f'/memories/{personas[0]["id"]}').get_json()] == [memory['id']]
+            assert 'memory_count{persona_id="%d"} 1' % personas[0]['id'] in client.get('/metrics').get_data(as_text=True)
+            assert not state.is_loaded('summary_pipeline')
+            logger.info('✅ 按需初始化数据库和记忆管理器')
+            
+            # 同一进程中再创建一个应用：各自输出自己的指标，后创建的不会覆盖先创建的
+            other = server_v2.create_app({
+                'DB_PATH': os.path.join(tmp, 'other.db'), 'PRELOAD': False, 'BACKGROUND': False, 'LOAD_DOTENV': False,
+            })
+            assert 'memory_count{' not in other.test_client().get('/metrics').get_data(as_text=True)
+            text = client.get('/metrics').get_data(as_text=True)
+            assert 'memory_count{persona_id="%d"} 1' % personas[0]['id'] in text
+            assert text.count('# TYPE memory_count ') == 1
+            other.extensions['server_v2'].shutdown()
+            assert other.extensions['server_v2'].metrics.render().strip() == ''
+            logger.info('✅ 每个应用的指标互不覆盖，关闭时注销')
+            
+            state.db.close()
+        
+        logger.info('✅ 应用工厂测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 应用工厂测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_prefork():
+    """测试 fork 后的 worker 重新连接数据库并通过变更日志同步"""
+    logger.info('=' * 50)
+    logger.info('测试 prefork 多进程')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        import server_v2
+        
+        if not hasattr(os, 'fork'):
+            logger.info('⚠️  当前平台不支持 fork，跳过')
+            return True
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            app = server_v2.create_app({
+                'DB_PATH': os.path.join(tmp, 'memory.db'), 'PRELOAD': True, 'BACKGROUND': False, 'LOAD_DOTENV': False,
+            })
+            state = app.extensions['server_v2']
+            persona_id = state.db.get_all_personas()[0]['id']
+            state.before_fork()
+            assert state.db.conn is None
+            
+            pid = os.fork()
+            if pid == 0:
+                # worker：重新连接数据库后写入一条记忆
+                code = 1
+                try:
+                    state.after_fork()
+                    state.memory_manager.add_memory(persona_id, 'worker 写入的记忆')
+                    state.shutdown()
+                    code = 0
+                finally:
+                    os._exit(code)
+            _, status = os.waitpid(pid, 0)
+            assert os.waitstatus_to_exitcode(status) == 0
+            logger.info('✅ worker 重新连接数据库并写入')
+            
+            assert state.memory_manager.sync_changes() == 1
+            assert [m['content'] for m in state.memory_manager.get_all_memories(persona_id)] == ['worker 写入的记忆']
+            logger.info('✅ 其他进程通过变更日志看到 worker 的写入')
+            
+            state.shutdown()
+        
+        logger.info('✅ prefork 多进程测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ prefork 多进程测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_maintenance_pool():
+    """测试维护任务的分片计划（进程池）"""
+    logger.info('=' * 50)
+    logger.info('测试维护进程池')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        from database import Database
+        from src.utils.embeddings import HashingEmbeddingBackend
+        from src.utils.memory_manager_v2 import MemoryManager
+        from src.utils.maintenance import INLINE, get_executor, shutdown_executor
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, 'memory.db'))
+            pid = db.create_persona('维护测试', '')
+            manager = MemoryManager(db=db, embedding_backend=HashingEmbeddingBackend(dim=64))
+            for content in ['用户喜欢爬山', '用户喜欢爬山', '用户住在北京', '用户养了一只猫', '用户养了一只猫']:
+                manager.add_memory(pid, content)
+            
+            # 进程池中计算合并计划，结果与在当前线程中计算一致
+            try:
+                assert manager.merge_similar_memories(0.9, executor=get_executor(1)) == 2
+            finally:
+                shutdown_executor()
+            rows = db.get_memories(pid)
+            assert sorted(r['content'] for r in rows) == ['用户住在北京', '用户养了一只猫', '用户喜欢爬山']
+            assert sorted(r['weight'] for r in rows) == [1.0, 1.5, 1.5]
+            assert len(manager.memory_cache[pid]) == 3 and len(manager.embeddings) == 3
+            logger.info('✅ 进程池合并相似记忆（一次事务写回）')
+            
+            # 计算期间被修改的记忆不参与合并
+            memory = manager.add_memory(pid, '用户住在北京')
+            
+            class UpdatingExecutor:
+                def submit(self, fn, shard):
+                    manager.update_memory(memory['id'], '用户住在上海')
+                    return INLINE.submit(fn, shard)
+            
+            assert manager.merge_similar_memories(0.9, executor=UpdatingExecutor()) == 0
+            assert len(db.get_memories(pid)) == 4
+            logger.info('✅ 计算期间被修改的记忆跳过')
+            
+            manager.memory_cache[pid][0]['vector'] = {}
+            assert manager.revectorize_memories(executor=INLINE) == 4
+            assert manager.memory_cache[pid][0]['vector'] == manager.vectorize(manager.memory_cache[pid][0]['content'])
+            assert all(r['vector'] for r in db.get_memories(pid))
+            logger.info('✅ 重新计算向量')
+            db.close()
+        
+        logger.info('✅ 维护进程池测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 维护进程池测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_sharded_database():
+    """测试按 Persona 分片的数据库"""
+    logger.info('=' * 50)
+    logger.info('测试数据库分片')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        from database import Database, ShardedDatabase, open_database, shard_of_id
+        from src.utils.memory_manager_v2 import MemoryManager
+        from migrate_shards import migrate
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'memory.db')
+            db = ShardedDatabase(path, shards=2)
+            p1 = db.create_persona('分片一', '')
+            p2 = db.create_persona('分片二', '')
+            assert {db.shard_index(p1), db.shard_index(p2)} == {0, 1}
+            
+            m1 = db.add_memory(p1, '用户喜欢爬山', is_public=True)
+            m2 = db.add_memory(p2, '用户住在北京')
+            assert shard_of_id(m1) == db.shard_index(p1) and shard_of_id(m2) == db.shard_index(p2)
+            assert db.get_memory(m2)['content'] == '用户住在北京'
+            assert [m['id'] for m in db.get_memories(p2, include_public=True)] == [m2, m1]
+            db.add_chat_message(p1, 'user', '你好')
+            assert len(db.get_chat_history(p1)) == 1 and db.get_chat_history(p2) == []
+            assert len(db.export_all_data()['memories']) == 2
+            logger.info('✅ 写入按 Persona 路由到分片，ID 高位是分片号')
+            
+            # 每个分片有自己的变更日志
+            other = MemoryManager(db=open_database(path))
+            db.update_memory(m1, '用户喜欢徒步')
+            db.delete_memory(m2)
+            assert other.sync_changes() == 2
+            assert [m['content'] for m in other.get_all_memories(p1)] == ['用户喜欢徒步']
+            assert other.get_all_memories(p2, include_public=False) == []
+            assert len(other.change_seqs) == 2
+            other.db.close()
+            logger.info('✅ 按分片同步变更日志')
+            
+            # 字符串 ID 同样路由；合并视图的 seq 高位是分片号，按分片依次列出
+            assert db.shard_index(str(p2)) == db.shard_index(p2)
+            changes = db.get_memory_changes()
+            assert len(changes) == 4 and [c['seq'] for c in changes] == sorted(c['seq'] for c in changes)
+            assert (changes[0]['seq'], changes[-1]['seq']) == db.get_change_seq_range()
+            assert [shard_of_id(c['seq']) for c in changes] == [shard_of_id(c['memory_id']) for c in changes]
+            assert db.get_memory_changes(changes[1]['seq'], limit=1) == [changes[2]]
+            logger.info('✅ 合并读取各分片的变更日志')
+            db.close()
+            
+            # 已有的单库数据迁移到分片
+            path = os.path.join(tmp, 'legacy.db')
+            legacy = Database(path)
+            pid = legacy.create_persona('迁移测试', '')
+            old_id = legacy.add_memory(pid, '迁移前的记忆')
+            legacy.add_chat_message(pid, 'user', '迁移前的消息')
+            legacy.close()
+            
+            counts = migrate(path, 3, backup=False)
+            assert sum(c['memories'] for c in counts.values()) == 1
+            db = open_database(path)
+            assert isinstance(db, ShardedDatabase)
+            memories = db.get_memories(pid)
+            assert [m['content'] for m in memories] == ['迁移前的记忆']
+            assert memories[0]['id'] != old_id and shard_of_id(memories[0]['id']) == db.shard_index(pid)
+            assert [m['content'] for m in db.get_chat_history(pid)] == ['迁移前的消息']
+            db.close()
+            logger.info('✅ 迁移工具拆分已有数据库')
+        
+        logger.info('✅ 数据库分片测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 数据库分片测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_chat_writer():
+    """测试聊天消息的异步组提交"""
+    logger.info('=' * 50)
+    logger.info('测试聊天消息写入线程')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        import threading
+        from database import Database, ShardedDatabase
+        from src.utils.chat_writer import ChatWriter
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, 'memory.db'))
+            pid = db.create_persona('写入测试', '')
+            
+            # 第一次提交阻塞时，之后的消息在队列中累积，下一次一起提交
+            gate, entered = threading.Event(), threading.Event()
+            
+            class GatedDatabase:
+                def __init__(self):
+                    self.calls = 0
+                
+                def add_chat_messages(self, messages):
+                    self.calls += 1
+                    if self.calls == 1:
+                        entered.set()
+                        gate.wait(5)
+                    return db.add_chat_messages(messages)
+            
+            writer = ChatWriter(GatedDatabase(), batch_size=64, fsync_interval=0)
+            writer.start()
+            futures = [writer.submit(pid, 'user', '消息 0')]
+            assert entered.wait(5)
+            futures += [writer.submit(pid, 'user' if i % 2 == 0 else 'assistant', f'消息 {i}') for i in range(1, 20)]
+            gate.set()
+            writer.flush()
+            ids = [f.result(1) for f in futures]
+            assert ids == sorted(ids) and len(set(ids)) == 20
+            assert [m['content'] for m in db.get_chat_messages_after(pid)] == [f'消息 {i}' for i in range(20)]
+            stats = writer.get_stats()
+            assert stats['written'] == 20 and stats['batches'] == 2 and stats['batch_max'] == 19
+            logger.info('✅ 排队的消息一次事务提交')
+            
+            # 停止时写完队列中的消息，之后同步写入
+            gate.clear()
+            entered.clear()
+            writer.db.calls = 0
+            futures = [writer.submit(pid, 'user', f'停止前 {i}') for i in range(5)]
+            threading.Timer(0.1, gate.set).start()
+            writer.stop()
+            assert all(f.done() for f in futures)
+            assert writer.submit(pid, 'user', '停止后').result(0) > ids[-1]
+            assert len(db.get_chat_messages_after(pid)) == 26
+            logger.info('✅ 停止前写完排队的消息')
+            
+            # 队列已满、停止过程中提交的消息仍由写入线程写入，不会与写入线程并发使用同一连接
+            active, overlap = [0], []
+            
+            class CountingDatabase:
+                def add_chat_messages(self, messages):
+                    active[0] += 1
+                    overlap.append(active[0])
+                    try:
+                        if not gate.is_set():
+                            entered.set()
+                            gate.wait(5)
+                        return db.add_chat_messages(messages)
+                    finally:
+                        active[0] -= 1
+            
+            gate.clear()
+            entered.clear()
+            writer = ChatWriter(CountingDatabase(), max_queue=1, fsync_interval=0)
+            writer.start()
+            futures = [writer.submit(pid, 'user', '停止中 0')]
+            assert entered.wait(5)
+            futures.append(writer.submit(pid, 'user', '停止中 1'))   # 队列已满
+            stopper = threading.Thread(target=writer.stop)
+            stopper.start()
+            blocked = threading.Thread(target=lambda: futures.append(writer.submit(pid, 'user', '停止中 2')))
+            blocked.start()
+            starter = threading.Thread(target=writer.start)
+            starter.start()
+            starter.join(1)
+            assert not starter.is_alive(), '队列满时 start() 不应被阻塞'
+            gate.set()
+            stopper.join(5)
+            blocked.join(5)
+            assert not writer.running and len(futures) == 3
+            assert [f.result(1) for f in futures] == sorted(f.result(1) for f in futures)
+            assert max(overlap) == 1
+            assert len(db.get_chat_messages_after(pid)) == 29
+            logger.info('✅ 停止过程中提交的消息不与写入线程并发写入')
+            db.close()
+            
+            # 定期 fsync（WAL）与分片
+            sharded = ShardedDatabase(os.path.join(tmp, 'sharded.db'), shards=2)
+            p1, p2 = sharded.create_persona('一', ''), sharded.create_persona('二', '')
+            writer = ChatWriter(sharded, fsync_interval=0.05)
+            writer.start()
+            id1 = writer.submit(p1, 'user', '分片一').result(5)
+            id2 = writer.submit(p2, 'user', '分片二').result(5)
+            assert id1 >> 40 == sharded.shard_index(p1) and id2 >> 40 == sharded.shard_index(p2)
+            assert sharded.shards[0].get_connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            writer.stop()
+            assert writer.get_stats()['fsyncs'] >= 1
+            assert [m['content'] for m in sharded.get_chat_history(p2)] == ['分片二']
+            sharded.close()
+            logger.info('✅ 按分片组提交，定期 fsync')
+        
+        logger.info('✅ 聊天消息写入线程测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 聊天消息写入线程测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def test_memory_delta():
+    """测试记忆的增量同步（since 游标）"""
+    logger.info('=' * 50)
+    logger.info('测试记忆增量同步')
+    logger.info('=' * 50)
+    
+    try:
+        import os
+        import tempfile
+        import server_v2
+        from database import Database
+        from src.utils.memory_manager_v2 import MemoryManager
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'memory.db')
+            app = server_v2.create_app({'DB_PATH': path, 'BACKGROUND': False, 'LOAD_DOTENV': False})
+            state = app.extensions['server_v2']
+            p1, p2 = [p['id'] for p in state.db.get_all_personas()[:2]]
+            manager = state.memory_manager
+            manager.sync_interval = 0
+            other = MemoryManager(db=Database(path))  # 另一个 worker
+            
+            kept = other.add_memory(p1, '用户喜欢爬山')
+            full = manager.get_memory_delta(p1, '')
+            assert full['reset'] and [m['content'] for m in full['upserts']] == ['用户喜欢爬山']
+            cursor = full['cursor']
+            assert manager.get_memory_delta(p1, cursor) is None
+            logger.info('✅ 没有变化时返回 None')
+            
+            # 其他 Persona 的私有记忆不相关：只推进游标
+            other.add_memory(p2, '另一个角色的私有记忆')
+            delta = manager.get_memory_delta(p1, cursor)
+            assert delta == {'cursor': delta['cursor'], 'reset': False, 'upserts': [], 'deletes': []}
+            assert delta['cursor'] != cursor
+            cursor = delta['cursor']
+            
+            # 新增公共记忆、修改和删除
+            public = other.add_memory(p2, '公共知识', is_public=True)
+            removed = manager.add_memory(p1, '稍后删除')
+            other.update_memory(kept['id'], '用户喜欢徒步')
+            delta = manager.get_memory_delta(p1, cursor)
+            assert sorted(m['content'] for m in delta['upserts']) == ['公共知识', '用户喜欢徒步', '稍后删除']
+            assert next(m for m in delta['upserts'] if m['id'] == public['id'])['type'] == 'public'
+            cursor = delta['cursor']
+            other.delete_memory(removed['id'])
+            delta = manager.get_memory_delta(p1, cursor)
+            assert delta['upserts'] == [] and delta['deletes'] == [removed['id']]
+            logger.info('✅ 只返回新增、修改和删除的记忆')
+            
+            # 游标无效或变更已被清理时返回全部记忆
+            assert manager.get_memory_delta(p1, 'abc')['reset']
+            other.add_memory(p1, '清理前')
+            manager.db.prune_memory_changes(1)
+            delta = manager.get_memory_delta(p1, cursor)
+            assert delta['reset'] and len(delta['upserts']) == 3
+            logger.info('✅ 变更日志被清理后返回全部记忆')
+            
+            client = app.test_client()
+            response = client.get(f'/memories/{p1}?since=')
+            assert response.status_code == 200 and response.get_json()['reset']
+            cursor = response.get_json()['cursor']
+            response = client.get(f'/memories/{p1}?since={cursor}')
+            assert response.status_code == 304 and response.data == b''
+            assert isinstance(client.get(f'/memories/{p1}').get_json(), list)
+            logger.info('✅ /memories/<id>?since= 没有变化时返回 304')
+            
+            other.db.close()
+            state.shutdown()
+        
+        logger.info('✅ 记忆增量同步测试通过\n')
+        return True
+        
+    except Exception as e:
+        logger.error(f'❌ 记忆增量同步测试失败: {e}')
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 def main():
     """运行所有测试"""
     logger.info('\n' + '=' * 50)
@@ -217,6 +1551,25 @@ def main():
         '数据库模块': test_database(),
         '记忆管理器': test_memory_manager(),
         'API 配置': test_api_config(),
+        '摘要流水线': test_summary_pipeline(),
+        'SSE 解析': test_sse_parser(),
+        'LLM 客户端': test_llm_client(),
+        '提供商路由': test_provider_router(),
+        '提示词组装': test_prompt_builder(),
+        '对话滚动摘要': test_conversation_summary(),
+        '语义向量': test_embeddings(),
+        '向量索引': test_ann_index(),
+        '共享向量文件': test_vector_store(),
+        '跨进程缓存同步': test_cache_coherence(),
+        '指标': test_metrics(),
+        '请求追踪': test_request_tracing(),
+        'SQL 语句统计': test_query_stats(),
+        '应用工厂': test_app_factory(),
+        'prefork 多进程': test_prefork(),
+        '维护进程池': test_maintenance_pool(),
+        '数据库分片': test_sharded_database(),
+        '聊天消息写入': test_chat_writer(),
+        '记忆增量同步': test_memory_delta(),
     }
     
     logger.info('=' * 50)